@@ -0,0 +1,221 @@
+"""
+自転車の付属品(かご・チャイルドシート)の検出。
+
+付属品を判定する方法は2つある。
+
+- 検出モデル自体が付属品のクラスも持つ場合は、同じフレームの付属品の枠を、それを含む自転車の枠に
+  割り当てる(:func:`associateAttributes`)。追加の推論は要らない。
+- そうでない場合は、付属品のモデル(yolo/models/basket_PoC_1)を自転車の切り抜きだけにかける
+  (:class:`AttributeDetector`)。切り抜きは小さく縮小してまとめて推論し、
+  ほぼ同じ切り抜き(停車中など)の結果はキャッシュから返す。
+"""
+
+from __future__ import annotations
+from collections import OrderedDict
+from hashlib import blake2b
+from pathlib import Path
+from threading import Lock
+from time import perf_counter
+from typing import Iterable, NamedTuple, Optional, Sequence
+
+from logging import getLogger
+
+import numpy as np
+import cv2
+from cv2.typing import MatLike
+from ultralytics import YOLO
+
+from BicycleCheck.detector import Detection
+
+logger = getLogger("BicycleCheck.attributes")
+
+ATTRIBUTEMODELPATH = Path("yolo/models/basket_PoC_1/weights/best.pt")
+ATTRIBUTECLASSNAMES = ("basket", "childseat")
+ATTRIBUTE_BATCH_SIZE = 32
+ATTRIBUTE_IMAGE_SIZE = 224
+ATTRIBUTE_CONFIDENCE = 0.35
+ATTRIBUTE_CACHE_SIZE = 4096
+# 付属品の枠の面積のうち、これ以上が自転車の枠に入っていれば、その自転車のものとする
+ATTRIBUTE_MIN_CONTAINMENT = 0.6
+# キャッシュの鍵を作る時の縮小後の大きさ。色も下位ビットを落とし、わずかな違いは同じとみなす
+HASHSIZE = (16, 16)
+HASHCOLORSHIFT = 5
+
+
+class BicycleAttributes(NamedTuple):
+    hasBasket: bool
+    hasChildseat: bool
+
+    @classmethod
+    def fromClassNames(cls, classNames: Iterable[str]) -> BicycleAttributes:
+        names = set(classNames)
+        return cls("basket" in names, "childseat" in names)
+
+
+NOATTRIBUTES = BicycleAttributes(False, False)
+
+
+def getOverlaps(
+    innerBoxes: np.ndarray, outerBoxes: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    (x1, y1, x2, y2) の枠の組ごとの、IoU と、内側の枠の面積のうち外側に入っている割合 (内側の数, 外側の数)
+    """
+    topLefts = np.maximum(innerBoxes[:, None, :2], outerBoxes[None, :, :2])
+    bottomRights = np.minimum(innerBoxes[:, None, 2:], outerBoxes[None, :, 2:])
+    intersections = np.clip(bottomRights - topLefts, 0, None).prod(axis=2)
+    innerAreas = (innerBoxes[:, 2:] - innerBoxes[:, :2]).prod(axis=1)
+    outerAreas = (outerBoxes[:, 2:] - outerBoxes[:, :2]).prod(axis=1)
+    unions = innerAreas[:, None] + outerAreas[None, :] - intersections
+    ious = intersections / np.maximum(unions, 1e-6)
+    containments = intersections / np.maximum(innerAreas[:, None], 1e-6)
+    return ious, containments
+
+
+def associateAttributes(
+    bicycles: Sequence[Detection], attributes: Sequence[Detection]
+) -> list[BicycleAttributes]:
+    """
+    同じフレームの付属品の検出を、それを含む自転車に割り当てる。
+    付属品1つは、含まれる割合が最も大きい(同じならIoUが大きい)自転車1台にだけ割り当てる
+    """
+    if not bicycles or not attributes:
+        return [NOATTRIBUTES] * len(bicycles)
+    ious, containments = getOverlaps(
+        np.array([attribute.box for attribute in attributes], dtype=np.float32),
+        np.array([bicycle.box for bicycle in bicycles], dtype=np.float32),
+    )
+    classNames: list[set[str]] = [set() for _ in bicycles]
+    # 含まれる割合で比べ、IoUは同点の時だけ効くようにする
+    scores = containments + ious * 1e-3
+    for attribute, attributeScores, attributeContainments in zip(
+        attributes, scores, containments
+    ):
+        best = int(attributeScores.argmax())
+        if attributeContainments[best] >= ATTRIBUTE_MIN_CONTAINMENT:
+            classNames[best].add(attribute.className)
+    return [BicycleAttributes.fromClassNames(names) for names in classNames]
+
+
+def getCropHash(crop: MatLike) -> str:
+    """
+    縮小して色を粗くした切り抜きのハッシュ。ほぼ同じ切り抜きは同じ値になる
+    """
+    if crop.size == 0:
+        return ""
+    small = cv2.resize(crop, HASHSIZE, interpolation=cv2.INTER_AREA) >> HASHCOLORSHIFT
+    return blake2b(small.tobytes(), digest_size=16).hexdigest()
+
+
+class AttributeDetector(object):
+    """
+    付属品のモデルを自転車の切り抜きにかけるクラス。複数のスレッドから使える。
+    """
+
+    model: YOLO
+    batchSize: int
+    imageSize: int
+    confidence: float
+    cacheSize: int
+    classIds: list[int]
+    cropCount: int
+    cacheHitCount: int
+    inferenceSeconds: float
+    _cache: OrderedDict[str, BicycleAttributes]
+    _lock: Lock
+    _predictLock: Lock
+
+    def __init__(
+        self,
+        modelPath: str | Path = ATTRIBUTEMODELPATH,
+        batchSize: int = ATTRIBUTE_BATCH_SIZE,
+        imageSize: int = ATTRIBUTE_IMAGE_SIZE,
+        confidence: float = ATTRIBUTE_CONFIDENCE,
+        cacheSize: int = ATTRIBUTE_CACHE_SIZE,
+    ) -> None:
+        self.model = YOLO(str(modelPath))
+        self.batchSize = batchSize
+        self.imageSize = imageSize
+        self.confidence = confidence
+        self.cacheSize = cacheSize
+        self.classIds = [
+            classId
+            for classId, className in self.model.names.items()
+            if className in ATTRIBUTECLASSNAMES
+        ]
+        if not self.classIds:
+            raise ValueError(f"model {modelPath} has none of {ATTRIBUTECLASSNAMES}")
+        self.cropCount = 0
+        self.cacheHitCount = 0
+        self.inferenceSeconds = 0.0
+        self._cache = OrderedDict()
+        self._lock = Lock()
+        self._predictLock = Lock()
+        logger.info(f"loaded attribute model {modelPath}, classes {self.classIds}")
+
+    def _getCached(self, key: str) -> Optional[BicycleAttributes]:
+        with self._lock:
+            attributes = self._cache.get(key)
+            if attributes is not None:
+                self._cache.move_to_end(key)
+            return attributes
+
+    def _setCached(self, key: str, attributes: BicycleAttributes) -> None:
+        with self._lock:
+            self._cache[key] = attributes
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cacheSize:
+                self._cache.popitem(last=False)
+
+    def _predict(self, crops: Sequence[MatLike]) -> list[BicycleAttributes]:
+        startTime = perf_counter()
+        # 同じモデルを複数のスレッドから同時に推論させない
+        with self._predictLock:
+            results = self.model.predict(
+                list(crops),
+                imgsz=self.imageSize,
+                conf=self.confidence,
+                classes=self.classIds,
+                verbose=False,
+            )
+        elapsed = perf_counter() - startTime
+        with self._lock:
+            self.inferenceSeconds += elapsed
+        logger.debug(f"detected attributes of {len(crops)} crops in {elapsed * 1000:.0f}ms")
+        return [
+            BicycleAttributes.fromClassNames(
+                self.model.names[classId]
+                for classId in (
+                    result.boxes.cls.cpu().numpy().astype(int).tolist()
+                    if result.boxes is not None
+                    else []
+                )
+            )
+            for result in results
+        ]
+
+    def detectCrops(self, crops: Sequence[MatLike]) -> list[BicycleAttributes]:
+        """
+        自転車の切り抜きごとに付属品を判定する。キャッシュに無いものだけを batchSize ずつ推論する
+        """
+        results: list[Optional[BicycleAttributes]] = []
+        missIndexes: list[int] = []
+        keys = [getCropHash(crop) for crop in crops]
+        for i, key in enumerate(keys):
+            attributes = NOATTRIBUTES if key == "" else self._getCached(key)
+            results.append(attributes)
+            if attributes is None:
+                missIndexes.append(i)
+        with self._lock:
+            self.cropCount += len(crops)
+            self.cacheHitCount += len(crops) - len(missIndexes)
+        for start in range(0, len(missIndexes), self.batchSize):
+            indexes = missIndexes[start : start + self.batchSize]
+            for i, attributes in zip(indexes, self._predict([crops[i] for i in indexes])):
+                results[i] = attributes
+                self._setCached(keys[i], attributes)
+        return [attributes or NOATTRIBUTES for attributes in results]
+
+    def getSummary(self) -> str:
+        hitRatio = self.cacheHitCount / self.cropCount if self.cropCount else 0.0
+        return f"{self.cropCount} crops, cache hit {hitRatio:.0%}, inference {self.inferenceSeconds:.2f}s"
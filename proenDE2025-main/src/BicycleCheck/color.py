@@ -0,0 +1,191 @@
+"""
+自転車の切り抜き画像の色分類。
+
+切り抜きを小さく縮小し、各画素をLab色空間で固定のパレットの最も近い色に割り当てて、
+割合の多い色を自転車の色とする。複数の切り抜きをまとめて一度の配列演算で処理する。
+道路やタイヤの黒・灰色が多く写るので、有彩色が一定の割合(chromaticShare)以上あればそちらを優先する。
+セグメンテーションのマスクがあれば自転車の画素だけを数え、無ければ中央ほど重く数える。
+"""
+
+from __future__ import annotations
+from time import perf_counter
+from typing import Optional, Sequence
+
+from logging import getLogger
+
+import numpy as np
+import cv2
+from cv2.typing import MatLike
+
+logger = getLogger("BicycleCheck.color")
+
+COLOR_SAMPLE_SIZE = 32
+COLOR_CHROMATIC_SHARE = 0.2
+UNKNOWNCOLOR = "unknown"
+# DBの color 列に入る色の名前。無彩色とそれ以外に分ける
+ACHROMATICNAMES = ("black", "gray", "silver", "white")
+CHROMATICNAMES = ("red", "orange", "yellow", "green", "blue", "brown", "pink", "purple")
+COLORNAMES = ACHROMATICNAMES + CHROMATICNAMES
+# (色の名前, BGR)。同じ名前に複数の代表色を持たせてよい
+COLORPALETTE: tuple[tuple[str, tuple[int, int, int]], ...] = (
+    ("black", (20, 20, 20)),
+    ("gray", (110, 110, 110)),
+    ("silver", (180, 180, 180)),
+    ("white", (240, 240, 240)),
+    ("red", (40, 30, 190)),
+    ("red", (30, 20, 120)),
+    ("orange", (20, 120, 240)),
+    ("yellow", (30, 210, 230)),
+    ("green", (60, 150, 40)),
+    ("green", (40, 80, 30)),
+    ("blue", (180, 90, 20)),
+    ("blue", (100, 40, 20)),
+    ("blue", (220, 170, 110)),
+    ("brown", (40, 70, 110)),
+    ("pink", (180, 130, 235)),
+    ("purple", (130, 40, 110)),
+)
+
+
+def toLab(bgrPixels: np.ndarray) -> np.ndarray:
+    """
+    uint8 のBGR画素(最後の次元が3)を、float32 のLab(L: 0〜100)に変換する
+    """
+    shape = bgrPixels.shape
+    pixels = bgrPixels.reshape(-1, 1, 3).astype(np.float32) / 255
+    return cv2.cvtColor(pixels, cv2.COLOR_BGR2Lab).reshape(shape)
+
+
+def getCenterWeights(width: int, height: int) -> np.ndarray:
+    """
+    マスクが無い場合の重み (高さ, 幅)。中央が1で、縁に向かって0に近づく
+    """
+    xs = np.linspace(-1.0, 1.0, width, dtype=np.float32)
+    ys = np.linspace(-1.0, 1.0, height, dtype=np.float32)
+    distances = np.sqrt(xs[None, :] ** 2 + ys[:, None] ** 2)
+    return np.clip(1.0 - distances, 0.0, 1.0)
+
+
+def stackCrops(
+    crops: Sequence[MatLike],
+    masks: Optional[Sequence[Optional[MatLike]]],
+    size: tuple[int, int],
+    centerWeights: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    切り抜きを size (幅, 高さ) に縮小して積み重ね、画素 (N, 高さ, 幅, 3) と重み (N, 高さ, 幅) を返す。
+    マスクが無いものは centerWeights で重みづけし、空の切り抜きは重み0にする
+    """
+    width, height = size
+    pixels = np.zeros((len(crops), height, width, 3), dtype=np.uint8)
+    weights = np.zeros((len(crops), height, width), dtype=np.float32)
+    for i, crop in enumerate(crops):
+        if crop.size == 0:
+            continue
+        pixels[i] = cv2.resize(crop, size, interpolation=cv2.INTER_AREA)
+        mask = masks[i] if masks is not None else None
+        if mask is None:
+            weights[i] = centerWeights
+        else:
+            weights[i] = cv2.resize(
+                (np.asarray(mask) > 0).astype(np.float32),
+                size,
+                interpolation=cv2.INTER_AREA,
+            )
+    return pixels, weights
+
+
+class ColorClassifier(object):
+    """
+    パレットによる色分類を行うクラス。
+    """
+
+    sampleSize: int
+    chromaticShare: float
+    cropCount: int
+    classifySeconds: float
+    _paletteLab: np.ndarray
+    _paletteNames: np.ndarray
+    _centerWeights: np.ndarray
+
+    def __init__(
+        self,
+        sampleSize: int = COLOR_SAMPLE_SIZE,
+        chromaticShare: float = COLOR_CHROMATIC_SHARE,
+    ) -> None:
+        self.sampleSize = sampleSize
+        self.chromaticShare = chromaticShare
+        self.cropCount = 0
+        self.classifySeconds = 0.0
+        self._paletteLab = toLab(
+            np.array([bgr for _, bgr in COLORPALETTE], dtype=np.uint8)
+        )
+        # パレットの各色が COLORNAMES の何番目か
+        self._paletteNames = np.array(
+            [COLORNAMES.index(name) for name, _ in COLORPALETTE]
+        )
+        self._centerWeights = getCenterWeights(sampleSize, sampleSize)
+
+    def getColorShares(
+        self,
+        crops: Sequence[MatLike],
+        masks: Optional[Sequence[Optional[MatLike]]] = None,
+    ) -> np.ndarray:
+        """
+        切り抜きごとの、COLORNAMES の各色の割合 (N, 色の数)。数える画素が無いものは全て0
+        """
+        pixels, weights = stackCrops(
+            crops, masks, (self.sampleSize, self.sampleSize), self._centerWeights
+        )
+        labs = toLab(pixels).reshape(len(crops), -1, 3)
+        # 各画素とパレットの各色との距離の2乗 (N, P, K)
+        distances = (
+            np.einsum("npc,npc->np", labs, labs)[:, :, None]
+            - 2 * labs @ self._paletteLab.T
+            + np.einsum("kc,kc->k", self._paletteLab, self._paletteLab)
+        )
+        nameIndexes = self._paletteNames[distances.argmin(axis=2)]
+        offsets = np.arange(len(crops))[:, None] * len(COLORNAMES)
+        counts = np.bincount(
+            (nameIndexes + offsets).ravel(),
+            weights=weights.reshape(len(crops), -1).ravel(),
+            minlength=len(crops) * len(COLORNAMES),
+        ).reshape(len(crops), len(COLORNAMES))
+        totals = counts.sum(axis=1, keepdims=True)
+        return np.divide(counts, totals, out=np.zeros_like(counts), where=totals > 0)
+
+    def classifyBatch(
+        self,
+        crops: Sequence[MatLike],
+        masks: Optional[Sequence[Optional[MatLike]]] = None,
+    ) -> list[str]:
+        """
+        切り抜きのまとまりを一度に分類し、それぞれの色の名前を返す。
+        masks を渡す場合は crops と同じ長さにし、マスクの無いものはNoneにする
+        """
+        if not crops:
+            return []
+        startTime = perf_counter()
+        shares = self.getColorShares(crops, masks)
+        achromaticCount = len(ACHROMATICNAMES)
+        chromaticBest = shares[:, achromaticCount:].argmax(axis=1) + achromaticCount
+        achromaticBest = shares[:, :achromaticCount].argmax(axis=1)
+        isChromatic = (
+            shares[np.arange(len(crops)), chromaticBest] >= self.chromaticShare
+        )
+        bestIndexes = np.where(isChromatic, chromaticBest, achromaticBest)
+        isCounted = shares.sum(axis=1) > 0
+        colors = [
+            COLORNAMES[index] if counted else UNKNOWNCOLOR
+            for index, counted in zip(bestIndexes.tolist(), isCounted.tolist())
+        ]
+        elapsed = perf_counter() - startTime
+        self.cropCount += len(crops)
+        self.classifySeconds += elapsed
+        logger.debug(f"classified {len(crops)} crops in {elapsed * 1000:.1f}ms")
+        return colors
+
+    def getCropsPerSecond(self) -> float:
+        if self.classifySeconds == 0:
+            return 0.0
+        return self.cropCount / self.classifySeconds
@@ -0,0 +1,569 @@
+"""
+YOLOによる自転車検出エンジン。
+
+モデルはワーカー(プロセス)ごとに一度だけ読み込み、:meth:`mp4extract.Mp4File.iterateFrames`
+から受け取ったメモリ上のフレームをバッチにまとめて推論する。
+切り抜き画像などの中間ファイルは書き出さず、検出結果を :class:`Detection` として返す。
+
+推論の実行方式(backend)は configs/universal.json の detector で選べる。
+
+- torch: ultralytics(PyTorch)でそのまま推論する
+- onnx: ONNXに書き出したモデルを ONNX Runtime で推論する。int8 にすると、重みを動的量子化したモデルを使う
+- openvino: OpenVINOの形式に書き出したモデルを OpenVINO Runtime で推論する
+
+書き出したモデルは元のモデルの隣に置き、次回からはそれを使う。
+onnx と openvino には onnxruntime / openvino パッケージが別途必要。
+"""
+
+from __future__ import annotations
+from abc import ABC, abstractmethod
+from ast import literal_eval
+from functools import lru_cache
+from json import load
+from pathlib import Path
+from threading import Lock
+from time import perf_counter
+from typing import Any, Generator, Iterable, NamedTuple, Optional, Sequence
+import os
+
+from logging import getLogger
+
+import numpy as np
+import cv2
+from cv2.typing import MatLike
+from ultralytics import YOLO
+from yaml import safe_load as loadYaml
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+try:
+    import openvino
+except ImportError:
+    openvino = None
+
+logger = getLogger("BicycleCheck.detector")
+
+DETECTMODELPATH = Path("yolo11n.pt")
+DETECTBATCHSIZE = 8
+DETECTCONFIDENCE = 0.25
+DETECTIOU = 0.7
+DETECTIMAGESIZE = 640
+# 付属品のクラスを持つモデルなら、それらも同じ推論で検出する(BicycleCheck.attributes を参照)
+DETECTCLASSNAMES = ("bicycle", "basket", "childseat")
+DETECTBACKENDS = ("torch", "onnx", "openvino")
+DETECT_WARMUP_COUNT = 2
+# レターボックスの余白の色(ultralyticsと同じ)
+LETTERBOXCOLOR = (114, 114, 114)
+
+
+class Detection(NamedTuple):
+    """
+    1フレーム内の1つの検出結果。box はフレーム上のピクセル座標 (x1, y1, x2, y2)
+    """
+
+    frameIndex: int
+    box: tuple[float, float, float, float]
+    confidence: float
+    classId: int
+    className: str
+
+
+class RawDetection(NamedTuple):
+    """
+    実行方式から返す、クラス名を付ける前の検出結果
+    """
+
+    box: tuple[float, float, float, float]
+    confidence: float
+    classId: int
+
+
+@lru_cache(maxsize=1)
+def getDetectorConfig() -> dict[str, Any]:
+    """
+    検出エンジンの設定。configs/universal.json の detector にあればそれを使う。
+    threads が0なら、CPUのコア数を推論ワーカーの数で割った数にする
+    """
+    detectorConfig: dict[str, Any] = {
+        "backend": "torch",
+        "int8": False,
+        "threads": 0,
+        "warmupCount": DETECT_WARMUP_COUNT,
+    }
+    filepath = Path("configs/universal.json")
+    if filepath.exists():
+        with open(filepath, "r") as file:
+            detectorConfig.update(load(file).get("detector", {}))
+    if detectorConfig["backend"] not in DETECTBACKENDS:
+        raise ValueError(f"unknown detector backend '{detectorConfig['backend']}'")
+    return detectorConfig
+
+
+def getThreadCount(workerCount: int = 1) -> int:
+    """
+    推論ワーカー1つあたりのスレッド数。設定の threads が0なら、CPUのコアを workerCount で分け合う
+    """
+    threadCount = int(getDetectorConfig()["threads"])
+    if threadCount > 0:
+        return threadCount
+    return max((os.cpu_count() or 1) // max(workerCount, 1), 1)
+
+
+@lru_cache(maxsize=None)
+def getYoloModel(modelPath: str) -> YOLO:
+    """
+    プロセス内で共有するultralyticsのモデル。埋め込みの計算などにも使う
+    """
+    return YOLO(modelPath)
+
+
+@lru_cache(maxsize=None)
+def getYoloModelLock(modelPath: str) -> Lock:
+    """
+    :func:`getYoloModel` のモデルごとのロック。ultralyticsの推論は、同じモデルを複数のスレッドから同時に使えない
+    """
+    return Lock()
+
+
+class DetectorBackend(ABC):
+    """
+    推論の実行方式の抽象クラス。
+    """
+
+    names: dict[int, str]
+
+    @abstractmethod
+    def predict(
+        self,
+        frames: Sequence[MatLike],
+        classIds: Optional[list[int]],
+        confidence: float,
+    ) -> list[list[RawDetection]]:
+        """
+        フレームのまとまりを推論し、フレームごとの検出結果を返す
+        """
+        raise NotImplementedError()
+
+
+class TorchBackend(DetectorBackend):
+    """
+    ultralytics(PyTorch)による推論。
+    torch のスレッド数はプロセス全体の設定なので、1つのプロセスに読み込む検出エンジンは1つにすること
+    """
+
+    model: YOLO
+    modelPath: str
+    imageSize: int
+    device: str
+
+    def __init__(
+        self, modelPath: Path, imageSize: int, device: str, threadCount: int
+    ) -> None:
+        import torch
+
+        torch.set_num_threads(threadCount)
+        self.modelPath = str(modelPath)
+        self.model = getYoloModel(self.modelPath)
+        self.names = self.model.names
+        self.imageSize = imageSize
+        self.device = device
+
+    def predict(
+        self,
+        frames: Sequence[MatLike],
+        classIds: Optional[list[int]],
+        confidence: float,
+    ) -> list[list[RawDetection]]:
+        with getYoloModelLock(self.modelPath):
+            results = self.model.predict(
+                list(frames),
+                imgsz=self.imageSize,
+                conf=confidence,
+                iou=DETECTIOU,
+                classes=classIds,
+                device=self.device,
+                verbose=False,
+            )
+        detections: list[list[RawDetection]] = []
+        for result in results:
+            boxes = result.boxes
+            if boxes is None:
+                detections.append([])
+                continue
+            columns = zip(
+                boxes.xyxy.cpu().numpy().tolist(),
+                boxes.conf.cpu().numpy().tolist(),
+                boxes.cls.cpu().numpy().astype(int).tolist(),
+            )
+            detections.append(
+                [
+                    RawDetection(tuple(box), score, classId)
+                    for box, score, classId in columns
+                ]
+            )
+        return detections
+
+
+class ExportedBackend(DetectorBackend):
+    """
+    書き出したモデルによる推論の共通部分。前処理(レターボックス)と後処理(NMS)をultralyticsと同じように行う
+    """
+
+    imageSize: int
+
+    @abstractmethod
+    def _run(self, inputs: np.ndarray) -> np.ndarray:
+        """
+        (N, 3, 高さ, 幅) の入力から、(N, 4 + クラス数, 候補数) の出力を得る
+        """
+        raise NotImplementedError()
+
+    def _letterbox(self, frame: MatLike) -> tuple[np.ndarray, float, float, float]:
+        """
+        縦横比を保って imageSize 四方に収め、(画像, 倍率, 左の余白, 上の余白) を返す
+        """
+        height, width = frame.shape[:2]
+        scale = min(self.imageSize / height, self.imageSize / width)
+        resizedWidth, resizedHeight = round(width * scale), round(height * scale)
+        padX = (self.imageSize - resizedWidth) / 2
+        padY = (self.imageSize - resizedHeight) / 2
+        resized = cv2.resize(
+            frame, (resizedWidth, resizedHeight), interpolation=cv2.INTER_LINEAR
+        )
+        image = cv2.copyMakeBorder(
+            resized,
+            round(padY - 0.1),
+            round(padY + 0.1),
+            round(padX - 0.1),
+            round(padX + 0.1),
+            cv2.BORDER_CONSTANT,
+            value=LETTERBOXCOLOR,
+        )
+        return image, scale, round(padX - 0.1), round(padY - 0.1)
+
+    def predict(
+        self,
+        frames: Sequence[MatLike],
+        classIds: Optional[list[int]],
+        confidence: float,
+    ) -> list[list[RawDetection]]:
+        letterboxes = [self._letterbox(frame) for frame in frames]
+        # BGR → RGB、HWC → CHW、0〜1
+        inputs = np.stack([image for image, *_ in letterboxes])[..., ::-1]
+        inputs = np.ascontiguousarray(inputs.transpose(0, 3, 1, 2), dtype=np.float32) / 255
+        outputs = self._run(inputs)
+        detections: list[list[RawDetection]] = []
+        for output, frame, (_, scale, padX, padY) in zip(outputs, frames, letterboxes):
+            candidates = output.T
+            scores = candidates[:, 4:]
+            if classIds is not None:
+                masked = np.full_like(scores, -1.0)
+                masked[:, classIds] = scores[:, classIds]
+                scores = masked
+            candidateClassIds = scores.argmax(axis=1)
+            confidences = scores[np.arange(len(scores)), candidateClassIds]
+            isKept = confidences > confidence
+            centers = candidates[isKept, :4]
+            confidences = confidences[isKept]
+            candidateClassIds = candidateClassIds[isKept]
+            # 中心と大きさ → 左上と大きさ。NMSはクラスごとに行う
+            topLefts = np.column_stack(
+                (centers[:, :2] - centers[:, 2:] / 2, centers[:, 2:])
+            )
+            keptIndexes = cv2.dnn.NMSBoxesBatched(
+                topLefts.tolist(),
+                confidences.tolist(),
+                candidateClassIds.tolist(),
+                confidence,
+                DETECTIOU,
+            )
+            height, width = frame.shape[:2]
+            frameDetections: list[RawDetection] = []
+            for index in np.asarray(keptIndexes, dtype=np.int64).reshape(-1).tolist():
+                x, y, boxWidth, boxHeight = topLefts[index].tolist()
+                x1 = min(max((x - padX) / scale, 0.0), width)
+                y1 = min(max((y - padY) / scale, 0.0), height)
+                x2 = min(max((x + boxWidth - padX) / scale, 0.0), width)
+                y2 = min(max((y + boxHeight - padY) / scale, 0.0), height)
+                frameDetections.append(
+                    RawDetection(
+                        (x1, y1, x2, y2),
+                        float(confidences[index]),
+                        int(candidateClassIds[index]),
+                    )
+                )
+            frameDetections.sort(key=lambda detection: -detection.confidence)
+            detections.append(frameDetections)
+        return detections
+
+
+class OnnxBackend(ExportedBackend):
+    """
+    ONNX Runtime による推論。
+    """
+
+    session: Any
+    _inputName: str
+
+    def __init__(self, modelPath: Path, imageSize: int, threadCount: int) -> None:
+        if onnxruntime is None:
+            raise ImportError("onnxruntime package is required for the onnx backend")
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threadCount
+        options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(
+            str(modelPath), options, providers=["CPUExecutionProvider"]
+        )
+        self._inputName = self.session.get_inputs()[0].name
+        # ultralyticsは書き出す時にクラス名をメタデータに入れる
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.names = literal_eval(metadata["names"])
+        self.imageSize = imageSize
+
+    def _run(self, inputs: np.ndarray) -> np.ndarray:
+        return self.session.run(None, {self._inputName: inputs})[0]
+
+
+class OpenVinoBackend(ExportedBackend):
+    """
+    OpenVINO Runtime による推論。
+    """
+
+    compiledModel: Any
+    _lock: Lock
+
+    def __init__(self, modelDir: Path, imageSize: int, threadCount: int) -> None:
+        if openvino is None:
+            raise ImportError("openvino package is required for the openvino backend")
+        core = openvino.Core()
+        model = core.read_model(str(next(modelDir.glob("*.xml"))))
+        self.compiledModel = core.compile_model(
+            model,
+            "CPU",
+            {"INFERENCE_NUM_THREADS": threadCount, "PERFORMANCE_HINT": "LATENCY"},
+        )
+        with open(modelDir.joinpath("metadata.yaml"), "r") as file:
+            self.names = loadYaml(file)["names"]
+        self.imageSize = imageSize
+        self._lock = Lock()
+
+    def _run(self, inputs: np.ndarray) -> np.ndarray:
+        # コンパイル済みモデルを直接呼ぶと共有の推論リクエストを使うので、スレッド間で同時に呼ばない
+        with self._lock:
+            return self.compiledModel(inputs)[self.compiledModel.output(0)]
+
+
+def getExportedModelPath(
+    modelPath: Path, backend: str, isInt8: bool, imageSize: int
+) -> Path:
+    """
+    backend の形式に書き出したモデルの場所。まだ無ければ書き出す。
+    onnx の int8 は、書き出したONNXの重みを動的量子化して作る
+    """
+    if backend == "torch":
+        return modelPath
+    if backend == "onnx":
+        exportedPath = modelPath.with_suffix(".onnx")
+        if not exportedPath.exists():
+            logger.info(f"exporting {modelPath} to {exportedPath}")
+            getYoloModel(str(modelPath)).export(
+                format="onnx", imgsz=imageSize, dynamic=True, simplify=True
+            )
+        if not isInt8:
+            return exportedPath
+        quantizedPath = modelPath.with_name(f"{modelPath.stem}_int8.onnx")
+        if not quantizedPath.exists():
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            logger.info(f"quantizing {exportedPath} to {quantizedPath}")
+            quantize_dynamic(exportedPath, quantizedPath, weight_type=QuantType.QUInt8)
+        return quantizedPath
+    if isInt8:
+        raise ValueError("int8 is only supported by the onnx backend")
+    exportedPath = modelPath.with_name(f"{modelPath.stem}_openvino_model")
+    if not exportedPath.exists():
+        logger.info(f"exporting {modelPath} to {exportedPath}")
+        getYoloModel(str(modelPath)).export(
+            format="openvino", imgsz=imageSize, dynamic=True
+        )
+    return exportedPath
+
+
+def getBackend(
+    modelPath: Path,
+    backend: str,
+    isInt8: bool,
+    imageSize: int,
+    device: str,
+    threadCount: int,
+) -> DetectorBackend:
+    exportedPath = getExportedModelPath(modelPath, backend, isInt8, imageSize)
+    match backend:
+        case "torch":
+            return TorchBackend(exportedPath, imageSize, device, threadCount)
+        case "onnx":
+            return OnnxBackend(exportedPath, imageSize, threadCount)
+        case _:
+            return OpenVinoBackend(exportedPath, imageSize, threadCount)
+
+
+class BicycleDetector(object):
+    """
+    モデルを保持し、フレームをバッチで推論するクラス。複数のスレッドから使える。
+    """
+
+    backend: DetectorBackend
+    backendName: str
+    batchSize: int
+    confidence: float
+    imageSize: int
+    classIds: Optional[list[int]]
+    frameCount: int
+    inferenceSeconds: float
+    _lock: Lock
+
+    def __init__(
+        self,
+        modelPath: str | Path = DETECTMODELPATH,
+        batchSize: int = DETECTBATCHSIZE,
+        confidence: float = DETECTCONFIDENCE,
+        imageSize: int = DETECTIMAGESIZE,
+        classNames: Optional[Sequence[str]] = DETECTCLASSNAMES,
+        device: str = "cpu",
+        backend: Optional[str] = None,
+        isInt8: Optional[bool] = None,
+        threadCount: Optional[int] = None,
+        warmupCount: Optional[int] = None,
+    ) -> None:
+        """
+        backend などを省略した場合は、configs/universal.json の detector の設定を使う。
+        threadCount を省略した場合は、推論ワーカーが1つとして :func:`getThreadCount` で決める
+        """
+        detectorConfig = getDetectorConfig()
+        self.backendName = backend if backend is not None else detectorConfig["backend"]
+        isInt8 = isInt8 if isInt8 is not None else bool(detectorConfig["int8"])
+        if threadCount is None:
+            threadCount = getThreadCount()
+        warmupCount = (
+            warmupCount if warmupCount is not None else int(detectorConfig["warmupCount"])
+        )
+        self.backend = getBackend(
+            Path(modelPath), self.backendName, isInt8, imageSize, device, threadCount
+        )
+        self.batchSize = batchSize
+        self.confidence = confidence
+        self.imageSize = imageSize
+        self.classIds = self._getClassIds(classNames)
+        self.frameCount = 0
+        self.inferenceSeconds = 0.0
+        self._lock = Lock()
+        logger.info(
+            f"loaded detection model {modelPath} ({self.backendName}{', int8' if isInt8 else ''}, {threadCount} threads), classes {self.classIds}"
+        )
+        self.warmUp(warmupCount)
+
+    @property
+    def names(self) -> dict[int, str]:
+        return self.backend.names
+
+    def _getClassIds(self, classNames: Optional[Sequence[str]]) -> Optional[list[int]]:
+        """
+        クラス名をモデルのクラス番号に変換する。
+        モデルに該当するクラスが無い場合は、全クラスを対象にする(None)
+        """
+        if classNames is None:
+            return None
+        classIds = [
+            classId
+            for classId, className in self.names.items()
+            if className in classNames
+        ]
+        if not classIds:
+            logger.warning(
+                f"model has none of {classNames}. detecting all classes instead"
+            )
+            return None
+        return classIds
+
+    def warmUp(self, count: int) -> None:
+        """
+        初回の推論は初期化などで遅いので、ワーカーの起動時に空のフレームで済ませておく。統計には含めない
+        """
+        if count <= 0:
+            return
+        startTime = perf_counter()
+        frame = np.full((self.imageSize, self.imageSize, 3), 114, dtype=np.uint8)
+        for _ in range(count):
+            self.backend.predict([frame] * self.batchSize, self.classIds, self.confidence)
+        logger.info(
+            f"warmed up {self.backendName} in {(perf_counter() - startTime) * 1000:.0f}ms"
+        )
+
+    def detectBatch(
+        self, frameIndexes: Sequence[int], frames: Sequence[MatLike]
+    ) -> list[Detection]:
+        """
+        フレームのまとまりを一度に推論する
+        """
+        startTime = perf_counter()
+        results = self.backend.predict(frames, self.classIds, self.confidence)
+        elapsed = perf_counter() - startTime
+        with self._lock:
+            self.frameCount += len(frames)
+            self.inferenceSeconds += elapsed
+        logger.debug(
+            f"detected batch of {len(frames)} frames in {elapsed * 1000:.0f}ms ({len(frames) / elapsed:.1f} frames/s)"
+        )
+
+        detections: list[Detection] = []
+        for frameIndex, result in zip(frameIndexes, results):
+            for box, confidence, classId in result:
+                detections.append(
+                    Detection(
+                        frameIndex=frameIndex,
+                        box=box,
+                        confidence=confidence,
+                        classId=classId,
+                        className=self.names[classId],
+                    )
+                )
+        return detections
+
+    def detectFrames(
+        self, frames: Iterable[tuple[int, MatLike]]
+    ) -> Generator[Detection, None, None]:
+        """
+        (フレーム番号, フレーム) の列を batchSize ずつまとめて推論し、検出結果を順に返す。
+        :meth:`mp4extract.Mp4File.iterateFrames` をそのまま渡せる。
+        """
+        frameIndexes: list[int] = []
+        batch: list[MatLike] = []
+        for frameIndex, frame in frames:
+            frameIndexes.append(frameIndex)
+            batch.append(frame)
+            if len(batch) >= self.batchSize:
+                yield from self.detectBatch(frameIndexes, batch)
+                frameIndexes, batch = [], []
+        if batch:
+            yield from self.detectBatch(frameIndexes, batch)
+
+    def getFramesPerSecond(self) -> float:
+        if self.inferenceSeconds == 0:
+            return 0.0
+        return self.frameCount / self.inferenceSeconds
+
+
+@lru_cache(maxsize=None)
+def getDetector(
+    modelPath: str = str(DETECTMODELPATH),
+    batchSize: int = DETECTBATCHSIZE,
+    threadCount: Optional[int] = None,
+) -> BicycleDetector:
+    """
+    プロセス内で共有する検出エンジンを取得する。モデルはプロセスごとに一度だけ読み込まれ、
+    読み込んだ時にウォームアップする
+    """
+    return BicycleDetector(modelPath, batchSize, threadCount=threadCount)
@@ -0,0 +1,280 @@
+"""
+自転車の切り抜き画像の外観の特徴ベクトル(再識別用)。
+
+experiments/similarity.ipynb では、比べる画像の組ごとに calcHist やAKAZEの特徴点を計算し直していたが、
+ここでは切り抜き1枚ごとに固定長のベクトルを一度だけ計算し、比較はベクトルのコサイン類似度で行う。
+ベクトルは次の部分をそれぞれ正規化してつなげたもの。
+
+- HSVの色相・彩度のヒストグラム(彩度の低い画素は明度のヒストグラム)
+- 明暗の勾配の向きのヒストグラム(2×4のマスごと)
+- 2×4のマスごとの平均のLab
+- YOLOの中間層の埋め込み(backboneModelPath を指定した場合のみ)
+
+ヒストグラムなどは非負なので、そのままでは別の自転車どうしでもコサイン類似度が高くなる
+(ver2 のデータセットで、別の自転車の組の84%が0.7以上)。そこで、YOLO以外の部分は
+benchmarks/reidCalibration.py で求めた平均を引いてPCAで白色化してから使う。
+白色化の行列は yolo/models/reid/whitening.npz に置く。
+
+複数の切り抜きをまとめて一度の配列演算で処理する。
+"""
+
+from __future__ import annotations
+from pathlib import Path
+from time import perf_counter
+from typing import Optional, Sequence
+
+from logging import getLogger
+
+import numpy as np
+import cv2
+from cv2.typing import MatLike
+
+from BicycleCheck.color import getCenterWeights, stackCrops, toLab
+
+logger = getLogger("BicycleCheck.reid")
+
+# 縮小後の大きさ (幅, 高さ)。自転車は横長なので横を長くする
+REID_SAMPLE_SIZE = (64, 40)
+REID_HUE_BINS = 16
+REID_SATURATION_BINS = 4
+REID_VALUE_BINS = 4
+# これより彩度の低い画素は、色相ではなく明度で数える
+REID_MIN_SATURATION = 40
+REID_SATURATION_BLEND = 20
+REID_ORIENTATION_BINS = 8
+REID_GRID = (4, 2)
+REID_BACKBONE_IMAGE_SIZE = 160
+REIDWHITENINGPATH = Path("yolo/models/reid/whitening.npz")
+# 白色化したベクトルがこれ以上似ていれば同じ自転車とみなす。benchmarks/reidCalibration.py で、
+# 別の自転車の組の約0.1%、同じ自転車(位置・明るさ・大きさを変えた切り抜き)の組の約95%が超える値
+REID_MIN_SIMILARITY = 0.6
+# 各部分の重み。外観の大まかな色を重視する
+REID_WEIGHTS = {"color": 1.0, "gradient": 0.7, "layout": 0.5, "backbone": 1.0}
+
+
+def normalizeRows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+
+def _getCellIndexes(width: int, height: int) -> np.ndarray:
+    """
+    縮小後の各画素が、REID_GRID のどのマスに入るか (高さ, 幅)
+    """
+    columnCount, rowCount = REID_GRID
+    columns = np.arange(width) * columnCount // width
+    rows = np.arange(height) * rowCount // height
+    return rows[:, None] * columnCount + columns[None, :]
+
+
+def _weightedBincount(
+    indexes: np.ndarray, weights: np.ndarray, binCount: int
+) -> np.ndarray:
+    """
+    (N, ...) の番号と重みから、切り抜きごとのヒストグラム (N, binCount) を作る
+    """
+    count = len(indexes)
+    offsets = (np.arange(count) * binCount).reshape(-1, *([1] * (indexes.ndim - 1)))
+    return np.bincount(
+        (indexes + offsets).ravel(),
+        weights=weights.ravel(),
+        minlength=count * binCount,
+    ).reshape(count, binCount)
+
+
+class AppearanceEncoder(object):
+    """
+    切り抜きを外観の特徴ベクトルにするクラス。ベクトルはL2正規化されたfloat32
+    """
+
+    sampleSize: tuple[int, int]
+    backboneModelPath: Optional[str]
+    cropCount: int
+    encodeSeconds: float
+    _centerWeights: np.ndarray
+    _cellIndexes: np.ndarray
+    _dimension: Optional[int]
+    _whiteningMean: Optional[np.ndarray]
+    _whiteningProjection: Optional[np.ndarray]
+
+    def __init__(
+        self,
+        sampleSize: tuple[int, int] = REID_SAMPLE_SIZE,
+        backboneModelPath: Optional[str | Path] = None,
+        whiteningPath: Optional[Path] = REIDWHITENINGPATH,
+    ) -> None:
+        """
+        whiteningPath をNoneにすると白色化しない(白色化の行列を求める時に使う)
+        """
+        self.sampleSize = sampleSize
+        self.backboneModelPath = (
+            str(backboneModelPath) if backboneModelPath is not None else None
+        )
+        self.cropCount = 0
+        self.encodeSeconds = 0.0
+        self._centerWeights = getCenterWeights(*sampleSize)
+        self._cellIndexes = _getCellIndexes(*sampleSize)
+        self._dimension = None
+        self._whiteningMean = None
+        self._whiteningProjection = None
+        if whiteningPath is not None:
+            with np.load(whiteningPath) as whitening:
+                self._whiteningMean = whitening["mean"].astype(np.float32)
+                self._whiteningProjection = whitening["projection"].astype(np.float32)
+        if self.backboneModelPath is not None:
+            logger.warning(
+                "the backbone embedding is not covered by the whitening. REID_MIN_SIMILARITY is calibrated without it"
+            )
+
+    @property
+    def dimension(self) -> int:
+        """
+        特徴ベクトルの次元数。YOLOの埋め込みを使う場合は、一度エンコードしてみて求める
+        """
+        if self._dimension is None:
+            width, height = self.sampleSize
+            self._dimension = self._encode(
+                [np.zeros((height, width, 3), dtype=np.uint8)], None
+            ).shape[1]
+        return self._dimension
+
+    def _getColorHistograms(self, pixels: np.ndarray, weights: np.ndarray) -> np.ndarray:
+        count, height, width, _ = pixels.shape
+        hsv = cv2.cvtColor(
+            pixels.reshape(count * height, width, 3), cv2.COLOR_BGR2HSV
+        ).reshape(pixels.shape).astype(np.int64)
+        hueBins = hsv[..., 0] * REID_HUE_BINS // 180
+        saturationBins = hsv[..., 1] * REID_SATURATION_BINS // 256
+        valueBins = hsv[..., 2] * REID_VALUE_BINS // 256
+        # 彩度が境目の前後の画素は、色相と明度の両方に振り分ける。境目での急な変化を避けるため
+        chromaticWeights = np.clip(
+            (hsv[..., 1] - REID_MIN_SATURATION) / (2 * REID_SATURATION_BLEND) + 0.5,
+            0.0,
+            1.0,
+        ).astype(np.float32)
+        chromaticCount = REID_HUE_BINS * REID_SATURATION_BINS
+        histograms = np.concatenate(
+            (
+                _weightedBincount(
+                    hueBins * REID_SATURATION_BINS + saturationBins,
+                    weights * chromaticWeights,
+                    chromaticCount,
+                ),
+                _weightedBincount(
+                    valueBins, weights * (1 - chromaticWeights), REID_VALUE_BINS
+                ),
+            ),
+            axis=1,
+        )
+        # ヒストグラムは平方根をとって比べる(Hellinger距離)
+        return normalizeRows(np.sqrt(histograms))
+
+    def _getGradientHistograms(
+        self, pixels: np.ndarray, weights: np.ndarray
+    ) -> np.ndarray:
+        count, height, width, _ = pixels.shape
+        gray = cv2.cvtColor(
+            pixels.reshape(count * height, width, 3), cv2.COLOR_BGR2GRAY
+        ).reshape(count, height, width).astype(np.float32)
+        # 切り抜きの境目をまたがないよう、画像ごとの軸で差分をとる
+        dy, dx = np.gradient(gray, axis=(1, 2))
+        magnitudes = np.hypot(dx, dy) * weights
+        # 向きは0〜πに折りたたむ
+        orientations = np.arctan2(dy, dx) % np.pi
+        orientationBins = np.minimum(
+            (orientations / np.pi * REID_ORIENTATION_BINS).astype(np.int64),
+            REID_ORIENTATION_BINS - 1,
+        )
+        indexes = self._cellIndexes[None] * REID_ORIENTATION_BINS + orientationBins
+        cellCount = REID_GRID[0] * REID_GRID[1]
+        histograms = _weightedBincount(
+            indexes, magnitudes, cellCount * REID_ORIENTATION_BINS
+        )
+        return normalizeRows(np.sqrt(histograms))
+
+    def _getColorLayouts(self, pixels: np.ndarray, weights: np.ndarray) -> np.ndarray:
+        count = len(pixels)
+        cellCount = REID_GRID[0] * REID_GRID[1]
+        labs = toLab(pixels) / np.array([100.0, 128.0, 128.0], dtype=np.float32)
+        indexes = np.broadcast_to(self._cellIndexes, weights.shape)
+        totals = _weightedBincount(indexes, weights, cellCount)
+        channels = [
+            _weightedBincount(indexes, weights * labs[..., channel], cellCount)
+            for channel in range(3)
+        ]
+        means = np.stack(channels, axis=2) / np.maximum(totals, 1e-6)[:, :, None]
+        return normalizeRows(means.reshape(count, cellCount * 3))
+
+    def _getBackboneEmbeddings(self, crops: Sequence[MatLike]) -> np.ndarray:
+        from BicycleCheck.detector import getYoloModel, getYoloModelLock
+
+        # 実行方式の設定によらず、埋め込みは ultralytics のモデルから取る。
+        # 検出と同じモデルを共有するので、推論中は他のスレッドに使わせない
+        model = getYoloModel(self.backboneModelPath)
+        with getYoloModelLock(self.backboneModelPath):
+            embeddings = model.embed(
+                [crop if crop.size > 0 else np.zeros((8, 8, 3), np.uint8) for crop in crops],
+                imgsz=REID_BACKBONE_IMAGE_SIZE,
+                verbose=False,
+            )
+        return normalizeRows(
+            np.stack([embedding.cpu().numpy() for embedding in embeddings]).astype(
+                np.float32
+            )
+        )
+
+    def _whiten(self, vectors: np.ndarray) -> np.ndarray:
+        """
+        平均を引いて白色化する。0ベクトル(空の切り抜き)は0のままにする
+        """
+        if self._whiteningMean is None or self._whiteningProjection is None:
+            return vectors
+        isEmpty = ~vectors.any(axis=1)
+        whitened = normalizeRows(
+            (vectors - self._whiteningMean) @ self._whiteningProjection
+        )
+        whitened[isEmpty] = 0.0
+        return whitened
+
+    def _encode(
+        self,
+        crops: Sequence[MatLike],
+        masks: Optional[Sequence[Optional[MatLike]]],
+    ) -> np.ndarray:
+        pixels, weights = stackCrops(crops, masks, self.sampleSize, self._centerWeights)
+        handcrafted = np.concatenate(
+            (
+                self._getColorHistograms(pixels, weights) * REID_WEIGHTS["color"],
+                self._getGradientHistograms(pixels, weights) * REID_WEIGHTS["gradient"],
+                self._getColorLayouts(pixels, weights) * REID_WEIGHTS["layout"],
+            ),
+            axis=1,
+        )
+        parts = [self._whiten(normalizeRows(handcrafted.astype(np.float32)))]
+        if self.backboneModelPath is not None:
+            parts.append(self._getBackboneEmbeddings(crops) * REID_WEIGHTS["backbone"])
+        return normalizeRows(np.concatenate(parts, axis=1).astype(np.float32))
+
+    def encodeBatch(
+        self,
+        crops: Sequence[MatLike],
+        masks: Optional[Sequence[Optional[MatLike]]] = None,
+    ) -> np.ndarray:
+        """
+        切り抜きのまとまりを一度にエンコードし、(N, dimension) の行列を返す。
+        空の切り抜きは0ベクトルになり、どれとも類似度0になる
+        """
+        if not crops:
+            return np.zeros((0, self.dimension), dtype=np.float32)
+        startTime = perf_counter()
+        vectors = self._encode(crops, masks)
+        elapsed = perf_counter() - startTime
+        self.cropCount += len(crops)
+        self.encodeSeconds += elapsed
+        logger.debug(f"encoded {len(crops)} crops in {elapsed * 1000:.1f}ms")
+        return vectors
+
+    def getCropsPerSecond(self) -> float:
+        if self.encodeSeconds == 0:
+            return 0.0
+        return self.cropCount / self.encodeSeconds
@@ -0,0 +1,176 @@
+"""
+検出前のフレーム間引き。
+
+一定フレームおきではなく、GPSから求めた走行距離が一定(targetMeters)進むごとにフレームを選ぶ。
+信号待ちなどで停車している間は距離が伸びないので、ほぼ同じフレームを検出にかけずに済む。
+GPSが無効な区間では、縮小したフレームの差分で画面が変わったかどうかを判断する。
+"""
+
+from __future__ import annotations
+from typing import Generator, NamedTuple
+
+from logging import getLogger
+
+import numpy as np
+import cv2
+from cv2.typing import MatLike
+
+from geo import getHaversineMeters
+from mp4extract import Mp4File, Mp4Track, Mp4UnrecognizableException
+
+logger = getLogger("BicycleCheck.sampler")
+
+SAMPLE_TARGET_METERS = 5.0
+SAMPLE_CHECK_STEP = 7
+SAMPLE_MIN_DIFFERENCE = 4.0
+DIFFERENCESIZE = (64, 36)
+
+
+def getCumulativeMeters(track: Mp4Track) -> np.ndarray:
+    """
+    各GPSレコード時点での累積走行距離。無効なレコードはnan。
+    無効な区間をまたぐ場合は、前後の有効なレコード間の直線距離を足す。
+    """
+    result = np.full(len(track), np.nan)
+    validIndexes = np.flatnonzero(track.valids)
+    if len(validIndexes) == 0:
+        return result
+    latitudes = track.latitudes[validIndexes]
+    longitudes = track.longitudes[validIndexes]
+    steps = getHaversineMeters(
+        latitudes[:-1], longitudes[:-1], latitudes[1:], longitudes[1:]
+    )
+    result[validIndexes] = np.concatenate(([0.0], np.cumsum(steps)))
+    return result
+
+
+class SamplingStats(NamedTuple):
+    candidateCount: int
+    decodedCount: int
+    emittedCount: int
+    skippedByDistanceCount: int
+    skippedByDifferenceCount: int
+
+    def getSkippedCount(self) -> int:
+        return self.candidateCount - self.emittedCount
+
+
+class FrameSampler(object):
+    """
+    走行距離とフレーム差分によってフレームを間引くクラス。
+    checkStep フレームおきの候補の中から、前回選んだフレームから targetMeters 以上進んだものを選ぶ。
+    """
+
+    targetMeters: float
+    checkStep: int
+    minDifference: float
+    candidateCount: int
+    decodedCount: int
+    emittedCount: int
+    skippedByDistanceCount: int
+    skippedByDifferenceCount: int
+
+    def __init__(
+        self,
+        targetMeters: float = SAMPLE_TARGET_METERS,
+        checkStep: int = SAMPLE_CHECK_STEP,
+        minDifference: float = SAMPLE_MIN_DIFFERENCE,
+    ) -> None:
+        self.targetMeters = targetMeters
+        self.checkStep = checkStep
+        self.minDifference = minDifference
+        self.candidateCount = 0
+        self.decodedCount = 0
+        self.emittedCount = 0
+        self.skippedByDistanceCount = 0
+        self.skippedByDifferenceCount = 0
+
+    def getStats(self) -> SamplingStats:
+        return SamplingStats(
+            self.candidateCount,
+            self.decodedCount,
+            self.emittedCount,
+            self.skippedByDistanceCount,
+            self.skippedByDifferenceCount,
+        )
+
+    def getFrameMeters(
+        self, track: Mp4Track, frameIndexes: np.ndarray, frameCount: int
+    ) -> np.ndarray:
+        """
+        各フレームの時点での累積走行距離。GPSレコードは動画全体に均等に並んでいるとみなす。
+        対応するレコードが無効ならnan
+        """
+        if len(track) == 0 or frameCount == 0:
+            return np.full(len(frameIndexes), np.nan)
+        cumulativeMeters = getCumulativeMeters(track)
+        recordIndexes = np.minimum(
+            frameIndexes * len(track) // frameCount, len(track) - 1
+        )
+        return cumulativeMeters[recordIndexes]
+
+    def _selectByDistance(self, frameMeters: np.ndarray) -> np.ndarray:
+        """
+        デコードする候補フレームを距離だけで選ぶ。GPSが無効な候補は差分で判断するので全て残す
+        """
+        isSelected = np.zeros(len(frameMeters), dtype=bool)
+        lastMeters = -np.inf
+        for i, meters in enumerate(frameMeters.tolist()):
+            if np.isnan(meters):
+                isSelected[i] = True
+            elif meters - lastMeters >= self.targetMeters:
+                isSelected[i] = True
+                lastMeters = meters
+        return isSelected
+
+    @staticmethod
+    def _getThumbnail(frame: MatLike) -> np.ndarray:
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        thumbnail = cv2.resize(gray, DIFFERENCESIZE, interpolation=cv2.INTER_AREA)
+        return thumbnail.astype(np.int16)
+
+    def iterateFrames(
+        self, mp4File: Mp4File
+    ) -> Generator[tuple[int, MatLike], None, None]:
+        """
+        間引いた (フレーム番号, フレーム) を順に返す。
+        :meth:`Mp4File.iterateFrames` の代わりに検出エンジンへ渡せる。
+        """
+        frameCount = mp4File.getVideoFrameCount()
+        candidates = np.arange(0, frameCount, self.checkStep)
+        try:
+            frameMeters = self.getFrameMeters(
+                mp4File.getTrack(), candidates, frameCount
+            )
+        except Mp4UnrecognizableException as e:
+            logger.warning(
+                f"no GPS for '{mp4File.path.name}'. using frame difference only: {e}"
+            )
+            frameMeters = np.full(len(candidates), np.nan)
+        isSelected = self._selectByDistance(frameMeters)
+        skippedByDistanceCount = int(np.count_nonzero(~isSelected))
+        skippedByDifferenceCount = 0
+        emittedCount = 0
+
+        lastThumbnail = None
+        selectedIndexes = candidates[isSelected].tolist()
+        for frameIndex, frame in mp4File.iterateFramesAt(selectedIndexes):
+            self.decodedCount += 1
+            thumbnail = self._getThumbnail(frame)
+            if (
+                lastThumbnail is not None
+                and np.abs(thumbnail - lastThumbnail).mean() < self.minDifference
+            ):
+                skippedByDifferenceCount += 1
+                continue
+            lastThumbnail = thumbnail
+            emittedCount += 1
+            yield frameIndex, frame
+
+        self.candidateCount += len(candidates)
+        self.emittedCount += emittedCount
+        self.skippedByDistanceCount += skippedByDistanceCount
+        self.skippedByDifferenceCount += skippedByDifferenceCount
+        logger.info(
+            f"sampled {emittedCount}/{len(candidates)} frames of '{mp4File.path.name}'. skipped {skippedByDistanceCount} by distance, {skippedByDifferenceCount} by difference"
+        )
@@ -0,0 +1,276 @@
+"""
+遠くの小さな自転車を拾うための、関心領域(ROI)のタイル分割推論。
+
+フレーム全体を大きな imgsz で推論する代わりに、歩道側の帯(関心領域)だけを元の解像度のまま
+tileSize 四方のタイルに分け、少しずつ重ねて切り出す。タイル(と、近くの大きな自転車用に縮小した
+フレーム全体)は一つのバッチにまとめて推論し、検出をフレームの座標に戻してからタイル間でNMSをかける。
+
+関心領域はカメラごとに configs/universal.json の tiling.regions で設定する。カメラは動画のファイル名の
+末尾(F: 前方、R: 後方)で決まる。左側通行なので、前方カメラでは左側、後方カメラでは右側が歩道になる。
+"""
+
+from __future__ import annotations
+from functools import lru_cache
+from json import load
+from math import ceil
+from pathlib import Path
+from typing import Any, NamedTuple, Sequence
+
+from logging import getLogger
+
+import numpy as np
+from cv2.typing import MatLike
+
+from BicycleCheck.attributes import getOverlaps
+from BicycleCheck.detector import Detection, DETECTIMAGESIZE
+
+logger = getLogger("BicycleCheck.tiling")
+
+TILE_OVERLAP = 0.2
+TILE_IOU = 0.5
+# タイルの縁で切れた枠は、面積のこの割合以上が別の枠に入っていれば、その枠の一部とみなして捨てる
+TILE_MIN_CONTAINMENT = 0.6
+# 枠がタイルの縁からこの画素数以内にあれば、縁で切れたとみなす
+TILE_EDGE_MARGIN = 2.0
+# (x1, y1, x2, y2) のフレームに対する割合。カメラが分からない場合はフレーム全体
+FULLREGION = (0.0, 0.0, 1.0, 1.0)
+TILE_REGIONS: dict[str, list[tuple[float, float, float, float]]] = {
+    "F": [(0.0, 0.35, 0.6, 0.9)],
+    "R": [(0.4, 0.35, 1.0, 0.9)],
+}
+
+
+@lru_cache(maxsize=1)
+def getTilingConfig() -> dict[str, Any]:
+    """
+    タイル分割の設定。configs/universal.json の tiling にあればそれを使う
+    """
+    tilingConfig: dict[str, Any] = {
+        "tileSize": DETECTIMAGESIZE,
+        "overlap": TILE_OVERLAP,
+        "includeFullFrame": True,
+        "regions": TILE_REGIONS,
+    }
+    filepath = Path("configs/universal.json")
+    if filepath.exists():
+        with open(filepath, "r") as file:
+            tilingConfig.update(load(file).get("tiling", {}))
+    return tilingConfig
+
+
+class Tile(NamedTuple):
+    """
+    フレームから切り出す範囲(ピクセル)
+    """
+
+    x: int
+    y: int
+    width: int
+    height: int
+
+    def crop(self, frame: MatLike) -> MatLike:
+        return frame[self.y : self.y + self.height, self.x : self.x + self.width]
+
+    def isCut(
+        self, box: tuple[float, float, float, float], frameWidth: int, frameHeight: int
+    ) -> bool:
+        """
+        タイル上の枠が、フレームの縁ではないタイルの縁に接しているか
+        """
+        x1, y1, x2, y2 = box
+        return (
+            (self.x > 0 and x1 <= TILE_EDGE_MARGIN)
+            or (self.y > 0 and y1 <= TILE_EDGE_MARGIN)
+            or (self.x + self.width < frameWidth and x2 >= self.width - TILE_EDGE_MARGIN)
+            or (self.y + self.height < frameHeight and y2 >= self.height - TILE_EDGE_MARGIN)
+        )
+
+
+def _getStarts(start: int, end: int, tileLength: int, overlap: float) -> list[int]:
+    """
+    [start, end) を、重なりが overlap 以上になるように tileLength ずつ覆う開始位置
+    """
+    length = end - start
+    if length <= tileLength:
+        return [start + (length - tileLength) // 2]
+    count = ceil((length - tileLength) / (tileLength * (1 - overlap))) + 1
+    return np.linspace(start, end - tileLength, count).round().astype(int).tolist()
+
+
+def getTiles(
+    frameWidth: int,
+    frameHeight: int,
+    regions: Sequence[Sequence[float]],
+    tileSize: int,
+    overlap: float,
+) -> list[Tile]:
+    """
+    関心領域を覆うタイル。タイルは tileSize 四方で、フレームからはみ出す場合はフレームの中に寄せる
+    """
+    tileWidth = min(tileSize, frameWidth)
+    tileHeight = min(tileSize, frameHeight)
+    tiles: list[Tile] = []
+    for x1, y1, x2, y2 in regions:
+        xs = _getStarts(
+            round(x1 * frameWidth), round(x2 * frameWidth), tileWidth, overlap
+        )
+        ys = _getStarts(
+            round(y1 * frameHeight), round(y2 * frameHeight), tileHeight, overlap
+        )
+        for y in ys:
+            for x in xs:
+                tile = Tile(
+                    min(max(x, 0), frameWidth - tileWidth),
+                    min(max(y, 0), frameHeight - tileHeight),
+                    tileWidth,
+                    tileHeight,
+                )
+                if tile not in tiles:
+                    tiles.append(tile)
+    return tiles
+
+
+def mergeDetections(
+    detections: Sequence[Detection], cuts: Sequence[bool], iouThreshold: float = TILE_IOU
+) -> list[Detection]:
+    """
+    1フレーム分の、タイルごとの検出をまとめる。クラスごとに信頼度の高い順にNMSをかけ、
+    タイルの縁で切れた枠(cuts)のうち、大部分が別の枠に入っているものも捨てる
+    """
+    if not detections:
+        return []
+    order = sorted(range(len(detections)), key=lambda i: -detections[i].confidence)
+    boxes = np.array([detections[i].box for i in order], dtype=np.float32)
+    classIds = np.array([detections[i].classId for i in order])
+    isCuts = np.array([cuts[i] for i in order])
+    ious, containments = getOverlaps(boxes, boxes)
+    isSameClass = classIds[:, None] == classIds[None, :]
+    isKept = np.ones(len(order), dtype=bool)
+    for i in range(len(order)):
+        if not isKept[i]:
+            continue
+        # i より信頼度の低い、同じクラスで重なりの大きいものを捨てる
+        isSuppressed = isSameClass[i] & (ious[i] >= iouThreshold)
+        isSuppressed[: i + 1] = False
+        isKept &= ~isSuppressed
+    isPart = (
+        isCuts[:, None]
+        & isSameClass
+        & (containments >= TILE_MIN_CONTAINMENT)
+        & isKept[None, :]
+        & ~np.eye(len(order), dtype=bool)
+    ).any(axis=1)
+    isKept &= ~isPart
+    return [detections[order[i]] for i in np.flatnonzero(isKept).tolist()]
+
+
+class FrameTiler(object):
+    """
+    フレームのまとまりをタイルに分け、タイルごとの検出をフレームごとにまとめ直すクラス。
+    推論自体は行わないので、検出エンジンが別のプロセスにあっても使える。
+    """
+
+    tileSize: int
+    overlap: float
+    regions: dict[str, list[tuple[float, float, float, float]]]
+    isFullFrameIncluded: bool
+    iouThreshold: float
+    _tiles: dict[tuple[int, int, str], list[Tile]]
+
+    def __init__(
+        self,
+        tileSize: int = DETECTIMAGESIZE,
+        overlap: float = TILE_OVERLAP,
+        regions: dict[str, list[tuple[float, float, float, float]]] = TILE_REGIONS,
+        isFullFrameIncluded: bool = True,
+        iouThreshold: float = TILE_IOU,
+    ) -> None:
+        """
+        tileSize は検出エンジンの imageSize と同じにすると、タイルが縮小されずに推論される
+        """
+        self.tileSize = tileSize
+        self.overlap = overlap
+        self.regions = {
+            camera: [tuple(region) for region in cameraRegions]
+            for camera, cameraRegions in regions.items()
+        }
+        self.isFullFrameIncluded = isFullFrameIncluded
+        self.iouThreshold = iouThreshold
+        self._tiles = {}
+
+    @classmethod
+    def fromConfig(cls) -> FrameTiler:
+        tilingConfig = getTilingConfig()
+        return cls(
+            int(tilingConfig["tileSize"]),
+            float(tilingConfig["overlap"]),
+            tilingConfig["regions"],
+            bool(tilingConfig["includeFullFrame"]),
+        )
+
+    def getTiles(self, frameWidth: int, frameHeight: int, camera: str) -> list[Tile]:
+        """
+        カメラ(F / R)ごとのタイル。フレーム全体を含める場合は先頭に入る
+        """
+        key = (frameWidth, frameHeight, camera)
+        tiles = self._tiles.get(key)
+        if tiles is None:
+            tiles = getTiles(
+                frameWidth,
+                frameHeight,
+                self.regions.get(camera, [FULLREGION]),
+                self.tileSize,
+                self.overlap,
+            )
+            if self.isFullFrameIncluded:
+                fullTile = Tile(0, 0, frameWidth, frameHeight)
+                tiles = [fullTile] + [tile for tile in tiles if tile != fullTile]
+            self._tiles[key] = tiles
+            logger.info(
+                f"{len(tiles)} tiles for {frameWidth}x{frameHeight} frames of camera {camera}"
+            )
+        return tiles
+
+    def split(
+        self, frames: Sequence[MatLike], camera: str
+    ) -> tuple[list[MatLike], list[tuple[int, Tile]]]:
+        """
+        フレームのまとまりを、一つのバッチで推論する切り抜きと、それぞれの (フレームの位置, タイル) に分ける
+        """
+        crops: list[MatLike] = []
+        tiles: list[tuple[int, Tile]] = []
+        for position, frame in enumerate(frames):
+            height, width = frame.shape[:2]
+            for tile in self.getTiles(width, height, camera):
+                crops.append(tile.crop(frame))
+                tiles.append((position, tile))
+        return crops, tiles
+
+    def merge(
+        self,
+        frameIndexes: Sequence[int],
+        frames: Sequence[MatLike],
+        tiles: Sequence[tuple[int, Tile]],
+        detections: Sequence[Detection],
+    ) -> list[Detection]:
+        """
+        :meth:`split` の切り抜きの検出(frameIndex は切り抜きの番号)を、フレームの座標に戻してまとめる
+        """
+        frameDetections: list[list[Detection]] = [[] for _ in frames]
+        frameCuts: list[list[bool]] = [[] for _ in frames]
+        for detection in detections:
+            position, tile = tiles[detection.frameIndex]
+            height, width = frames[position].shape[:2]
+            x1, y1, x2, y2 = detection.box
+            frameDetections[position].append(
+                detection._replace(
+                    frameIndex=frameIndexes[position],
+                    box=(x1 + tile.x, y1 + tile.y, x2 + tile.x, y2 + tile.y),
+                )
+            )
+            frameCuts[position].append(tile.isCut(detection.box, width, height))
+        return [
+            detection
+            for detections, cuts in zip(frameDetections, frameCuts)
+            for detection in mergeDetections(detections, cuts, self.iouThreshold)
+        ]
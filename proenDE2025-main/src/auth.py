@@ -1,9 +1,22 @@
+"""
+認証。ログイン時にJWTを発行し、以降のリクエストではトークンだけで利用者を確認する。
+
+トークンには利用者の情報(user_id, name, district_id)を入れて署名するので、
+通常の確認は署名の検証だけで済み、DBには問い合わせない。
+失効させたトークンは、DBの token_revoke テーブルを定期的に読み込んだ :class:`RevocationTable` で弾く。
+利用者がDB上に今も存在するかまで確かめたい重要な操作では、:func:`getVerifiedUserAsync` を使う。
+"""
+
 from __future__ import annotations
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Any, Iterable, NamedTuple, Optional
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
+from time import monotonic
+
+from logging import getLogger
 
 from fastapi import Depends, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
 from pwdlib import PasswordHash
 from jwt.exceptions import InvalidTokenError
@@ -12,36 +25,211 @@ import jwt
 from setup import jsonLoad
 
 if TYPE_CHECKING:
-    from schemas import User, UserSql
+    from schemas import TokenRevoke, User, UserSql
+
+logger = getLogger("BicycleCheck.auth")
 
 SECRETKEY: str = jsonLoad(Path("configs/secrets.json"))["secretKey"]  # type:ignore
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# 失効したトークンの一覧をDBから読み直す間隔(秒)。失効が反映されるまで最大これだけかかる
+TOKEN_REVOKE_REFRESH_SECONDS = 30.0
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/users/login")
 password_hash = PasswordHash.recommended()
 
 
+class TokenClaims(NamedTuple):
+    """
+    トークンに入れる利用者の情報。user_id がNoneなのは、情報を入れる前の形式のトークン
+    """
+
+    email: str
+    user_id: Optional[int]
+    name: Optional[str]
+    district_id: Optional[int]
+    issuedTime: float
+
+    @classmethod
+    def fromPayload(cls, payload: dict[str, Any]) -> TokenClaims:
+        return cls(
+            payload["sub"],
+            payload.get("uid"),
+            payload.get("name"),
+            payload.get("did"),
+            float(payload["iat"]),
+        )
+
+    def asUser(self) -> "User":
+        from schemas import User
+
+        # 署名済みの値なので、検証はせずにそのまま使う
+        return User.model_construct(
+            user_id=self.user_id,
+            name=self.name,
+            district_id=self.district_id,
+            email=self.email,
+        )
+
+
+class RevocationTable(object):
+    """
+    利用者ごとの失効日時の表。これ以前に発行されたその利用者のトークンは無効になる。
+    DBの token_revoke テーブルの写しで、refreshSeconds 秒ごとに読み直す
+    """
+
+    refreshSeconds: float
+    _revokedTimes: dict[int, float]
+    _refreshedTime: float
+    _isRefreshing: bool
+
+    def __init__(self, refreshSeconds: float = TOKEN_REVOKE_REFRESH_SECONDS) -> None:
+        self.refreshSeconds = refreshSeconds
+        self._revokedTimes = {}
+        self._refreshedTime = float("-inf")
+        self._isRefreshing = False
+
+    def isRevoked(self, claims: TokenClaims) -> bool:
+        if claims.user_id is None:
+            return False
+        revokedTime = self._revokedTimes.get(claims.user_id)
+        # iat は秒単位なので、失効と同じ秒に発行されたものも無効とする
+        return revokedTime is not None and claims.issuedTime <= revokedTime
+
+    def isStale(self) -> bool:
+        return not self._isRefreshing and (
+            monotonic() - self._refreshedTime >= self.refreshSeconds
+        )
+
+    def _update(self, revokes: Iterable["TokenRevoke"]) -> None:
+        self._revokedTimes = {
+            revoke.user_id: revoke.revoked_time.timestamp() for revoke in revokes
+        }
+        logger.debug(f"loaded {len(self._revokedTimes)} token revocations")
+
+    def refresh(self) -> None:
+        from schemas import TokenRevoke
+
+        self._isRefreshing = True
+        try:
+            self._update(TokenRevoke.getAll())
+        except HTTPException:
+            # 読めなかった場合は前回の表を使い続け、次の間隔で読み直す
+            logger.warning("couldn't load token revocations. using the previous table")
+        finally:
+            self._refreshedTime = monotonic()
+            self._isRefreshing = False
+
+    async def refreshAsync(self) -> None:
+        """
+        :meth:`refresh` の非同期版。読み込み中に来たリクエストは、前回の表で確認する
+        """
+        from schemas import TokenRevoke
+
+        self._isRefreshing = True
+        try:
+            self._update(await TokenRevoke.getAllAsync())
+        except HTTPException:
+            logger.warning("couldn't load token revocations. using the previous table")
+        finally:
+            self._refreshedTime = monotonic()
+            self._isRefreshing = False
+
+    def revoke(self, user_id: int) -> None:
+        """
+        利用者のこれまでのトークンを全て失効させる。このプロセスには即座に反映される
+        """
+        from schemas import TokenRevoke
+
+        # DBの revoked_time は DATETIME(0) で、小数秒は丸められる。読み直した時と同じ値になるよう、
+        # 秒未満を切り捨ててから保存する
+        revoke = TokenRevoke(
+            user_id=user_id, revoked_time=datetime.now().replace(microsecond=0)
+        )
+        revoke.create()
+        self._revokedTimes[user_id] = revoke.revoked_time.timestamp()
+
+
+revocations = RevocationTable()
+
+
 def AuthUser(email: str, password: str) -> bool:
     from schemas import UserSql
 
-    user = UserSql.getOne(email)
+    # キャッシュのパスワードは古いことがあるので、照合には必ずDBを読む
+    user = UserSql.getOneUncached(email)
     if user is None:
         return False
     # return True only when the hashed password matches
     return verifyPassword(password, user.hashedPassword)
 
 
+async def authUserAsync(email: str, password: str) -> bool:
+    """
+    :func:`AuthUser` の非同期版。パスワードの照合は重いのでスレッドプールで行う
+    """
+    return await getAuthenticatedUserAsync(email, password) is not None
+
+
+async def getAuthenticatedUserAsync(email: str, password: str) -> "UserSql | None":
+    """
+    メールアドレスとパスワードが合っていれば、その利用者を返す
+    """
+    from schemas import UserSql
+
+    # キャッシュのパスワードは古いことがあるので、照合には必ずDBを読む
+    user = await UserSql.getOneUncachedAsync(email)
+    if user is None:
+        return None
+    if not await run_in_threadpool(verifyPassword, password, user.hashedPassword):
+        return None
+    return user
+
+
 def getCurrentUser(token: str = Depends(oauth2_scheme)) -> "User | None":
+    if revocations.isStale():
+        revocations.refresh()
     user = decodeToken(token)
-    # return user
     if user is None:
         # 401 Unauthorized when token is invalid
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid or expired token",
         )
-    return user.asUser()
+    return user
+
+
+async def getCurrentUserAsync(token: str = Depends(oauth2_scheme)) -> "User | None":
+    """
+    :func:`getCurrentUser` の非同期版
+    """
+    if revocations.isStale():
+        await revocations.refreshAsync()
+    user = await decodeTokenAsync(token)
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid or expired token",
+        )
+    return user
+
+
+async def getVerifiedUserAsync(token: str = Depends(oauth2_scheme)) -> "User | None":
+    """
+    :func:`getCurrentUserAsync` に加えて、利用者がDB上に今も存在することを確かめる。
+    キャッシュを通さずにDBに問い合わせるので、重要な操作のみで使う
+    """
+    from schemas import UserSql
+
+    user = await getCurrentUserAsync(token)
+    assert user is not None
+    userSql = await UserSql.getOneUncachedAsync(user.email)
+    if userSql is None or userSql.user_id != user.user_id:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid or expired token",
+        )
+    return userSql.asUser()
 
 
 def verifyPassword(rawPassword: str, hashedPassword: str) -> bool:
@@ -52,25 +240,64 @@ def hashPassword(rawPassword: str) -> str:
     return password_hash.hash(rawPassword)
 
 
-def generateToken(email: str) -> str:
-    """Generate a JWT token with subject=email and expiration."""
-    to_encode = {"sub": email, "iat": int(datetime.now(tz=timezone.utc).timestamp())}
-    expire = datetime.now(tz=timezone.utc) + timedelta(
-        minutes=ACCESS_TOKEN_EXPIRE_MINUTES
-    )
-    to_encode.update({"exp": expire})
+def generateToken(user: "User") -> str:
+    """Generate a JWT token with subject=email, user claims and expiration."""
+    issuedTime = datetime.now(tz=timezone.utc)
+    to_encode = {
+        "sub": user.email,
+        "uid": user.user_id,
+        "name": user.name,
+        "did": user.district_id,
+        "iat": int(issuedTime.timestamp()),
+        "exp": issuedTime + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES),
+    }
     return jwt.encode(to_encode, SECRETKEY, algorithm=ALGORITHM)
 
 
-def decodeToken(token: str) -> "UserSql | None":
-    from schemas import UserSql
-
+def decodeClaims(token: str) -> TokenClaims | None:
+    """
+    トークンの署名と期限を確かめ、中の情報を取り出す。DBには問い合わせない
+    """
     try:
-        payload = jwt.decode(token, SECRETKEY, algorithms=[ALGORITHM])
-        email = payload.get("sub")
+        payload = jwt.decode(
+            token,
+            SECRETKEY,
+            algorithms=[ALGORITHM],
+            options={"require": ["sub", "iat", "exp"]},
+        )
     except jwt.ExpiredSignatureError:
         return None
     except (InvalidTokenError, jwt.DecodeError):
         return None
-    user = UserSql.getOne(email)
-    return user
+    claims = TokenClaims.fromPayload(payload)
+    if revocations.isRevoked(claims):
+        return None
+    return claims
+
+
+def decodeToken(token: str) -> "User | None":
+    from schemas import UserSql
+
+    claims = decodeClaims(token)
+    if claims is None:
+        return None
+    if claims.user_id is not None:
+        return claims.asUser()
+    # 利用者の情報を入れる前に発行されたトークンは、DBから引く
+    user = UserSql.getOne(claims.email)
+    return user.asUser() if user is not None else None
+
+
+async def decodeTokenAsync(token: str) -> "User | None":
+    """
+    :func:`decodeToken` の非同期版
+    """
+    from schemas import UserSql
+
+    claims = decodeClaims(token)
+    if claims is None:
+        return None
+    if claims.user_id is not None:
+        return claims.asUser()
+    user = await UserSql.getOneAsync(claims.email)
+    return user.asUser() if user is not None else None
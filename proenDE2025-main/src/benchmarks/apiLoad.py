@@ -0,0 +1,72 @@
+"""
+起動中のAPIサーバーに複数のクライアントから同時に問い合わせ、応答時間の分布を求める。
+DBを同期で読むハンドラと非同期で読むハンドラの比較などに使う。
+
+サーバーを起動した状態で、リポジトリのルートで実行する:
+python src/benchmarks/apiLoad.py --url "http://localhost:8080/api/bicycle?id=1" --clients 64 --requests 50
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from time import perf_counter
+
+from logging import getLogger
+from logging.config import dictConfig
+
+from yaml import FullLoader, load as loadYaml
+import numpy as np
+import requests
+
+logger = getLogger("BicycleCheck.benchmark")
+
+
+def runClient(url: str, requestCount: int) -> tuple[list[float], int]:
+    """
+    一つのクライアントとして、同じURLに順に問い合わせる。応答時間と失敗数を返す
+    """
+    latencies: list[float] = []
+    errorCount = 0
+    with requests.Session() as session:
+        for _ in range(requestCount):
+            startTime = perf_counter()
+            try:
+                response = session.get(url, timeout=30)
+                if response.status_code >= 500:
+                    errorCount += 1
+            except requests.RequestException:
+                errorCount += 1
+            latencies.append(perf_counter() - startTime)
+    return latencies, errorCount
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:8080/api/bicycle?id=1")
+    parser.add_argument("--clients", type=int, default=64, dest="clientCount")
+    parser.add_argument("--requests", type=int, default=50, dest="requestCount")
+    args = parser.parse_args()
+
+    startTime = perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clientCount) as executor:
+        results = list(
+            executor.map(
+                lambda _: runClient(args.url, args.requestCount),
+                range(args.clientCount),
+            )
+        )
+    elapsed = perf_counter() - startTime
+    latencies = np.array([latency for result in results for latency in result[0]])
+    errorCount = sum(result[1] for result in results)
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+    logger.info(
+        f"{len(latencies)} requests from {args.clientCount} clients in {elapsed:.1f}s: "
+        f"{len(latencies) / elapsed:.0f} requests/s, p50 {p50:.1f}ms, p95 {p95:.1f}ms, p99 {p99:.1f}ms, "
+        f"max {latencies.max() * 1000:.1f}ms, errors {errorCount}"
+    )
+
+
+if __name__ == "__main__":
+    with open(Path("configs/log_conf.yaml"), "r", encoding="UTF-8") as configFile:
+        dictConfig(loadYaml(configFile.read(), FullLoader))
+    main()
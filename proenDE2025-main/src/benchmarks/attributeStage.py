@@ -0,0 +1,96 @@
+"""
+付属品(かご・チャイルドシート)の判定にかかる、1フレームあたりの推論時間を測る。
+自転車の検出だけの場合と、切り抜きに付属品のモデルをかける場合(キャッシュなし・あり)を比較する。
+検出モデルが付属品のクラスを持つ場合の、枠の割り当てだけにかかる時間も測る。
+入力は experiments/content/public_road の画像を、メモリ上のフレームとして繰り返し使う。
+
+付属品のモデル(yolo/models/basket_PoC_1/weights/best.pt)が必要。
+リポジトリのルートで実行する: python src/benchmarks/attributeStage.py
+"""
+
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+from time import perf_counter
+
+from logging import getLogger
+from logging.config import dictConfig
+
+from yaml import FullLoader, load as loadYaml
+import cv2
+
+sys.path.append(str(Path(__file__).parent.parent))
+from BicycleCheck.attributes import (  # noqa: E402
+    AttributeDetector,
+    associateAttributes,
+    ATTRIBUTECLASSNAMES,
+    ATTRIBUTEMODELPATH,
+)
+from BicycleCheck.detector import BicycleDetector, DETECTMODELPATH  # noqa: E402
+
+logger = getLogger("BicycleCheck.benchmark")
+
+IMAGEDIR = Path("src/experiments/content/public_road")
+FRAMECOUNT = 64
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("--model", type=Path, default=DETECTMODELPATH)
+    parser.add_argument("--attribute-model", type=Path, default=ATTRIBUTEMODELPATH, dest="attributeModel")
+    args = parser.parse_args()
+    images = [cv2.imread(str(path)) for path in sorted(IMAGEDIR.glob("*.jpeg"))]
+    frames = [(i, images[i % len(images)]) for i in range(FRAMECOUNT)]
+    detector = BicycleDetector(args.model)
+    attributeDetector = AttributeDetector(args.attributeModel)
+    # 初回推論は初期化を含むので計測から外す
+    detector.detectBatch([0], [images[0]])
+    attributeDetector.detectCrops([images[0][:64, :64]])
+
+    startTime = perf_counter()
+    detections = list(detector.detectFrames(frames))
+    detectSeconds = perf_counter() - startTime
+    bicycles = [
+        detection for detection in detections if detection.className not in ATTRIBUTECLASSNAMES
+    ]
+    crops = [
+        frames[detection.frameIndex][1][
+            int(detection.box[1]) : int(detection.box[3]),
+            int(detection.box[0]) : int(detection.box[2]),
+        ]
+        for detection in bicycles
+    ]
+    logger.info(
+        f"detect only: {detectSeconds / FRAMECOUNT * 1000:.1f}ms/frame, {len(bicycles)} bicycles"
+    )
+
+    # 同じ画像を繰り返し使っているので、2周目以降はキャッシュに当たる。1周目だけを「キャッシュなし」とする
+    uniqueCrops = [crop for crop, detection in zip(crops, bicycles) if detection.frameIndex < len(images)]
+    startTime = perf_counter()
+    attributes = attributeDetector.detectCrops(uniqueCrops)
+    coldSeconds = (perf_counter() - startTime) / max(len(uniqueCrops), 1) * len(crops)
+    startTime = perf_counter()
+    attributeDetector.detectCrops(crops)
+    warmSeconds = perf_counter() - startTime
+    logger.info(
+        f"with attribute model: +{coldSeconds / FRAMECOUNT * 1000:.1f}ms/frame without cache, "
+        f"+{warmSeconds / FRAMECOUNT * 1000:.1f}ms/frame with cache. "
+        f"{sum(attribute.hasBasket for attribute in attributes)} baskets, "
+        f"{sum(attribute.hasChildseat for attribute in attributes)} child seats in {len(uniqueCrops)} crops"
+    )
+
+    startTime = perf_counter()
+    for frameIndex, _ in frames:
+        frameDetections = [detection for detection in detections if detection.frameIndex == frameIndex]
+        associateAttributes(
+            [detection for detection in frameDetections if detection.className not in ATTRIBUTECLASSNAMES],
+            [detection for detection in frameDetections if detection.className in ATTRIBUTECLASSNAMES],
+        )
+    associateSeconds = perf_counter() - startTime
+    logger.info(f"in-frame association: +{associateSeconds / FRAMECOUNT * 1000:.3f}ms/frame")
+
+
+if __name__ == "__main__":
+    with open(Path("configs/log_conf.yaml"), "r", encoding="UTF-8") as configFile:
+        dictConfig(loadYaml(configFile.read(), FullLoader))
+    main()
@@ -0,0 +1,128 @@
+"""
+認証付きリクエスト1件あたりの、利用者確認の処理速度(件/秒)を測る。
+トークンの主体(メールアドレス)からDBで利用者を引く従来の方法と、
+トークンに入れた利用者の情報を署名の検証だけで使う方法を比較する。
+
+db と verified はDBに問い合わせるので、configs/secrets.json に書いたDBと、そこに登録済みの利用者が必要。
+リポジトリのルートで実行する:
+python src/benchmarks/authToken.py --email test@example.com --modes db cached claims verified --clients 32
+"""
+
+import asyncio
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+from time import perf_counter
+from typing import Awaitable, Callable
+
+from logging import getLogger
+from logging.config import dictConfig
+
+from yaml import FullLoader, load as loadYaml
+import jwt
+
+sys.path.append(str(Path(__file__).parent.parent))
+from auth import (  # noqa: E402
+    ALGORITHM,
+    SECRETKEY,
+    decodeTokenAsync,
+    generateToken,
+    getVerifiedUserAsync,
+)
+from schemas import User, UserSql  # noqa: E402
+
+logger = getLogger("BicycleCheck.benchmark")
+
+AUTHMODES = ("db", "cached", "claims", "verified")
+
+
+async def authenticateFromDB(token: str) -> User:
+    """
+    従来の方法。主体をDBで引き、User に詰め直す。schemaCache を通さない
+    """
+    email = jwt.decode(token, SECRETKEY, algorithms=[ALGORITHM])["sub"]
+    user = await UserSql.getOneAsync.__wrapped__(UserSql, email)
+    return user.asUser()
+
+
+async def authenticateCached(token: str) -> User:
+    """
+    従来の方法で、getOneAsync のキャッシュを使う場合
+    """
+    email = jwt.decode(token, SECRETKEY, algorithms=[ALGORITHM])["sub"]
+    user = await UserSql.getOneAsync(email)
+    return user.asUser()
+
+
+async def authenticateClaims(token: str) -> User:
+    user = await decodeTokenAsync(token)
+    assert user is not None
+    return user
+
+
+async def authenticateVerified(token: str) -> User:
+    user = await getVerifiedUserAsync(token)
+    assert user is not None
+    return user
+
+
+async def measure(
+    authenticate: Callable[[str], Awaitable[User]],
+    token: str,
+    clientCount: int,
+    requestCount: int,
+) -> float:
+    """
+    clientCount 個の並行したクライアントが、それぞれ requestCount 回確認する。件/秒を返す
+    """
+
+    async def runClient() -> None:
+        for _ in range(requestCount):
+            await authenticate(token)
+
+    startTime = perf_counter()
+    await asyncio.gather(*(runClient() for _ in range(clientCount)))
+    return clientCount * requestCount / (perf_counter() - startTime)
+
+
+async def run(args) -> None:
+    if args.email is not None:
+        user = await UserSql.getOneAsync(args.email)
+        if user is None:
+            raise ValueError(f"user '{args.email}' not found")
+    else:
+        if set(args.modes) - {"claims"}:
+            raise ValueError("--email is required for modes other than claims")
+        user = User(user_id=1, name="bench", district_id=1, email="bench@example.com")
+    token = generateToken(user)
+    authenticates = {
+        "db": authenticateFromDB,
+        "cached": authenticateCached,
+        "claims": authenticateClaims,
+        "verified": authenticateVerified,
+    }
+    for mode in args.modes:
+        # 接続やキャッシュを温めておく
+        await measure(authenticates[mode], token, 1, 10)
+        requestsPerSecond = await measure(
+            authenticates[mode], token, args.clientCount, args.requestCount
+        )
+        logger.info(
+            f"{mode}: {requestsPerSecond:.0f} requests/s ({args.clientCount} clients x {args.requestCount})"
+        )
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("--email", default=None)
+    parser.add_argument("--modes", choices=AUTHMODES, nargs="+", default=["claims"])
+    parser.add_argument("--clients", type=int, default=32, dest="clientCount")
+    parser.add_argument("--requests", type=int, default=1000, dest="requestCount")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    with open(Path("configs/log_conf.yaml"), "r", encoding="UTF-8") as configFile:
+        dictConfig(loadYaml(configFile.read(), FullLoader))
+    main()
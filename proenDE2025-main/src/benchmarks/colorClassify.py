@@ -0,0 +1,101 @@
+"""
+切り抜き画像の色分類の処理速度(枚/秒)を、
+experiments/colorKmean.ipynb と同じ KMeans(n_clusters=5, n_init=10) を1枚ずつ全画素にかける方法と、
+:class:`BicycleCheck.color.ColorClassifier` でまとめて分類する方法で比較する。
+
+切り抜きは --crops のディレクトリの jpg を使う(pipeline.py の出力先が既定)。無ければ乱数の画像を使う。
+KMeans側には scikit-learn が別途必要。
+リポジトリのルートで実行する: python src/benchmarks/colorClassify.py --batch-size 64
+"""
+
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+from time import perf_counter
+
+from logging import getLogger
+from logging.config import dictConfig
+
+from yaml import FullLoader, load as loadYaml
+import numpy as np
+import cv2
+from cv2.typing import MatLike
+
+try:
+    from sklearn.cluster import KMeans
+except ImportError:
+    KMeans = None
+
+sys.path.append(str(Path(__file__).parent.parent))
+from BicycleCheck.color import ColorClassifier, COLORNAMES, COLORPALETTE, toLab  # noqa: E402
+
+logger = getLogger("BicycleCheck.benchmark")
+
+CROPDIR = Path("tmp/images/bicycle")
+SYNTHETICSIZE = (160, 240)
+
+
+def loadCrops(cropDir: Path, limit: int) -> list[MatLike]:
+    crops = [cv2.imread(str(path)) for path in sorted(cropDir.glob("*.jpg"))[:limit]]
+    crops = [crop for crop in crops if crop is not None and crop.size > 0]
+    if crops:
+        return crops
+    logger.warning(f"no crops in {cropDir}. using {limit} random images")
+    random = np.random.default_rng(0)
+    return [
+        random.integers(0, 256, (*SYNTHETICSIZE, 3), dtype=np.uint8)
+        for _ in range(limit)
+    ]
+
+
+def classifyKMeans(crop: MatLike) -> str:
+    """
+    ノートブックの方法。最も大きいクラスタの中心を、パレットの最も近い色の名前にする
+    """
+    cluster = KMeans(n_clusters=5, n_init=10).fit(crop.reshape(-1, 3))
+    largest = np.bincount(cluster.labels_).argmax()
+    center = np.clip(cluster.cluster_centers_[largest], 0, 255).astype(np.uint8)
+    paletteLab = toLab(np.array([bgr for _, bgr in COLORPALETTE], dtype=np.uint8))
+    distances = ((paletteLab - toLab(center[None, :])) ** 2).sum(axis=1)
+    return COLORPALETTE[int(distances.argmin())][0]
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("--crops", type=Path, default=CROPDIR, dest="cropDir")
+    parser.add_argument("--count", type=int, default=256, dest="cropCount")
+    parser.add_argument("--batch-size", type=int, default=64, dest="batchSize")
+    parser.add_argument("--kmeans-count", type=int, default=32, dest="kmeansCount", help="crops to run KMeans on (it is slow)")
+    args = parser.parse_args()
+    crops = loadCrops(args.cropDir, args.cropCount)
+    meanPixels = np.mean([crop.shape[0] * crop.shape[1] for crop in crops])
+    logger.info(f"{len(crops)} crops, {meanPixels:.0f} pixels on average")
+
+    classifier = ColorClassifier()
+    classifier.classifyBatch(crops[: args.batchSize])
+    startTime = perf_counter()
+    colors: list[str] = []
+    for start in range(0, len(crops), args.batchSize):
+        colors += classifier.classifyBatch(crops[start : start + args.batchSize])
+    elapsed = perf_counter() - startTime
+    counts = {name: colors.count(name) for name in COLORNAMES if name in colors}
+    logger.info(f"palette: {len(crops) / elapsed:.0f} crops/s ({elapsed / len(crops) * 1000:.2f}ms/crop). {counts}")
+
+    if KMeans is None:
+        logger.warning("scikit-learn is not installed. skipping KMeans")
+        return
+    kmeansCrops = crops[: args.kmeansCount]
+    startTime = perf_counter()
+    kmeansColors = [classifyKMeans(crop) for crop in kmeansCrops]
+    elapsed = perf_counter() - startTime
+    agreement = np.mean([a == b for a, b in zip(kmeansColors, colors)])
+    logger.info(
+        f"kmeans: {len(kmeansCrops) / elapsed:.1f} crops/s ({elapsed / len(kmeansCrops) * 1000:.0f}ms/crop). "
+        f"same color as palette for {agreement:.0%}"
+    )
+
+
+if __name__ == "__main__":
+    with open(Path("configs/log_conf.yaml"), "r", encoding="UTF-8") as configFile:
+        dictConfig(loadYaml(configFile.read(), FullLoader))
+    main()
@@ -0,0 +1,68 @@
+"""
+DBへの問い合わせを、毎回接続を作る従来の方法と接続プールで比較する。
+configs/secrets.json に書いたDB(ローカルのMySQL/MariaDBコンテナなど)に対して、
+複数スレッドから一件取得の問い合わせを繰り返し、1秒あたりの件数を求める。
+
+リポジトリのルートで実行する: python src/benchmarks/dbPool.py --threads 16 --requests 2000
+"""
+
+import sys
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from time import perf_counter
+from typing import Callable
+
+from logging import getLogger
+from logging.config import dictConfig
+
+from yaml import FullLoader, load as loadYaml
+
+sys.path.append(str(Path(__file__).parent.parent))
+from crud import getConnectionToDB, getConnectionPool, get_select  # noqa: E402
+
+logger = getLogger("BicycleCheck.benchmark")
+
+QUERY = "SELECT * FROM bike_info LIMIT 1"
+
+
+def selectByNewConnection() -> None:
+    """
+    問い合わせごとに接続を作って閉じる従来の方法
+    """
+    conn = getConnectionToDB()
+    try:
+        get_select(QUERY, conn)
+    finally:
+        conn.close()
+
+
+def selectByPool() -> None:
+    get_select(QUERY)
+
+
+def measure(function: Callable[[], None], threadCount: int, requestCount: int) -> float:
+    startTime = perf_counter()
+    with ThreadPoolExecutor(max_workers=threadCount) as executor:
+        for future in [executor.submit(function) for _ in range(requestCount)]:
+            future.result()
+    return requestCount / (perf_counter() - startTime)
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("--threads", type=int, default=16, dest="threadCount")
+    parser.add_argument("--requests", type=int, default=2000, dest="requestCount")
+    args = parser.parse_args()
+
+    connectRate = measure(selectByNewConnection, args.threadCount, args.requestCount)
+    logger.info(f"new connection per query: {connectRate:.0f} requests/s")
+    poolRate = measure(selectByPool, args.threadCount, args.requestCount)
+    logger.info(f"connection pool: {poolRate:.0f} requests/s")
+    logger.info(f"pool stats: {getConnectionPool().getStats()}")
+
+
+if __name__ == "__main__":
+    with open(Path("configs/log_conf.yaml"), "r", encoding="UTF-8") as configFile:
+        dictConfig(loadYaml(configFile.read(), FullLoader))
+    main()
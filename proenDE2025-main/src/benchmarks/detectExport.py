@@ -0,0 +1,131 @@
+"""
+発見事例の書き出しで使うメモリの量を測る。
+サーバー側から少しずつ読む書き出し(iterateExport)と、全件を読み込んでから書く場合の、最大常駐メモリを比較する。
+
+本番のテーブルを汚さないよう、kensys_info と同じ構造(外部キーを除く)の kensys_bench を作って使う。
+最大常駐メモリはプロセス全体で一度しか測れないので、方式ごとに別のプロセスで実行する。
+configs/secrets.json に書いたDBに対して、リポジトリのルートで実行する:
+python src/benchmarks/detectExport.py --rows 1000000 --fill
+python src/benchmarks/detectExport.py --mode stream --format csv
+python src/benchmarks/detectExport.py --mode fetchall --format csv
+"""
+
+import os
+import resource
+import sys
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from pathlib import Path
+from time import perf_counter
+
+from logging import getLogger
+from logging.config import dictConfig
+
+from yaml import FullLoader, load as loadYaml
+import numpy as np
+
+sys.path.append(str(Path(__file__).parent.parent))
+from crud import bulk_insert_query, get_select, insert_query  # noqa: E402
+from detectExport import EXPORTFORMATS, formatRows, iterateChunks  # noqa: E402
+from schemas import BicycleDetect, DetectFilter  # noqa: E402
+
+logger = getLogger("BicycleCheck.benchmark")
+
+LONGITUDERANGE = (139.60, 139.90)
+LATITUDERANGE = (35.55, 35.80)
+COLORS = ("black", "white", "silver", "red", "blue", "unknown")
+INSERTBATCHSIZE = 5000
+
+
+class BenchmarkDetect(BicycleDetect):
+    @classmethod
+    def getTableName(cls) -> str:
+        return "kensys_bench"
+
+
+def fillTable(rowCount: int, random: np.random.Generator) -> None:
+    insert_query("DROP TABLE IF EXISTS kensys_bench")
+    insert_query("CREATE TABLE kensys_bench LIKE kensys_info")
+    longitudes = random.uniform(*LONGITUDERANGE, rowCount)
+    latitudes = random.uniform(*LATITUDERANGE, rowCount)
+    colorIndexes = random.integers(0, len(COLORS), rowCount)
+    startTime = datetime.now() - timedelta(seconds=rowCount)
+
+    def getValues():
+        for i, (longitude, latitude, colorIndex) in enumerate(
+            zip(longitudes.tolist(), latitudes.tolist(), colorIndexes.tolist())
+        ):
+            x_chunk, x_fractional = BenchmarkDetect.coordinateActualToChunked(longitude)
+            y_chunk, y_fractional = BenchmarkDetect.coordinateActualToChunked(latitude)
+            yield (
+                1, 1, startTime + timedelta(seconds=i),
+                x_chunk, y_chunk, x_fractional, y_fractional,
+                f"crops/{i}.jpg", COLORS[colorIndex], i % 3 == 0, i % 7 == 0,
+            )
+
+    bulk_insert_query(BenchmarkDetect.getInsertQuery(), getValues(), INSERTBATCHSIZE)
+
+
+def getMaxRssMegabytes() -> float:
+    # Linuxでは ru_maxrss の単位はキロバイト
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def exportFetchall(output, format: str) -> int:
+    """
+    比較用に、全件を読み込んでから書き出す
+    """
+    query, params = BenchmarkDetect.getExportQuery(None, DetectFilter())
+    rows = [BenchmarkDetect.toExportRow(row) for row in get_select(query, None, params)]
+    output.write(formatRows(rows, format, True))
+    return len(rows)
+
+
+def exportStream(output, format: str, batchSize: int) -> int:
+    rowCount = 0
+
+    def countRows():
+        nonlocal rowCount
+        for rows in BenchmarkDetect.iterateExport(None, DetectFilter(), batchSize):
+            rowCount += len(rows)
+            yield rows
+
+    for chunk in iterateChunks(countRows(), format):
+        output.write(chunk)
+    return rowCount
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000, dest="rowCount")
+    parser.add_argument("--fill", action="store_true", dest="isFilled", help="(re)create kensys_bench and exit")
+    parser.add_argument("--mode", choices=("stream", "fetchall"), default="stream")
+    parser.add_argument("--format", choices=EXPORTFORMATS, default="ndjson")
+    parser.add_argument("--batch-size", type=int, default=1000, dest="batchSize")
+    parser.add_argument("--drop", action="store_true", dest="isDropped", help="drop kensys_bench afterwards")
+    args = parser.parse_args()
+    if args.isFilled:
+        startTime = perf_counter()
+        fillTable(args.rowCount, np.random.default_rng(0))
+        logger.info(f"inserted {args.rowCount} rows in {perf_counter() - startTime:.1f}s")
+        return
+    baseRss = getMaxRssMegabytes()
+    startTime = perf_counter()
+    with open(os.devnull, "w", encoding="UTF-8") as output:
+        if args.mode == "stream":
+            rowCount = exportStream(output, args.format, args.batchSize)
+        else:
+            rowCount = exportFetchall(output, args.format)
+    seconds = perf_counter() - startTime
+    logger.info(
+        f"{args.mode} {args.format}: {rowCount} rows in {seconds:.1f}s ({rowCount / seconds:.0f} rows/s), "
+        f"peak RSS {getMaxRssMegabytes():.1f} MB (before export {baseRss:.1f} MB)"
+    )
+    if args.isDropped:
+        insert_query("DROP TABLE IF EXISTS kensys_bench")
+
+
+if __name__ == "__main__":
+    with open(Path("configs/log_conf.yaml"), "r", encoding="UTF-8") as configFile:
+        dictConfig(loadYaml(configFile.read(), FullLoader))
+    main()
@@ -0,0 +1,137 @@
+"""
+:class:`BicycleCheck.detector.BicycleDetector` の実行方式ごとのCPUでの速度と精度を測る。
+入力は experiments/content/public_road の画像。正解データは無いので、torch の検出結果を正解とみなし、
+各実行方式の mAP@0.5 と mAP@0.5:0.95 がそこからどれだけ下がるかを見る。
+onnxruntime / openvino が入っていない実行方式は飛ばす。
+
+リポジトリのルートで実行する: python src/benchmarks/detectorBackend.py
+"""
+
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+from time import perf_counter
+
+from logging import getLogger
+from logging.config import dictConfig
+
+from yaml import FullLoader, load as loadYaml
+import numpy as np
+import cv2
+
+sys.path.append(str(Path(__file__).parent.parent))
+from BicycleCheck.attributes import getOverlaps  # noqa: E402
+from BicycleCheck.detector import (  # noqa: E402
+    BicycleDetector,
+    Detection,
+    DETECTMODELPATH,
+)
+
+logger = getLogger("BicycleCheck.benchmark")
+
+IMAGEDIR = Path("src/experiments/content/public_road")
+REPEATCOUNT = 3
+# (実行方式, int8)
+BACKENDS = [("torch", False), ("onnx", False), ("onnx", True), ("openvino", False)]
+IOUTHRESHOLDS = np.linspace(0.5, 0.95, 10)
+
+
+def getAveragePrecision(
+    references: list[Detection], detections: list[Detection], iouThreshold: float
+) -> float:
+    """
+    1クラス分のAP(VOCの全点補間)。検出は信頼度の高い順に、まだ対応の無い正解の枠に割り当てる
+    """
+    if not references:
+        return 1.0 if not detections else 0.0
+    detections = sorted(detections, key=lambda detection: -detection.confidence)
+    isMatched: set[int] = set()
+    isTruePositives: list[bool] = []
+    for detection in detections:
+        candidates = [
+            i
+            for i, reference in enumerate(references)
+            if reference.frameIndex == detection.frameIndex and i not in isMatched
+        ]
+        best = -1
+        if candidates:
+            ious, _ = getOverlaps(
+                np.array([detection.box], dtype=np.float32),
+                np.array([references[i].box for i in candidates], dtype=np.float32),
+            )
+            if ious[0].max() >= iouThreshold:
+                best = candidates[int(ious[0].argmax())]
+        if best >= 0:
+            isMatched.add(best)
+        isTruePositives.append(best >= 0)
+    truePositives = np.cumsum(isTruePositives)
+    recalls = truePositives / len(references)
+    precisions = truePositives / np.arange(1, len(detections) + 1)
+    recalls = np.concatenate(([0.0], recalls, [1.0]))
+    precisions = np.concatenate(([1.0], precisions, [0.0]))
+    precisions = np.maximum.accumulate(precisions[::-1])[::-1]
+    return float(np.sum((recalls[1:] - recalls[:-1]) * precisions[1:]))
+
+
+def getMeanAveragePrecision(
+    references: list[Detection], detections: list[Detection], iouThreshold: float
+) -> float:
+    classIds = sorted({detection.classId for detection in references + detections})
+    if not classIds:
+        return 1.0
+    return float(
+        np.mean(
+            [
+                getAveragePrecision(
+                    [r for r in references if r.classId == classId],
+                    [d for d in detections if d.classId == classId],
+                    iouThreshold,
+                )
+                for classId in classIds
+            ]
+        )
+    )
+
+
+def main(modelPath: Path, threadCount: int) -> None:
+    images = [cv2.imread(str(path)) for path in sorted(IMAGEDIR.glob("*.jpeg"))]
+    frames = list(enumerate(images))
+    references: list[Detection] = []
+    for backend, isInt8 in BACKENDS:
+        name = f"{backend}{' int8' if isInt8 else ''}"
+        try:
+            detector = BicycleDetector(
+                modelPath,
+                backend=backend,
+                isInt8=isInt8,
+                threadCount=threadCount,
+            )
+        except ImportError as e:
+            logger.warning(f"{name}: skipped ({e})")
+            continue
+        startTime = perf_counter()
+        for _ in range(REPEATCOUNT):
+            detections = list(detector.detectFrames(frames))
+        elapsed = perf_counter() - startTime
+        if backend == "torch":
+            references = detections
+        mapAt50 = getMeanAveragePrecision(references, detections, 0.5)
+        mapAt50To95 = np.mean(
+            [
+                getMeanAveragePrecision(references, detections, threshold)
+                for threshold in IOUTHRESHOLDS
+            ]
+        )
+        logger.info(
+            f"{name}: {elapsed * 1000 / (len(frames) * REPEATCOUNT):.1f}ms/frame, {len(detections)} detections, mAP@0.5 {mapAt50:.3f}, mAP@0.5:0.95 {mapAt50To95:.3f} (vs torch)"
+        )
+
+
+if __name__ == "__main__":
+    with open(Path("configs/log_conf.yaml"), "r", encoding="UTF-8") as configFile:
+        dictConfig(loadYaml(configFile.read(), FullLoader))
+    parser = ArgumentParser()
+    parser.add_argument("--model", type=Path, default=DETECTMODELPATH)
+    parser.add_argument("--threads", type=int, default=4, dest="threadCount")
+    args = parser.parse_args()
+    main(args.model, args.threadCount)
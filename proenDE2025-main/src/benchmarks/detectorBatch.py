@@ -0,0 +1,47 @@
+"""
+:class:`BicycleCheck.detector.BicycleDetector` のバッチサイズごとのCPUスループットを測る。
+入力は experiments/content/public_road の画像を、メモリ上のフレームとして繰り返し使う。
+
+リポジトリのルートで実行する: python src/benchmarks/detectorBatch.py
+"""
+
+import sys
+from pathlib import Path
+from time import perf_counter
+
+from logging import getLogger
+from logging.config import dictConfig
+
+from yaml import FullLoader, load as loadYaml
+import cv2
+
+sys.path.append(str(Path(__file__).parent.parent))
+from BicycleCheck.detector import BicycleDetector, DETECTMODELPATH  # noqa: E402
+
+logger = getLogger("BicycleCheck.benchmark")
+
+IMAGEDIR = Path("src/experiments/content/public_road")
+FRAMECOUNT = 64
+BATCHSIZES = [1, 2, 4, 8, 16]
+
+
+def main() -> None:
+    images = [cv2.imread(str(path)) for path in sorted(IMAGEDIR.glob("*.jpeg"))]
+    frames = [(i, images[i % len(images)]) for i in range(FRAMECOUNT)]
+    detector = BicycleDetector(DETECTMODELPATH)
+    # 初回推論は初期化を含むので計測から外す
+    detector.detectBatch([0], [images[0]])
+    for batchSize in BATCHSIZES:
+        detector.batchSize = batchSize
+        startTime = perf_counter()
+        detections = list(detector.detectFrames(frames))
+        elapsed = perf_counter() - startTime
+        logger.info(
+            f"batch {batchSize}: {FRAMECOUNT / elapsed:.2f} frames/s, {len(detections)} detections"
+        )
+
+
+if __name__ == "__main__":
+    with open(Path("configs/log_conf.yaml"), "r", encoding="UTF-8") as configFile:
+        dictConfig(loadYaml(configFile.read(), FullLoader))
+    main()
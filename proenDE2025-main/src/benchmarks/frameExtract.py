@@ -0,0 +1,90 @@
+"""
+フレーム抽出を、フレーム毎に VideoCapture を開いてシークする従来の方法と
+:meth:`Mp4File.iterateFrames` による一回の順次読み出しで比較する。
+動画は cv2.VideoWriter でその場で生成する。
+
+リポジトリのルートで実行する: python src/benchmarks/frameExtract.py
+"""
+
+import sys
+from pathlib import Path
+from time import perf_counter
+from typing import Optional
+
+from logging import getLogger
+from logging.config import dictConfig
+
+from yaml import FullLoader, load as loadYaml
+import numpy as np
+import cv2
+from cv2.typing import MatLike
+
+sys.path.append(str(Path(__file__).parent.parent))
+from mp4extract import Mp4File  # noqa: E402
+
+logger = getLogger("BicycleCheck.benchmark")
+
+VIDEOPATH = Path("tmp/benchmark-frameExtract.mp4")
+FRAMESIZE = (1280, 720)
+FRAMECOUNT = 900
+FPS = 30
+STEPS = [1, 10, 30]
+
+
+def writeSyntheticVideo(path: Path) -> None:
+    """
+    フレーム毎に内容の変わる動画を生成する。キーフレーム間隔はエンコーダ任せ
+    """
+    writer = cv2.VideoWriter(
+        str(path), cv2.VideoWriter.fourcc(*"mp4v"), FPS, FRAMESIZE
+    )
+    generator = np.random.default_rng(0)
+    background = generator.integers(0, 255, (FRAMESIZE[1], FRAMESIZE[0], 3), np.uint8)
+    for i in range(FRAMECOUNT):
+        frame = np.roll(background, i * 4, axis=1)
+        cv2.putText(
+            frame, str(i), (50, 100), cv2.FONT_HERSHEY_SIMPLEX, 3, (255, 255, 255), 5
+        )
+        writer.write(frame)
+    writer.release()
+
+
+def extractFramesBySeek(mp4File: Mp4File, step: int) -> list[Optional[MatLike]]:
+    """
+    フレーム毎に動画を開き直し、CAP_PROP_POS_FRAMES でシークする従来の方法
+    """
+    result: list[Optional[MatLike]] = []
+    for i in range(0, mp4File.getVideoFrameCount(), step):
+        videoFile = mp4File.getVideoFile()
+        videoFile.set(cv2.CAP_PROP_POS_FRAMES, i)
+        ret, frame = videoFile.read()
+        result.append(frame if ret else None)
+        videoFile.release()
+    return result
+
+
+def main() -> None:
+    VIDEOPATH.parent.mkdir(exist_ok=True)
+    writeSyntheticVideo(VIDEOPATH)
+    mp4File = Mp4File(VIDEOPATH)
+    for step in STEPS:
+        startTime = perf_counter()
+        framesBySeek = extractFramesBySeek(mp4File, step)
+        seekTime = perf_counter() - startTime
+        startTime = perf_counter()
+        framesByOrder = [frame for _, frame in mp4File.iterateFrames(step)]
+        orderTime = perf_counter() - startTime
+        isMatched = len(framesBySeek) == len(framesByOrder) and all(
+            frameBySeek is not None and np.array_equal(frameBySeek, frameByOrder)
+            for frameBySeek, frameByOrder in zip(framesBySeek, framesByOrder)
+        )
+        logger.info(
+            f"step {step}: {len(framesByOrder)} frames, seek {seekTime:.2f}s, sequential {orderTime:.2f}s ({seekTime / orderTime:.1f}x), matched: {isMatched}"
+        )
+    VIDEOPATH.unlink()
+
+
+if __name__ == "__main__":
+    with open(Path("configs/log_conf.yaml"), "r", encoding="UTF-8") as configFile:
+        dictConfig(loadYaml(configFile.read(), FullLoader))
+    main()
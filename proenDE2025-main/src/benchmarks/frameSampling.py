@@ -0,0 +1,53 @@
+"""
+一定フレームおきの間引きと、:class:`BicycleCheck.sampler.FrameSampler` による
+距離・差分ベースの間引きで、検出にかけるフレーム数と検出時間を比較する。
+
+リポジトリのルートで実行する: python src/benchmarks/frameSampling.py
+"""
+
+import sys
+from pathlib import Path
+from time import perf_counter
+
+from logging import getLogger
+from logging.config import dictConfig
+
+from yaml import FullLoader, load as loadYaml
+
+sys.path.append(str(Path(__file__).parent.parent))
+from mp4extract import Mp4File  # noqa: E402
+from BicycleCheck.detector import getDetector  # noqa: E402
+from BicycleCheck.sampler import FrameSampler, SAMPLE_CHECK_STEP  # noqa: E402
+
+logger = getLogger("BicycleCheck.benchmark")
+
+BASEDIR = Path("tmp/")
+
+
+def main() -> None:
+    detector = getDetector()
+    sampler = FrameSampler()
+    for file in sorted(BASEDIR.glob("*.MP4")):
+        mp4File = Mp4File(file)
+        startTime = perf_counter()
+        fixedFrames = list(mp4File.iterateFrames(SAMPLE_CHECK_STEP))
+        fixedDetections = list(detector.detectFrames(fixedFrames))
+        fixedTime = perf_counter() - startTime
+
+        startTime = perf_counter()
+        adaptiveFrames = list(sampler.iterateFrames(mp4File))
+        adaptiveDetections = list(detector.detectFrames(adaptiveFrames))
+        adaptiveTime = perf_counter() - startTime
+
+        logger.info(
+            f"{file.name}: fixed {len(fixedFrames)} frames/{len(fixedDetections)} detections in {fixedTime:.1f}s, "
+            f"adaptive {len(adaptiveFrames)} frames/{len(adaptiveDetections)} detections in {adaptiveTime:.1f}s. "
+            f"skipped {len(fixedFrames) - len(adaptiveFrames)} frames, saved {fixedTime - adaptiveTime:.1f}s"
+        )
+    logger.info(f"total: {sampler.getStats()}")
+
+
+if __name__ == "__main__":
+    with open(Path("configs/log_conf.yaml"), "r", encoding="UTF-8") as configFile:
+        dictConfig(loadYaml(configFile.read(), FullLoader))
+    main()
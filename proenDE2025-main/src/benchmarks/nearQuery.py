@@ -0,0 +1,107 @@
+"""
+「この付近で見つかった自転車」の問い合わせの応答時間を、検出テーブルの件数ごとに測る。
+チャンクの複合インデックスを使う場合と、使わずに全件を読む場合を比較する。
+
+本番のテーブルを汚さないよう、kensys_info と同じ構造(外部キーを除く)の kensys_bench を作って使う。
+configs/secrets.json に書いたDBに対して、リポジトリのルートで実行する:
+python src/benchmarks/nearQuery.py --sizes 10000 100000 1000000 3000000
+"""
+
+import sys
+from argparse import ArgumentParser
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+
+from logging import getLogger
+from logging.config import dictConfig
+
+from yaml import FullLoader, load as loadYaml
+import numpy as np
+
+sys.path.append(str(Path(__file__).parent.parent))
+from crud import bulk_insert_query, get_select, insert_query  # noqa: E402
+from schemas import BicycleDetect  # noqa: E402
+
+logger = getLogger("BicycleCheck.benchmark")
+
+# 東京23区ほどの範囲に検出を散らばらせる
+LONGITUDERANGE = (139.60, 139.90)
+LATITUDERANGE = (35.55, 35.80)
+QUERYCOUNT = 200
+INSERTBATCHSIZE = 5000
+
+
+class BenchmarkDetect(BicycleDetect):
+    @classmethod
+    def getTableName(cls) -> str:
+        return "kensys_bench"
+
+
+def fillTable(rowCount: int, random: np.random.Generator) -> None:
+    insert_query("DROP TABLE IF EXISTS kensys_bench")
+    insert_query("CREATE TABLE kensys_bench LIKE kensys_info")
+    longitudes = random.uniform(*LONGITUDERANGE, rowCount)
+    latitudes = random.uniform(*LATITUDERANGE, rowCount)
+    detectionTime = datetime.now()
+
+    def getValues():
+        for longitude, latitude in zip(longitudes.tolist(), latitudes.tolist()):
+            x_chunk, x_fractional = BenchmarkDetect.coordinateActualToChunked(longitude)
+            y_chunk, y_fractional = BenchmarkDetect.coordinateActualToChunked(latitude)
+            yield (
+                1, 1, detectionTime,
+                x_chunk, y_chunk, x_fractional, y_fractional,
+                "", "unknown", False, False,
+            )
+
+    bulk_insert_query(BenchmarkDetect.getInsertQuery(), getValues(), INSERTBATCHSIZE)
+
+
+def measure(random: np.random.Generator, isIndexUsed: bool) -> tuple[float, float, float]:
+    """
+    ランダムな地点での問い合わせを繰り返し、応答時間の中央値とp99(ミリ秒)、平均の件数を返す
+    """
+    latencies: list[float] = []
+    counts: list[int] = []
+    for _ in range(QUERYCOUNT):
+        longitude = random.uniform(*LONGITUDERANGE)
+        latitude = random.uniform(*LATITUDERANGE)
+        startTime = perf_counter()
+        if isIndexUsed:
+            detects = BenchmarkDetect.getByCoordinates(longitude, latitude)
+        else:
+            query, params = BenchmarkDetect.getNearQuery(longitude, latitude, 50.0)
+            query = query.replace("WHERE", "IGNORE INDEX (kensys_chunk) WHERE")
+            rows = get_select(query, None, params)
+            detects = BenchmarkDetect.filterByDistance(
+                [BenchmarkDetect.fromRow(row) for row in rows], longitude, latitude, 50.0
+            )
+        latencies.append(perf_counter() - startTime)
+        counts.append(len(detects))
+    p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+    return p50, p99, float(np.mean(counts))
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--scan", action="store_true", dest="isScanMeasured", help="also measure without the index")
+    args = parser.parse_args()
+    random = np.random.default_rng(0)
+    for rowCount in args.sizes:
+        startTime = perf_counter()
+        fillTable(rowCount, random)
+        logger.info(f"inserted {rowCount} rows in {perf_counter() - startTime:.1f}s")
+        p50, p99, meanCount = measure(random, True)
+        logger.info(f"{rowCount} rows, chunk index: p50 {p50:.2f}ms, p99 {p99:.2f}ms, {meanCount:.1f} hits")
+        if args.isScanMeasured:
+            p50, p99, meanCount = measure(random, False)
+            logger.info(f"{rowCount} rows, full scan: p50 {p50:.2f}ms, p99 {p99:.2f}ms, {meanCount:.1f} hits")
+    insert_query("DROP TABLE IF EXISTS kensys_bench")
+
+
+if __name__ == "__main__":
+    with open(Path("configs/log_conf.yaml"), "r", encoding="UTF-8") as configFile:
+        dictConfig(loadYaml(configFile.read(), FullLoader))
+    main()
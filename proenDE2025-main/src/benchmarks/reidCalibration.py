@@ -0,0 +1,141 @@
+"""
+:class:`BicycleCheck.reid.AppearanceEncoder` の白色化の行列を求め、REID_MIN_SIMILARITY を決めるための
+同じ自転車/別の自転車の類似度の分布を測る。
+
+入力は yolo/datasets/yolo11/ver2 の自転車の写真。同じ自転車を別のフレームで写した組は無いので、
+1枚の写真から、枠の位置・大きさ・明るさ・ぼけ・JPEGの画質を変えた切り抜きを作って「同じ自転車」とする。
+train の写真で平均とPCAの白色化を求め、valid と test の写真で評価する。
+
+リポジトリのルートで実行する: python src/benchmarks/reidCalibration.py [--write]
+"""
+
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+
+from logging import getLogger
+from logging.config import dictConfig
+
+from yaml import FullLoader, load as loadYaml
+import numpy as np
+import cv2
+from cv2.typing import MatLike
+
+sys.path.append(str(Path(__file__).parent.parent))
+from BicycleCheck.reid import (  # noqa: E402
+    AppearanceEncoder,
+    normalizeRows,
+    REID_MIN_SIMILARITY,
+    REIDWHITENINGPATH,
+)
+
+logger = getLogger("BicycleCheck.benchmark")
+
+DATASETDIR = Path("yolo/datasets/yolo11/ver2")
+# 白色化後の次元数
+WHITENINGDIMENSION = 64
+# 白色化を求める時に、写真1枚から作る切り抜きの数
+FITVIEWCOUNT = 3
+THRESHOLDS = [0.5, 0.55, 0.6, 0.65, 0.7]
+
+
+def jitter(image: MatLike, rng: np.random.Generator) -> MatLike:
+    """
+    同じ自転車を別のフレームで切り抜いたような画像を作る
+    """
+    height, width = image.shape[:2]
+    scale = rng.uniform(0.9, 1.0)
+    cropWidth, cropHeight = int(width * scale), int(height * scale)
+    x = int(rng.integers(0, width - cropWidth + 1))
+    y = int(rng.integers(0, height - cropHeight + 1))
+    crop = image[y : y + cropHeight, x : x + cropWidth]
+    # 距離による大きさの違い
+    factor = rng.uniform(0.4, 1.0)
+    crop = cv2.resize(crop, None, fx=factor, fy=factor, interpolation=cv2.INTER_AREA)
+    crop = cv2.convertScaleAbs(crop, alpha=rng.uniform(0.8, 1.2), beta=rng.uniform(-20, 20))
+    if rng.random() < 0.5:
+        crop = cv2.GaussianBlur(crop, (3, 3), 0)
+    _, buffer = cv2.imencode(
+        ".jpg", crop, [cv2.IMWRITE_JPEG_QUALITY, int(rng.integers(60, 95))]
+    )
+    return cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+
+
+def encodeViews(
+    encoder: AppearanceEncoder,
+    images: list[MatLike],
+    viewCount: int,
+    rng: np.random.Generator,
+) -> list[np.ndarray]:
+    return [
+        encoder.encodeBatch([jitter(image, rng) for image in images])
+        for _ in range(viewCount)
+    ]
+
+
+def fitWhitening(vectors: np.ndarray, dimension: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    (平均, 射影行列 (元の次元数, dimension))。主成分ごとに分散が1になるようにする
+    """
+    mean = vectors.mean(axis=0)
+    _, singularValues, components = np.linalg.svd(vectors - mean, full_matrices=False)
+    scales = singularValues[:dimension] / np.sqrt(len(vectors))
+    return mean, components[:dimension].T / scales
+
+
+def main(isWritten: bool, seed: int) -> None:
+    rng = np.random.default_rng(seed)
+    encoder = AppearanceEncoder(whiteningPath=None)
+    fitImages = [
+        cv2.imread(str(path)) for path in sorted(DATASETDIR.glob("train/images/*.jpg"))
+    ]
+    evaluateImages = [
+        cv2.imread(str(path))
+        for split in ("valid", "test")
+        for path in sorted(DATASETDIR.glob(f"{split}/images/*.jpg"))
+    ]
+    mean, projection = fitWhitening(
+        np.vstack(encodeViews(encoder, fitImages, FITVIEWCOUNT, rng)),
+        WHITENINGDIMENSION,
+    )
+    rawA, rawB = encodeViews(encoder, evaluateImages, 2, rng)
+    isDifferent = ~np.eye(len(evaluateImages), dtype=bool)
+    for name, a, b in (
+        ("raw", rawA, rawB),
+        (
+            "whitened",
+            normalizeRows((rawA - mean) @ projection),
+            normalizeRows((rawB - mean) @ projection),
+        ),
+    ):
+        same = (a * b).sum(axis=1)
+        different = (a @ b.T)[isDifferent]
+        logger.info(
+            f"{name}: different median {np.median(different):.2f}, p99 {np.quantile(different, 0.99):.2f}; same median {np.median(same):.2f}, p5 {np.quantile(same, 0.05):.2f}"
+        )
+        for threshold in THRESHOLDS:
+            logger.info(
+                f"{name} >= {threshold}: different {(different >= threshold).mean():.2%}, same {(same >= threshold).mean():.1%}"
+                + (" (REID_MIN_SIMILARITY)" if threshold == REID_MIN_SIMILARITY else "")
+            )
+    logger.info(
+        f"{len(fitImages)} photos for fitting, {len(evaluateImages)} photos for evaluation"
+    )
+    if isWritten:
+        REIDWHITENINGPATH.parent.mkdir(parents=True, exist_ok=True)
+        np.savez(
+            REIDWHITENINGPATH,
+            mean=mean.astype(np.float32),
+            projection=projection.astype(np.float32),
+        )
+        logger.info(f"wrote {REIDWHITENINGPATH}")
+
+
+if __name__ == "__main__":
+    with open(Path("configs/log_conf.yaml"), "r", encoding="UTF-8") as configFile:
+        dictConfig(loadYaml(configFile.read(), FullLoader))
+    parser = ArgumentParser()
+    parser.add_argument("--write", action="store_true", dest="isWritten", help=f"save the whitening to {REIDWHITENINGPATH}")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    main(args.isWritten, args.seed)
@@ -0,0 +1,134 @@
+"""
+再識別の照合にかかる時間を測る。
+experiments/similarity.ipynb のように、候補の切り抜きごとにAKAZEの特徴点を計算して総当たりで比べる方法と、
+特徴ベクトルをメモリマップの行列に保存し、周囲の目撃だけをまとめてコサイン類似度で比べる方法を比較する。
+
+保存件数ごとに、乱数のベクトルと東京23区ほどの範囲に散らばらせた目撃で索引を作る(tmp/reid_bench に書く)。
+リポジトリのルートで実行する: python src/benchmarks/reidSearch.py --sizes 10000 100000 1000000
+"""
+
+import sys
+from argparse import ArgumentParser
+from datetime import datetime
+from pathlib import Path
+from shutil import rmtree
+from time import perf_counter
+
+from logging import getLogger
+from logging.config import dictConfig
+
+from yaml import FullLoader, load as loadYaml
+import numpy as np
+import cv2
+
+sys.path.append(str(Path(__file__).parent.parent))
+from BicycleCheck.reid import AppearanceEncoder, normalizeRows  # noqa: E402
+from reidIndex import EmbeddingStore, ReidIndex  # noqa: E402
+from sightingIndex import SightingIndex, Sighting  # noqa: E402
+
+logger = getLogger("BicycleCheck.benchmark")
+
+BENCHDIR = Path("tmp/reid_bench")
+LONGITUDERANGE = (139.60, 139.90)
+LATITUDERANGE = (35.55, 35.80)
+CROPSIZE = (160, 240)
+QUERYBATCHSIZE = 64
+QUERYCOUNT = 20
+
+
+def getCrops(count: int, random: np.random.Generator) -> list[np.ndarray]:
+    crops = random.integers(0, 256, (count, *CROPSIZE, 3), dtype=np.uint8)
+    return [cv2.GaussianBlur(crop, (5, 5), 0) for crop in crops]
+
+
+def measureAkaze(candidateCount: int, random: np.random.Generator) -> float:
+    """
+    ノートブックの方法。1件の照合で、候補の数だけ特徴点の計算と総当たりの照合を行う。秒を返す
+    """
+    query, *candidates = getCrops(candidateCount + 1, random)
+    # AKAZE の無いOpenCVでは、同じく二値の特徴量のORBで代用する
+    detector = cv2.AKAZE_create() if hasattr(cv2, "AKAZE_create") else cv2.ORB_create()
+    matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+    startTime = perf_counter()
+    _, queryDescriptors = detector.detectAndCompute(cv2.resize(query, (200, 200)), None)
+    for candidate in candidates:
+        _, descriptors = detector.detectAndCompute(cv2.resize(candidate, (200, 200)), None)
+        if queryDescriptors is not None and descriptors is not None:
+            matcher.match(queryDescriptors, descriptors)
+    return perf_counter() - startTime
+
+
+def buildIndex(
+    size: int, dimension: int, random: np.random.Generator
+) -> tuple[ReidIndex, np.ndarray, np.ndarray]:
+    rmtree(BENCHDIR, ignore_errors=True)
+    store = EmbeddingStore(BENCHDIR, dimension)
+    sightingIndex = SightingIndex(windowSeconds=float("inf"))
+    longitudes = random.uniform(*LONGITUDERANGE, size)
+    latitudes = random.uniform(*LATITUDERANGE, size)
+    detectionTime = datetime.now().timestamp()
+    for start in range(0, size, 10000):
+        stop = min(start + 10000, size)
+        vectors = normalizeRows(
+            random.normal(size=(stop - start, dimension)).astype(np.float32)
+        )
+        for i in range(start, stop):
+            sightingIndex.add(
+                Sighting(i, i, float(longitudes[i]), float(latitudes[i]), detectionTime)
+            )
+        store.add(list(range(start, stop)), vectors)
+    store.flush()
+    return ReidIndex(sightingIndex, store), longitudes, latitudes
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--akaze-candidates", type=int, default=50, dest="akazeCandidateCount")
+    args = parser.parse_args()
+    random = np.random.default_rng(0)
+
+    encoder = AppearanceEncoder()
+    crops = getCrops(256, random)
+    encoder.encodeBatch(crops[:QUERYBATCHSIZE])
+    startTime = perf_counter()
+    for start in range(0, len(crops), QUERYBATCHSIZE):
+        encoder.encodeBatch(crops[start : start + QUERYBATCHSIZE])
+    elapsed = perf_counter() - startTime
+    logger.info(f"encoder: {len(crops) / elapsed:.0f} crops/s, {encoder.dimension} dimensions")
+
+    akazeSeconds = measureAkaze(args.akazeCandidateCount, random)
+    logger.info(
+        f"keypoints: {akazeSeconds * 1000:.0f}ms per query against {args.akazeCandidateCount} candidates "
+        f"({akazeSeconds / args.akazeCandidateCount * 1000:.1f}ms per candidate)"
+    )
+
+    for size in args.sizes:
+        startTime = perf_counter()
+        index, longitudes, latitudes = buildIndex(size, encoder.dimension, random)
+        logger.info(f"{size} embeddings indexed in {perf_counter() - startTime:.1f}s")
+        latencies: list[float] = []
+        for _ in range(QUERYCOUNT):
+            targets = random.integers(0, size, QUERYBATCHSIZE)
+            points = [(float(longitudes[i]), float(latitudes[i])) for i in targets]
+            vectors = index.store.getVectors(targets)
+            startTime = perf_counter()
+            matches = index.findBicycleIds(points, vectors)
+            latencies.append((perf_counter() - startTime) / QUERYBATCHSIZE)
+        hitRatio = np.mean([match.bicycleId == i for match, i in zip(matches, targets.tolist())])
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+        # 空間で絞り込まず、全件と比べた場合
+        startTime = perf_counter()
+        np.asarray(index.store.getVectors(np.arange(size))) @ vectors.T
+        bruteSeconds = (perf_counter() - startTime) / QUERYBATCHSIZE
+        logger.info(
+            f"{size} embeddings: {p50:.3f}ms/query (p99 {p99:.3f}ms) within {index.radiusMeters}m, "
+            f"self match {hitRatio:.0%}. all rows: {bruteSeconds * 1000:.3f}ms/query"
+        )
+    rmtree(BENCHDIR, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    with open(Path("configs/log_conf.yaml"), "r", encoding="UTF-8") as configFile:
+        dictConfig(loadYaml(configFile.read(), FullLoader))
+    main()
@@ -0,0 +1,60 @@
+"""
+getOne の応答時間を、キャッシュを通さない場合と通す場合で比較する。
+configs/secrets.json に書いたDBの district_info に、少なくとも1件のデータがある状態で、
+リポジトリのルートで実行する: python src/benchmarks/schemaCache.py --id 1 --count 2000
+"""
+
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+from time import perf_counter
+from typing import Callable
+
+from logging import getLogger
+from logging.config import dictConfig
+
+from yaml import FullLoader, load as loadYaml
+import numpy as np
+
+sys.path.append(str(Path(__file__).parent.parent))
+from schemas import Area  # noqa: E402
+from schemaCache import getSchemaCache  # noqa: E402
+
+logger = getLogger("BicycleCheck.benchmark")
+
+
+def measure(function: Callable[[], object], count: int) -> tuple[float, float]:
+    """
+    count 回呼び出し、応答時間の中央値とp99(マイクロ秒)を返す
+    """
+    latencies: list[float] = []
+    for _ in range(count):
+        startTime = perf_counter()
+        function()
+        latencies.append(perf_counter() - startTime)
+    p50, p99 = np.percentile(latencies, [50, 99]) * 1_000_000
+    return p50, p99
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument("--id", type=int, default=1)
+    parser.add_argument("--count", type=int, default=2000)
+    args = parser.parse_args()
+
+    # デコレータを外した元の関数を呼ぶと、毎回DBに問い合わせる
+    uncached = Area.getOne.__wrapped__
+    p50, p99 = measure(lambda: uncached(Area, args.id), args.count)
+    logger.info(f"without cache: p50 {p50:.0f}us, p99 {p99:.0f}us")
+    p50, p99 = measure(lambda: Area.getOne(args.id), args.count)
+    logger.info(f"with cache: p50 {p50:.0f}us, p99 {p99:.0f}us")
+    cache = getSchemaCache()
+    if cache is not None:
+        stats = cache.getStats()
+        logger.info(f"{type(cache).__name__}: {stats}, hit ratio {stats.getHitRatio():.1%}")
+
+
+if __name__ == "__main__":
+    with open(Path("configs/log_conf.yaml"), "r", encoding="UTF-8") as configFile:
+        dictConfig(loadYaml(configFile.read(), FullLoader))
+    main()
@@ -0,0 +1,134 @@
+"""
+:class:`BicycleCheck.tiling.FrameTiler` によるタイル分割推論と、フレーム全体の推論(imgszを変えて)の
+再現率とCPUスループットを比べる。入力は experiments/content/public_road の画像で、
+ファイル名に _r を含むものは後方カメラ、それ以外は前方カメラとみなす。
+正解データは無いので、最も大きい imgsz でのフレーム全体の推論の自転車の検出と、
+タイル分割推論の検出を合わせて(NMSで重複を除いて)正解とみなす。
+
+リポジトリのルートで実行する: python src/benchmarks/tiledInference.py
+"""
+
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+from time import perf_counter
+
+from logging import getLogger
+from logging.config import dictConfig
+
+from yaml import FullLoader, load as loadYaml
+import numpy as np
+import cv2
+from cv2.typing import MatLike
+
+sys.path.append(str(Path(__file__).parent.parent))
+from BicycleCheck.attributes import getOverlaps  # noqa: E402
+from BicycleCheck.detector import (  # noqa: E402
+    BicycleDetector,
+    Detection,
+    DETECTMODELPATH,
+)
+from BicycleCheck.tiling import FrameTiler, mergeDetections  # noqa: E402
+
+logger = getLogger("BicycleCheck.benchmark")
+
+IMAGEDIR = Path("src/experiments/content/public_road")
+IMAGESIZES = [640, 960, 1280]
+REPEATCOUNT = 2
+RECALLIOU = 0.5
+
+
+def getCamera(path: Path) -> str:
+    return "R" if "_r" in path.stem else "F"
+
+
+def getRecall(references: list[Detection], detections: list[Detection]) -> float:
+    """
+    正解の枠のうち、同じフレームでIoUが RECALLIOU 以上の検出があるものの割合
+    """
+    if not references:
+        return 1.0
+    foundCount = 0
+    for frameIndex in {reference.frameIndex for reference in references}:
+        frameReferences = [r for r in references if r.frameIndex == frameIndex]
+        frameDetections = [d for d in detections if d.frameIndex == frameIndex]
+        if not frameDetections:
+            continue
+        ious, _ = getOverlaps(
+            np.array([r.box for r in frameReferences], dtype=np.float32),
+            np.array([d.box for d in frameDetections], dtype=np.float32),
+        )
+        foundCount += int((ious.max(axis=1) >= RECALLIOU).sum())
+    return foundCount / len(references)
+
+
+def detectFull(detector: BicycleDetector, images: list[MatLike]) -> list[Detection]:
+    return list(detector.detectFrames(enumerate(images)))
+
+
+def detectTiled(
+    detector: BicycleDetector,
+    tiler: FrameTiler,
+    images: list[MatLike],
+    cameras: list[str],
+) -> list[Detection]:
+    detections: list[Detection] = []
+    for start in range(0, len(images), detector.batchSize):
+        frameIndexes = list(range(start, min(start + detector.batchSize, len(images))))
+        # まとまりの中でカメラが混ざらないよう、カメラごとに分ける
+        for camera in sorted({cameras[i] for i in frameIndexes}):
+            positions = [i for i in frameIndexes if cameras[i] == camera]
+            cameraFrames = [images[i] for i in positions]
+            crops, tiles = tiler.split(cameraFrames, camera)
+            detections += tiler.merge(
+                positions,
+                cameraFrames,
+                tiles,
+                detector.detectBatch(list(range(len(crops))), crops),
+            )
+    return detections
+
+
+def main(modelPath: Path) -> None:
+    paths = sorted(IMAGEDIR.glob("*.jpeg"))
+    images = [cv2.imread(str(path)) for path in paths]
+    cameras = [getCamera(path) for path in paths]
+    results: dict[str, tuple[list[Detection], float]] = {}
+    for imageSize in IMAGESIZES:
+        detector = BicycleDetector(modelPath, imageSize=imageSize, classNames=["bicycle"])
+        startTime = perf_counter()
+        for _ in range(REPEATCOUNT):
+            detections = detectFull(detector, images)
+        results[f"full {imageSize}"] = (detections, perf_counter() - startTime)
+    tiler = FrameTiler.fromConfig()
+    detector = BicycleDetector(
+        modelPath, imageSize=tiler.tileSize, classNames=["bicycle"]
+    )
+    startTime = perf_counter()
+    for _ in range(REPEATCOUNT):
+        detections = detectTiled(detector, tiler, images, cameras)
+    results[f"tiled {tiler.tileSize}"] = (detections, perf_counter() - startTime)
+
+    candidates = results[f"full {IMAGESIZES[-1]}"][0] + detections
+    references = [
+        detection
+        for frameIndex in range(len(images))
+        for detection in mergeDetections(
+            [c for c in candidates if c.frameIndex == frameIndex],
+            [False] * sum(c.frameIndex == frameIndex for c in candidates),
+        )
+    ]
+    logger.info(f"{len(references)} reference bicycles in {len(images)} images")
+    for name, (detections, elapsed) in results.items():
+        logger.info(
+            f"{name}: {len(images) * REPEATCOUNT / elapsed:.2f} frames/s, {len(detections)} detections, recall {getRecall(references, detections):.3f}"
+        )
+
+
+if __name__ == "__main__":
+    with open(Path("configs/log_conf.yaml"), "r", encoding="UTF-8") as configFile:
+        dictConfig(loadYaml(configFile.read(), FullLoader))
+    parser = ArgumentParser()
+    parser.add_argument("--model", type=Path, default=DETECTMODELPATH)
+    args = parser.parse_args()
+    main(args.model)
@@ -0,0 +1,58 @@
+"""
+GPSレコードの解析を、1レコードずつの :meth:`Mp4File._parseCoordinate` と
+列指向の :class:`Mp4Track` で比較する。結果が一致するかの確認も兼ねる。
+
+リポジトリのルートで実行する: python src/benchmarks/trackDecode.py
+"""
+
+import sys
+from pathlib import Path
+from time import perf_counter
+
+from logging import getLogger
+from logging.config import dictConfig
+
+from yaml import FullLoader, load as loadYaml
+
+sys.path.append(str(Path(__file__).parent.parent))
+from mp4extract import Mp4File, coordinateType, CHUNKSIZE, HEADERSIZE  # noqa: E402
+
+logger = getLogger("BicycleCheck.benchmark")
+
+BASEDIR = Path("tmp/")
+
+
+def getCoordinatesByChunk(mp4File: Mp4File) -> list[coordinateType]:
+    """
+    ファイルを CHUNKSIZE ずつ読み、1レコードずつ正規表現で解析する従来の方法
+    """
+    result: list[coordinateType] = []
+    with open(mp4File.path, mode="rb") as file:
+        file.seek(mp4File.getStartPoint() + HEADERSIZE)
+        while True:
+            chunk = file.read(CHUNKSIZE)
+            if chunk == (b" " * CHUNKSIZE) or len(chunk) < CHUNKSIZE:
+                break
+            result.append(Mp4File._parseCoordinate(chunk))
+    return result
+
+
+def main() -> None:
+    for file in sorted(BASEDIR.glob("*.MP4")):
+        mp4File = Mp4File(file)
+        startTime = perf_counter()
+        expected = getCoordinatesByChunk(mp4File)
+        chunkTime = perf_counter() - startTime
+        startTime = perf_counter()
+        track = mp4File.getTrack()
+        trackTime = perf_counter() - startTime
+        isMatched = track.toCoordinates() == expected
+        logger.info(
+            f"{file.name}: {len(track)} records, chunk {chunkTime * 1000:.1f}ms, track {trackTime * 1000:.1f}ms, matched: {isMatched}"
+        )
+
+
+if __name__ == "__main__":
+    with open(Path("configs/log_conf.yaml"), "r", encoding="UTF-8") as configFile:
+        dictConfig(loadYaml(configFile.read(), FullLoader))
+    main()
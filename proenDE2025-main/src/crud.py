@@ -1,21 +1,71 @@
 from pathlib import Path
 from json import load
-from typing import List, Dict, Any, Optional, cast,Union
+from contextlib import contextmanager
+from functools import lru_cache
+from threading import BoundedSemaphore, Lock
+from time import perf_counter, sleep
+from itertools import islice
+from re import IGNORECASE, compile as reCompile
+from typing import List, Dict, Any, Callable, Generator, Iterable, NamedTuple, Optional, cast,Union
 
 from logging import getLogger
 
 from mysql.connector import connect
-from mysql.connector.pooling import PooledMySQLConnection
+from mysql.connector.pooling import MySQLConnectionPool, PooledMySQLConnection
 from mysql.connector.abstracts import MySQLConnectionAbstract
 from mysql.connector.errors import (
     ProgrammingError as MysqlProgrammingError,
     DatabaseError,
+    PoolError,
 )
 
 LOGGER = getLogger("BicycleCheck.db")
 
+DBPOOL_NAME = "bicyclecheck"
+DBPOOL_SIZE = 8
+DBPOOL_MAX_OVERFLOW = 4
+DBPOOL_TIMEOUT = 10.0
+# プールが空の時に、返却を確かめる間隔
+DBPOOL_POLL_SECONDS = 0.005
+DBBULK_BATCH_SIZE = 500
+DBSTREAM_BATCH_SIZE = 1000
 
+
+# 問い合わせのたびに、クエリ文字列を渡して呼ばれる関数。計測やテストで問い合わせ回数を数えるのに使う
+queryHooks: list[Callable[[str], None]] = []
+
+
+def notifyQuery(query: str) -> None:
+    for hook in queryHooks:
+        hook(query)
+
+
+class QueryCounter(object):
+    """
+    with文の中で実行された問い合わせを記録する
+    """
+
+    queries: list[str]
+
+    def __init__(self) -> None:
+        self.queries = []
+
+    def __enter__(self) -> "QueryCounter":
+        queryHooks.append(self.queries.append)
+        return self
+
+    def __exit__(self, *args) -> None:
+        queryHooks.remove(self.queries.append)
+
+    def getCount(self) -> int:
+        return len(self.queries)
+
+
+@lru_cache(maxsize=1)
 def getDBConfig() -> dict[str, str | dict[str, str]]:
+    """
+    DBの接続設定。ファイルはプロセス内で一度だけ読み込まれる
+    """
     filepath = Path("configs/secrets.json")
     try:
         with open(filepath, "r") as file:
@@ -57,30 +107,244 @@ def getConnectionToDB(
         raise e
 
 
+@lru_cache(maxsize=1)
+def getPoolConfig() -> dict[str, Any]:
+    """
+    接続プールの設定。configs/universal.json の dbPool にあればそれを使う
+    """
+    poolConfig: dict[str, Any] = {
+        "size": DBPOOL_SIZE,
+        "maxOverflow": DBPOOL_MAX_OVERFLOW,
+        "timeout": DBPOOL_TIMEOUT,
+    }
+    filepath = Path("configs/universal.json")
+    if filepath.exists():
+        with open(filepath, "r") as file:
+            poolConfig.update(load(file).get("dbPool", {}))
+    return poolConfig
+
+
+class PoolStats(NamedTuple):
+    borrowCount: int
+    waitCount: int
+    waitSeconds: float
+    maxWaitSeconds: float
+    overflowCount: int
+    timeoutCount: int
+
+
+class ConnectionPool(object):
+    """
+    mysql.connector の接続プール。
+    プールが空の場合は maxOverflow 個まで一時的な接続を作り、それも尽きたら timeout 秒まで返却を待つ。
+    借りるまでに待たされた時間を記録する。
+    """
+
+    size: int
+    maxOverflow: int
+    timeout: float
+    borrowCount: int
+    waitCount: int
+    waitSeconds: float
+    maxWaitSeconds: float
+    overflowCount: int
+    timeoutCount: int
+    _pool: MySQLConnectionPool
+    _connectionConfig: dict[str, Any]
+    _overflowSemaphore: BoundedSemaphore
+    _lock: Lock
+
+    def __init__(
+        self,
+        size: int = DBPOOL_SIZE,
+        maxOverflow: int = DBPOOL_MAX_OVERFLOW,
+        timeout: float = DBPOOL_TIMEOUT,
+    ) -> None:
+        dbconfig = getDBConfig()
+        self._connectionConfig = {
+            "host": dbconfig["host"],
+            "user": dbconfig["user"],
+            "password": dbconfig["password"],
+            "database": dbconfig["database"],
+        }
+        self.size = size
+        self.maxOverflow = maxOverflow
+        self.timeout = timeout
+        self.borrowCount = 0
+        self.waitCount = 0
+        self.waitSeconds = 0.0
+        self.maxWaitSeconds = 0.0
+        self.overflowCount = 0
+        self.timeoutCount = 0
+        self._overflowSemaphore = BoundedSemaphore(maxOverflow)
+        self._lock = Lock()
+        try:
+            self._pool = MySQLConnectionPool(
+                pool_name=DBPOOL_NAME,
+                pool_size=size,
+                pool_reset_session=True,
+                **self._connectionConfig,
+            )
+        except DatabaseError as e:
+            LOGGER.error(f"can't connect to DB! reason: {e.msg}")
+            raise e
+        LOGGER.info(f"created DB connection pool. size: {size}, overflow: {maxOverflow}")
+
+    def _acquire(self) -> tuple[PooledMySQLConnection | MySQLConnectionAbstract, bool]:
+        """
+        接続と、それが一時的な接続かどうかを返す
+        """
+        startTime = perf_counter()
+        while True:
+            try:
+                conn = self._pool.get_connection()
+                isOverflow = False
+                break
+            except PoolError:
+                pass
+            if self._overflowSemaphore.acquire(blocking=False):
+                try:
+                    conn = connect(**self._connectionConfig)
+                except DatabaseError as e:
+                    self._overflowSemaphore.release()
+                    LOGGER.error(f"can't connect to DB! reason: {e.msg}")
+                    raise e
+                isOverflow = True
+                break
+            if perf_counter() - startTime >= self.timeout:
+                with self._lock:
+                    self.timeoutCount += 1
+                raise PoolError(
+                    f"couldn't get a DB connection in {self.timeout}s. pool exhausted"
+                )
+            sleep(DBPOOL_POLL_SECONDS)
+        waited = perf_counter() - startTime
+        with self._lock:
+            self.borrowCount += 1
+            if isOverflow:
+                self.overflowCount += 1
+            if waited >= DBPOOL_POLL_SECONDS:
+                self.waitCount += 1
+                self.waitSeconds += waited
+                self.maxWaitSeconds = max(self.maxWaitSeconds, waited)
+        return conn, isOverflow
+
+    @contextmanager
+    def borrow(
+        self,
+    ) -> Generator[PooledMySQLConnection | MySQLConnectionAbstract, None, None]:
+        """
+        接続を借りる。with文を抜けるとプールに返される(一時的な接続は閉じられる)
+        """
+        conn, isOverflow = self._acquire()
+        try:
+            yield conn
+        finally:
+            conn.close()
+            if isOverflow:
+                self._overflowSemaphore.release()
+
+    def getStats(self) -> PoolStats:
+        with self._lock:
+            return PoolStats(
+                self.borrowCount,
+                self.waitCount,
+                self.waitSeconds,
+                self.maxWaitSeconds,
+                self.overflowCount,
+                self.timeoutCount,
+            )
+
+
+@lru_cache(maxsize=1)
+def getConnectionPool() -> ConnectionPool:
+    """
+    プロセス内で共有する接続プールを取得する。初回の呼び出しで作られる
+    """
+    poolConfig = getPoolConfig()
+    return ConnectionPool(
+        int(poolConfig["size"]),
+        int(poolConfig["maxOverflow"]),
+        float(poolConfig["timeout"]),
+    )
+
+
+def borrowConnection():
+    """
+    共有の接続プールから接続を借りる。with文で使う
+    """
+    return getConnectionPool().borrow()
+
+
 def get_select(
     query: str,
     conn: Optional[PooledMySQLConnection | MySQLConnectionAbstract] = None,
+    params: Optional[Union[tuple[Any, ...], dict[str, Any]]] = None,
 ) -> List[Dict[str, Any]]:
-    conn = getConnectionToDB(conn)
+    """
+    conn を省略した場合は、接続プールから借りて実行後に返す。
+    渡された接続は閉じない
+    """
+    if conn is None:
+        with borrowConnection() as conn:
+            return get_select(query, conn, params)
+    notifyQuery(query)
     try:
         cursor = conn.cursor()
         cursor = conn.cursor(dictionary=True)
-        cursor.execute(query)
+        cursor.execute(query, params)
     except MysqlProgrammingError as e:
         LOGGER.error(f"couldn't run a query: {query}. reason: {e.msg}")
         conn.rollback()
     finally:
         data = cast(List[Dict[str, Any]], cursor.fetchall())
         cursor.close()
-        conn.close()
     return data
 
+def iterate_select(
+    query: str,
+    params: Optional[Union[tuple[Any, ...], dict[str, Any]]] = None,
+    batchSize: int = DBSTREAM_BATCH_SIZE,
+    conn: Optional[PooledMySQLConnection | MySQLConnectionAbstract] = None,
+) -> Generator[List[Dict[str, Any]], None, None]:
+    """
+    結果を batchSize 行ずつ返す。:func:`get_select` と違い、サーバー側から少しずつ読むので
+    結果の大きさに関わらずメモリは batchSize 行分しか使わない。
+    conn を省略した場合は、接続プールから借りて、最後まで読んだ後に返す。渡された接続は閉じない
+    """
+    if conn is None:
+        with borrowConnection() as conn:
+            yield from iterate_select(query, params, batchSize, conn)
+        return
+    notifyQuery(query)
+    cursor = conn.cursor(dictionary=True, buffered=False)
+    try:
+        cursor.execute(query, params)
+        while True:
+            rows = cast(List[Dict[str, Any]], cursor.fetchmany(batchSize))
+            if not rows:
+                break
+            yield rows
+    finally:
+        # 途中でやめた場合も、読み残した行を捨ててから接続を返す
+        if conn.unread_result:
+            conn.consume_results()
+        cursor.close()
+
+
 def insert_query(
     query: str,
     params: Optional[Union[tuple[Any, ...], dict[str, Any]]] = None,
     conn: Optional[PooledMySQLConnection | MySQLConnectionAbstract] = None,
 ) -> Optional[int]:
-    conn = getConnectionToDB(conn)
+    """
+    conn を省略した場合は、接続プールから借りて実行後に返す。
+    渡された接続は閉じない
+    """
+    if conn is None:
+        with borrowConnection() as conn:
+            return insert_query(query, params, conn)
+    notifyQuery(query)
     last_id: Optional[int] = None
     try:
         cursor = conn.cursor()
@@ -97,9 +361,163 @@ def insert_query(
     finally:
         LOGGER.warning(f"Could run query!")
         cursor.close()
-        conn.close()
     return last_id
 
+# 複数行のINSERTで採番されるidの間隔。連番にならない設定ならNone。プロセス内で一度だけ調べる
+_autoIncrementStep: Optional[int] = None
+_isAutoIncrementChecked = False
+_autoIncrementLock = Lock()
+# 表ごとの自動採番の列。プロセス内で一度だけ調べる
+_autoIncrementColumns: Dict[str, Optional[str]] = {}
+INSERTTABLEPATTERN = reCompile(r"^\s*INSERT\s+INTO\s+`?(\w+)`?", IGNORECASE)
+
+
+def getAutoIncrementStep(
+    conn: PooledMySQLConnection | MySQLConnectionAbstract,
+) -> Optional[int]:
+    """
+    1文で挿入した複数の行のidが、lastrowid から auto_increment_increment おきに並ぶならその間隔を返す。
+    innodb_autoinc_lock_mode が2(MySQL 8の既定)だと、同時に挿入する他の接続とidが入り混じるのでNone
+    """
+    global _autoIncrementStep, _isAutoIncrementChecked
+    with _autoIncrementLock:
+        if not _isAutoIncrementChecked:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(
+                    "SELECT @@innodb_autoinc_lock_mode, @@auto_increment_increment"
+                )
+                lockMode, increment = cast(tuple[int, int], cursor.fetchone())
+            finally:
+                cursor.close()
+            _autoIncrementStep = int(increment) if int(lockMode) in (0, 1) else None
+            _isAutoIncrementChecked = True
+            if _autoIncrementStep is None:
+                LOGGER.info(
+                    f"innodb_autoinc_lock_mode is {lockMode}. bulk inserts re-select their ids"
+                )
+        return _autoIncrementStep
+
+
+def getAutoIncrementColumn(
+    tableName: str, conn: PooledMySQLConnection | MySQLConnectionAbstract
+) -> Optional[str]:
+    """
+    表の自動採番の列名。無ければNone
+    """
+    with _autoIncrementLock:
+        if tableName not in _autoIncrementColumns:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(
+                    "SELECT COLUMN_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND EXTRA LIKE %s",
+                    (tableName, "%auto_increment%"),
+                )
+                row = cursor.fetchone()
+            finally:
+                cursor.close()
+            _autoIncrementColumns[tableName] = (
+                str(cast(tuple[Any, ...], row)[0]) if row else None
+            )
+        return _autoIncrementColumns[tableName]
+
+
+def _selectInsertedIds(
+    cursor: Any, tableName: str, idColumn: str, firstId: int, rowCount: int
+) -> List[Optional[int]]:
+    """
+    挿入の前に取った一貫性のあるスナップショットの中で、firstId 以上のidを主キーの範囲で読み直す。
+    挿入より前に採番されたidは全て firstId より小さく、スナップショットの後に他の接続がコミットした行は見えないので、
+    見えるのはこのトランザクションで挿入した行だけになる。数が合わなければ全てNone
+    """
+    cursor.execute(
+        f"SELECT {idColumn} FROM {tableName} WHERE {idColumn} >= %s ORDER BY {idColumn} LIMIT %s",
+        (firstId, rowCount + 1),
+    )
+    ids = [int(row[0]) for row in cursor.fetchall()]
+    if len(ids) != rowCount:
+        LOGGER.warning(
+            f"expected {rowCount} inserted rows in {tableName} from id {firstId}, found {len(ids)}"
+        )
+        return [None] * rowCount
+    return list(ids)
+
+
+def bulk_insert_query(
+    query: str,
+    paramsList: Iterable[tuple[Any, ...]],
+    batchSize: int = DBBULK_BATCH_SIZE,
+    conn: Optional[PooledMySQLConnection | MySQLConnectionAbstract] = None,
+) -> List[Optional[int]]:
+    """
+    同じINSERT文を batchSize 行ずつ executemany でまとめて実行する。
+    INSERT ... VALUES はコネクタが複数行のVALUESに書き換えるので、1バッチ1往復・1トランザクションになる。
+    自動採番されたidを入力と同じ順に返す。失敗したバッチはロールバックし、その行のidはNoneになる。
+    idが連番で割り当てられる設定でない場合(:func:`getAutoIncrementStep`)も複数行のまま挿入し、
+    バッチごとに一貫性のあるスナップショットでトランザクションを始めて、:func:`_selectInsertedIds` でidを読み直す。
+    conn を省略した場合は、接続プールから借りて実行後に返す。渡された接続は閉じない
+    """
+    if conn is None:
+        with borrowConnection() as conn:
+            return bulk_insert_query(query, paramsList, batchSize, conn)
+    ids: List[Optional[int]] = []
+    paramsIterator = iter(paramsList)
+    step = getAutoIncrementStep(conn)
+    tableName: Optional[str] = None
+    idColumn: Optional[str] = None
+    if step is None:
+        match = INSERTTABLEPATTERN.match(query)
+        if match is not None:
+            tableName = match.group(1)
+            idColumn = getAutoIncrementColumn(tableName, conn)
+        if idColumn is None:
+            LOGGER.warning(f"couldn't find the auto increment column for: {query}")
+    cursor = conn.cursor()
+    try:
+        while True:
+            batch = list(islice(paramsIterator, batchSize))
+            if not batch:
+                break
+            batchIds: List[Optional[int]] = []
+            try:
+                if step is None:
+                    # 挿入より前のスナップショットにするため、先にトランザクションを始める
+                    if conn.in_transaction:
+                        conn.commit()
+                    conn.start_transaction(
+                        consistent_snapshot=True, isolation_level="REPEATABLE READ"
+                    )
+                notifyQuery(query)
+                cursor.executemany(query, batch)
+                firstId = cursor.lastrowid
+                rowCount = cursor.rowcount
+                if not firstId or rowCount != len(batch):
+                    batchIds = [None] * len(batch)
+                elif step is not None:
+                    # lock_mode 0/1 では、1文で挿入した行のidは step おきに連続して割り当てられる
+                    batchIds = list(range(firstId, firstId + rowCount * step, step))
+                elif tableName is not None and idColumn is not None:
+                    batchIds = _selectInsertedIds(
+                        cursor, tableName, idColumn, firstId, rowCount
+                    )
+                else:
+                    batchIds = [None] * len(batch)
+                conn.commit()
+            except DatabaseError as e:
+                LOGGER.error(
+                    f"couldn't insert a batch of {len(batch)} rows: {query}. reason: {e.msg}"
+                )
+                conn.rollback()
+                ids.extend([None] * len(batch))
+                continue
+            ids.extend(batchIds)
+    finally:
+        cursor.close()
+    LOGGER.info(
+        f"bulk inserted {sum(id is not None for id in ids)}/{len(ids)} rows, {batchSize} rows per batch"
+    )
+    return ids
+
 def delete_db(
     conn: Optional[PooledMySQLConnection | MySQLConnectionAbstract] = None,
 ):
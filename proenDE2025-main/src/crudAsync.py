@@ -0,0 +1,253 @@
+"""
+DBへの非同期アクセス。FastAPIのハンドラから、イベントループを止めずにDBを読み書きするのに使う。
+
+mysql.connector の asyncio 版(mysql.connector.aio)には接続プールが無いので、ここで用意する。
+プールは最初に使われたイベントループに結びつく。
+"""
+
+from __future__ import annotations
+from asyncio import Lock, LifoQueue, TimeoutError as AsyncTimeoutError, wait_for
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from time import perf_counter
+from typing import Any, AsyncGenerator, Dict, List, Optional, Union, cast
+
+from logging import getLogger
+
+from mysql.connector.aio import connect
+from mysql.connector.aio.abstracts import MySQLConnectionAbstract
+from mysql.connector.errors import (
+    ProgrammingError as MysqlProgrammingError,
+    DatabaseError,
+    PoolError,
+)
+
+from crud import (
+    getDBConfig,
+    getPoolConfig,
+    notifyQuery,
+    PoolStats,
+    DBPOOL_POLL_SECONDS,
+    DBSTREAM_BATCH_SIZE,
+)
+
+LOGGER = getLogger("BicycleCheck.db")
+
+
+class AsyncConnectionPool(object):
+    """
+    mysql.connector.aio の接続プール。
+    接続は必要になった時に size 個まで作り、それ以上は timeout 秒まで返却を待つ。
+    返された接続は、開いているトランザクションをロールバックしてから次に貸す。
+    借りるまでに待たされた時間を記録する。
+    """
+
+    size: int
+    timeout: float
+    borrowCount: int
+    waitCount: int
+    waitSeconds: float
+    maxWaitSeconds: float
+    timeoutCount: int
+    _connectionConfig: dict[str, Any]
+    _idleConnections: Optional[LifoQueue[MySQLConnectionAbstract]]
+    _createdCount: int
+    _lock: Optional[Lock]
+
+    def __init__(self, size: int, timeout: float) -> None:
+        dbconfig = getDBConfig()
+        self._connectionConfig = {
+            "host": dbconfig["host"],
+            "user": dbconfig["user"],
+            "password": dbconfig["password"],
+            "database": dbconfig["database"],
+        }
+        self.size = size
+        self.timeout = timeout
+        self.borrowCount = 0
+        self.waitCount = 0
+        self.waitSeconds = 0.0
+        self.maxWaitSeconds = 0.0
+        self.timeoutCount = 0
+        self._idleConnections = None
+        self._createdCount = 0
+        self._lock = None
+
+    def _getIdleConnections(self) -> LifoQueue[MySQLConnectionAbstract]:
+        # asyncioのオブジェクトは、イベントループの中で作る
+        if self._idleConnections is None:
+            self._idleConnections = LifoQueue(maxsize=self.size)
+            self._lock = Lock()
+        return self._idleConnections
+
+    async def _acquire(self) -> MySQLConnectionAbstract:
+        idleConnections = self._getIdleConnections()
+        assert self._lock is not None
+        startTime = perf_counter()
+        conn: Optional[MySQLConnectionAbstract] = None
+        if idleConnections.empty():
+            async with self._lock:
+                isCreatable = self._createdCount < self.size
+                if isCreatable:
+                    self._createdCount += 1
+            if isCreatable:
+                try:
+                    conn = await connect(**self._connectionConfig)
+                except DatabaseError as e:
+                    async with self._lock:
+                        self._createdCount -= 1
+                    LOGGER.error(f"can't connect to DB! reason: {e.msg}")
+                    raise e
+        if conn is None:
+            try:
+                conn = await wait_for(idleConnections.get(), self.timeout)
+            except AsyncTimeoutError as e:
+                self.timeoutCount += 1
+                raise PoolError(
+                    f"couldn't get a DB connection in {self.timeout}s. pool exhausted"
+                ) from e
+        waited = perf_counter() - startTime
+        self.borrowCount += 1
+        if waited >= DBPOOL_POLL_SECONDS:
+            self.waitCount += 1
+            self.waitSeconds += waited
+            self.maxWaitSeconds = max(self.maxWaitSeconds, waited)
+        return conn
+
+    async def _release(self, conn: MySQLConnectionAbstract) -> None:
+        if await conn.is_connected():
+            # SELECTだけでもトランザクションが始まり、REPEATABLE READ では開いたままだと
+            # 次に借りた時も古いスナップショットを読んでしまう。同期版の pool_reset_session に相当する
+            try:
+                if conn.unread_result:
+                    await conn.consume_results()
+                await conn.rollback()
+            except DatabaseError as e:
+                LOGGER.warning(f"couldn't reset a DB connection. discarding it. reason: {e.msg}")
+                await conn.close()
+            else:
+                self._getIdleConnections().put_nowait(conn)
+                return
+        # 切れた接続は捨て、次に必要になった時に作り直す
+        assert self._lock is not None
+        async with self._lock:
+            self._createdCount -= 1
+
+    @asynccontextmanager
+    async def borrow(self) -> AsyncGenerator[MySQLConnectionAbstract, None]:
+        """
+        接続を借りる。async with文を抜けるとプールに返される
+        """
+        conn = await self._acquire()
+        try:
+            yield conn
+        finally:
+            await self._release(conn)
+
+    def getStats(self) -> PoolStats:
+        return PoolStats(
+            self.borrowCount,
+            self.waitCount,
+            self.waitSeconds,
+            self.maxWaitSeconds,
+            0,
+            self.timeoutCount,
+        )
+
+
+@lru_cache(maxsize=1)
+def getAsyncConnectionPool() -> AsyncConnectionPool:
+    """
+    プロセス内で共有する非同期の接続プールを取得する。
+    溢れた分の一時接続は作らず、同期版のプールの size と maxOverflow の合計を上限とする
+    """
+    poolConfig = getPoolConfig()
+    return AsyncConnectionPool(
+        int(poolConfig["size"]) + int(poolConfig["maxOverflow"]),
+        float(poolConfig["timeout"]),
+    )
+
+
+def borrowConnectionAsync():
+    """
+    共有の非同期接続プールから接続を借りる。async with文で使う
+    """
+    return getAsyncConnectionPool().borrow()
+
+
+async def get_select_async(
+    query: str,
+    params: Optional[Union[tuple[Any, ...], dict[str, Any]]] = None,
+    conn: Optional[MySQLConnectionAbstract] = None,
+) -> List[Dict[str, Any]]:
+    """
+    :func:`crud.get_select` の非同期版。
+    conn を省略した場合は、接続プールから借りて実行後に返す。渡された接続は閉じない
+    """
+    if conn is None:
+        async with borrowConnectionAsync() as conn:
+            return await get_select_async(query, params, conn)
+    notifyQuery(query)
+    data: List[Dict[str, Any]] = []
+    async with await conn.cursor(dictionary=True) as cursor:
+        try:
+            await cursor.execute(query, params)
+            data = cast(List[Dict[str, Any]], await cursor.fetchall())
+        except MysqlProgrammingError as e:
+            LOGGER.error(f"couldn't run a query: {query}. reason: {e.msg}")
+            await conn.rollback()
+    return data
+
+
+async def iterate_select_async(
+    query: str,
+    params: Optional[Union[tuple[Any, ...], dict[str, Any]]] = None,
+    batchSize: int = DBSTREAM_BATCH_SIZE,
+    conn: Optional[MySQLConnectionAbstract] = None,
+) -> AsyncGenerator[List[Dict[str, Any]], None]:
+    """
+    :func:`crud.iterate_select` の非同期版。結果をサーバー側から batchSize 行ずつ読んで返す
+    """
+    if conn is None:
+        async with borrowConnectionAsync() as conn:
+            async for rows in iterate_select_async(query, params, batchSize, conn):
+                yield rows
+        return
+    notifyQuery(query)
+    cursor = await conn.cursor(dictionary=True, buffered=False)
+    try:
+        await cursor.execute(query, params)
+        while True:
+            rows = cast(List[Dict[str, Any]], await cursor.fetchmany(batchSize))
+            if not rows:
+                break
+            yield rows
+    finally:
+        if conn.unread_result:
+            await conn.consume_results()
+        await cursor.close()
+
+
+async def insert_query_async(
+    query: str,
+    params: Optional[Union[tuple[Any, ...], dict[str, Any]]] = None,
+    conn: Optional[MySQLConnectionAbstract] = None,
+) -> Optional[int]:
+    """
+    :func:`crud.insert_query` の非同期版。
+    conn を省略した場合は、接続プールから借りて実行後に返す。渡された接続は閉じない
+    """
+    if conn is None:
+        async with borrowConnectionAsync() as conn:
+            return await insert_query_async(query, params, conn)
+    notifyQuery(query)
+    last_id: Optional[int] = None
+    async with await conn.cursor() as cursor:
+        try:
+            await cursor.execute(query, params)
+            await conn.commit()
+            last_id = cursor.lastrowid
+        except MysqlProgrammingError as e:
+            LOGGER.error(f"Couldn't run query: {query}. reason: {e.msg}")
+            await conn.rollback()
+    return last_id
@@ -0,0 +1,132 @@
+"""
+発見事例の書き出し。管区と期間を指定して、NDJSONまたはCSVで全件を書き出す。
+
+DBからは :meth:`schemas.BicycleDetect.iterateExport` で少しずつ読み、読んだ分だけ文字列にして返すので、
+件数に関わらずメモリの使用量は一定になる。APIの書き出しエンドポイントからも使う。
+
+リポジトリのルートで実行する:
+python src/detectExport.py --district 1 --since 2025-08-01 --until 2025-09-01 --format csv --output tmp/detections.csv
+"""
+
+from __future__ import annotations
+from argparse import ArgumentParser
+from csv import DictWriter
+from datetime import datetime
+from io import StringIO
+from json import dumps as jsonDumps
+from pathlib import Path
+from time import perf_counter
+from typing import Any, AsyncGenerator, AsyncIterable, Generator, Iterable, Optional
+import sys
+
+from logging import getLogger
+from logging.config import dictConfig
+
+from yaml import FullLoader, load as loadYaml
+
+from schemas import BicycleDetect, DetectFilter, DETECT_COLUMNS_BY_FIELD
+
+logger = getLogger("BicycleCheck.export")
+
+EXPORTFORMATS = ("ndjson", "csv")
+EXPORTFIELDS = list(DETECT_COLUMNS_BY_FIELD)
+
+
+def getMediaType(format: str) -> str:
+    return "text/csv" if format == "csv" else "application/x-ndjson"
+
+
+def _toJsonValue(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"not serializable: {type(value)}")
+
+
+def formatRows(rows: list[dict[str, Any]], format: str, isFirst: bool) -> str:
+    """
+    一まとまりの行を文字列にする。CSVの場合、最初のまとまりには見出し行をつける
+    """
+    if format == "csv":
+        buffer = StringIO()
+        writer = DictWriter(buffer, EXPORTFIELDS)
+        if isFirst:
+            writer.writeheader()
+        writer.writerows(rows)
+        return buffer.getvalue()
+    return "".join(
+        jsonDumps(row, default=_toJsonValue, ensure_ascii=False) + "\n" for row in rows
+    )
+
+
+def iterateChunks(
+    batches: Iterable[list[dict[str, Any]]], format: str
+) -> Generator[str, None, None]:
+    isFirst = True
+    for rows in batches:
+        yield formatRows(rows, format, isFirst)
+        isFirst = False
+    if isFirst and format == "csv":
+        # 結果が無くても見出し行は書く
+        yield formatRows([], format, True)
+
+
+async def iterateChunksAsync(
+    batches: AsyncIterable[list[dict[str, Any]]], format: str
+) -> AsyncGenerator[str, None]:
+    """
+    :func:`iterateChunks` の非同期版。StreamingResponse に渡す
+    """
+    isFirst = True
+    async for rows in batches:
+        yield formatRows(rows, format, isFirst)
+        isFirst = False
+    if isFirst and format == "csv":
+        yield formatRows([], format, True)
+
+
+def exportDetects(
+    output,
+    district_id: Optional[int],
+    filter: DetectFilter,
+    format: str,
+    batchSize: int,
+) -> int:
+    """
+    条件に合う発見事例を output に書き出し、書き出した件数を返す
+    """
+    rowCount = 0
+
+    def countRows():
+        nonlocal rowCount
+        for rows in BicycleDetect.iterateExport(district_id, filter, batchSize):
+            rowCount += len(rows)
+            yield rows
+
+    for chunk in iterateChunks(countRows(), format):
+        output.write(chunk)
+    return rowCount
+
+
+def main() -> None:
+    parser = ArgumentParser(description="export bicycle detections")
+    parser.add_argument("--district", type=int, default=None, dest="districtId")
+    parser.add_argument("--since", type=datetime.fromisoformat, default=None)
+    parser.add_argument("--until", type=datetime.fromisoformat, default=None)
+    parser.add_argument("--format", choices=EXPORTFORMATS, default="ndjson")
+    parser.add_argument("--output", type=Path, default=None, help="defaults to stdout")
+    parser.add_argument("--batch-size", type=int, default=1000, dest="batchSize")
+    args = parser.parse_args()
+    filter = DetectFilter(since=args.since, until=args.until)
+    startTime = perf_counter()
+    if args.output is None:
+        rowCount = exportDetects(sys.stdout, args.districtId, filter, args.format, args.batchSize)
+    else:
+        with open(args.output, "w", encoding="UTF-8", newline="") as file:
+            rowCount = exportDetects(file, args.districtId, filter, args.format, args.batchSize)
+    logger.info(f"exported {rowCount} detections in {perf_counter() - startTime:.1f}s")
+
+
+if __name__ == "__main__":
+    with open(Path("configs/log_conf.yaml"), "r", encoding="UTF-8") as configFile:
+        dictConfig(loadYaml(configFile.read(), FullLoader))
+    main()
@@ -0,0 +1,142 @@
+"""
+抽出したフレームの画像ファイルへの書き出し。
+
+エンコード(cv2.imencode)はスレッドプールで並列に行う。OpenCVはエンコード中にGILを手放すので、
+スレッドでも複数コアを使える。フレームはジェネレータから順に受け取り、
+処理待ちのフレームは上限(maxPending)までしか溜めないので、全フレームをメモリに載せることはない。
+書き込みは一時ファイルに書いてから置き換えるので、途中で止まっても壊れたファイルは残らない。
+"""
+
+from __future__ import annotations
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from time import perf_counter
+from typing import Generator, Iterable, NamedTuple, Optional
+import os
+
+from logging import getLogger
+
+import cv2
+from cv2.typing import MatLike
+
+logger = getLogger("BicycleCheck.framewriter")
+
+JPEGQUALITY = 90
+WEBPQUALITY = 80
+
+
+class FrameWriteException(Exception):
+    pass
+
+
+class FrameEncoding(NamedTuple):
+    """
+    画像の形式。extension はドットなしの拡張子、params は cv2.imencode に渡すパラメータ
+    """
+
+    extension: str
+    params: tuple[int, ...]
+
+    @classmethod
+    def jpeg(cls, quality: int = JPEGQUALITY) -> FrameEncoding:
+        return cls("jpg", (cv2.IMWRITE_JPEG_QUALITY, quality))
+
+    @classmethod
+    def webp(cls, quality: int = WEBPQUALITY) -> FrameEncoding:
+        return cls("webp", (cv2.IMWRITE_WEBP_QUALITY, quality))
+
+
+class WrittenFrame(NamedTuple):
+    path: Path
+    byteCount: int
+    encodeSeconds: float
+
+
+class FrameWriter(object):
+    """
+    フレームをスレッドプールでエンコードして書き出すクラス。with文で使う。
+    """
+
+    encoding: FrameEncoding
+    workerCount: int
+    maxPending: int
+    frameCount: int
+    byteCount: int
+    encodeSeconds: float
+    _executor: ThreadPoolExecutor
+
+    def __init__(
+        self,
+        encoding: Optional[FrameEncoding] = None,
+        workerCount: Optional[int] = None,
+        maxPending: Optional[int] = None,
+    ) -> None:
+        self.encoding = encoding if encoding is not None else FrameEncoding.jpeg()
+        self.workerCount = workerCount if workerCount is not None else os.cpu_count() or 1
+        self.maxPending = maxPending if maxPending is not None else self.workerCount * 2
+        self.frameCount = 0
+        self.byteCount = 0
+        self.encodeSeconds = 0.0
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workerCount, thread_name_prefix="framewriter"
+        )
+
+    def __enter__(self) -> FrameWriter:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._executor.shutdown()
+
+    def getPath(self, targetDir: Path, name: str) -> Path:
+        """
+        拡張子を除いたファイル名から、この形式での書き出し先を求める
+        """
+        return targetDir.joinpath(f"{name}.{self.encoding.extension}")
+
+    def _writeFrame(self, path: Path, frame: MatLike) -> WrittenFrame:
+        startTime = perf_counter()
+        ret, buffer = cv2.imencode(
+            f".{self.encoding.extension}", frame, list(self.encoding.params)
+        )
+        encodeSeconds = perf_counter() - startTime
+        if not ret:
+            raise FrameWriteException(f"couldn't encode frame into {path}")
+        temporaryPath = path.with_name(f".{path.name}.tmp")
+        with open(temporaryPath, "wb") as file:
+            file.write(buffer.tobytes())
+        os.replace(temporaryPath, path)
+        logger.debug(
+            f"written {path.name}: {buffer.nbytes} bytes, encoded in {encodeSeconds * 1000:.1f}ms"
+        )
+        return WrittenFrame(path, buffer.nbytes, encodeSeconds)
+
+    def _collect(self, future: Future[WrittenFrame]) -> WrittenFrame:
+        written = future.result()
+        self.frameCount += 1
+        self.byteCount += written.byteCount
+        self.encodeSeconds += written.encodeSeconds
+        return written
+
+    def writeFrames(
+        self, frames: Iterable[tuple[Path, MatLike]]
+    ) -> Generator[WrittenFrame, None, None]:
+        """
+        (書き出し先, フレーム) の列を書き出し、書き出した結果を入力と同じ順に返す。
+        書き出し先のディレクトリは事前に作っておくこと
+        """
+        pending: deque[Future[WrittenFrame]] = deque()
+        for path, frame in frames:
+            if len(pending) >= self.maxPending:
+                yield self._collect(pending.popleft())
+            pending.append(self._executor.submit(self._writeFrame, path, frame))
+        while pending:
+            yield self._collect(pending.popleft())
+
+    def getSummary(self) -> str:
+        averageBytes = self.byteCount / self.frameCount if self.frameCount else 0
+        averageSeconds = self.encodeSeconds / self.frameCount if self.frameCount else 0
+        return f"{self.frameCount} frames, {self.byteCount} bytes ({averageBytes:.0f} bytes/frame), encode {averageSeconds * 1000:.1f}ms/frame"
@@ -0,0 +1,50 @@
+"""
+緯度経度の計算。
+"""
+
+from math import asin, cos, radians, sin, sqrt
+
+import numpy as np
+
+EARTHRADIUS = 6371008.8
+
+
+def getHaversineMeters(
+    latitudes1: np.ndarray | float,
+    longitudes1: np.ndarray | float,
+    latitudes2: np.ndarray | float,
+    longitudes2: np.ndarray | float,
+) -> np.ndarray:
+    """
+    十進度の緯度経度の組どうしの大円距離(メートル)をまとめて求める
+    """
+    phi1 = np.radians(latitudes1)
+    phi2 = np.radians(latitudes2)
+    deltaPhi = phi2 - phi1
+    deltaLambda = np.radians(np.subtract(longitudes2, longitudes1))
+    haversine = (
+        np.sin(deltaPhi / 2) ** 2
+        + np.cos(phi1) * np.cos(phi2) * np.sin(deltaLambda / 2) ** 2
+    )
+    return 2 * EARTHRADIUS * np.arcsin(np.sqrt(np.clip(haversine, 0, 1)))
+
+
+def getMetersPerDegree(latitude: float) -> tuple[float, float]:
+    """
+    指定した緯度での、経度1度と緯度1度あたりの距離(メートル)
+    """
+    metersPerLatitude = np.pi * EARTHRADIUS / 180
+    return metersPerLatitude * float(np.cos(np.radians(latitude))), metersPerLatitude
+
+
+def getDistanceMeters(x1: float, y1: float, x2: float, y2: float) -> float:
+    """
+    経度x・緯度yの2点間の大円距離(メートル)。1組だけならnumpyを使うより速い
+    """
+    phi1 = radians(y1)
+    phi2 = radians(y2)
+    haversine = (
+        sin((phi2 - phi1) / 2) ** 2
+        + cos(phi1) * cos(phi2) * sin(radians(x2 - x1) / 2) ** 2
+    )
+    return 2 * EARTHRADIUS * asin(sqrt(min(max(haversine, 0.0), 1.0)))
@@ -0,0 +1,162 @@
+"""
+MP4のボックス(アトム)構造の索引。
+
+ボックスのヘッダ(サイズと種類)だけを読んで次のボックスへ読み飛ばすので、
+ファイルの大きさに関わらず数KBしか読まない。
+ドラレコ独自のGPSデータ(CSMDAT)がどこに、どれだけの長さで入っているかを求めるのに使う。
+
+実際のドラレコのファイルでは、moov の後ろに 'A' で埋めた領域があり、それが "AAAA" という種類の
+巨大なボックスとして読める。CSMDATはその途中(ファイル末尾から CSMDATTAILOFFSET バイト手前)にあるので、
+ボックスの先頭に見つからなければ、まずその位置を確かめる。そこにも無い場合に限り、
+moov より後ろをファイル末尾から順に探す(この場合は数百KB以上を読む)。
+"""
+
+from __future__ import annotations
+from functools import lru_cache
+from pathlib import Path
+from struct import unpack
+from typing import NamedTuple, Optional
+import os
+
+from logging import getLogger
+
+logger = getLogger("BicycleCheck.mp4box")
+
+CSMDATMAGIC = b"CSMDAT"
+# 中身にさらにボックスを持つ種類。CSMDATを探す際はこの中も見る
+CONTAINERTYPES = {b"moov", b"udta", b"trak", b"mdia", b"minf"}
+# ボックスの先頭から何バイトの範囲でCSMDATを探すか
+MAGICSEARCHSIZE = 64
+# ドラレコのファイルで、CSMDATがファイル末尾から何バイト手前にあるか(VID1 / VID3 で共通)
+CSMDATTAILOFFSET = 598068
+# ファイル末尾から探す時に一度に読む大きさ
+TAILSEARCHCHUNKSIZE = 1 << 20
+# これらのボックスより後ろを、ファイル末尾から探す
+TAILSEARCHAFTERTYPES = {b"moov", b"mdat"}
+
+
+class Mp4Box(NamedTuple):
+    boxType: bytes
+    offset: int
+    size: int
+    headerSize: int
+    depth: int
+
+    def getEnd(self) -> int:
+        return self.offset + self.size
+
+
+class Mp4Payload(NamedTuple):
+    offset: int
+    size: int
+
+
+def _readBoxes(file, start: int, end: int, depth: int) -> list[Mp4Box]:
+    boxes: list[Mp4Box] = []
+    offset = start
+    while offset + 8 <= end:
+        file.seek(offset, os.SEEK_SET)
+        header = file.read(8)
+        if len(header) < 8:
+            break
+        size, boxType = unpack(">I4s", header)
+        headerSize = 8
+        if size == 1:
+            # 64bit長のボックス
+            largeSize = file.read(8)
+            if len(largeSize) < 8:
+                break
+            size = unpack(">Q", largeSize)[0]
+            headerSize = 16
+        elif size == 0:
+            # ファイル末尾まで続くボックス
+            size = end - offset
+        if size < headerSize:
+            logger.warning(f"broken box header at {offset}. stop scanning")
+            break
+        # 途中で切れたファイルでは、ボックスがファイル末尾を超えることがある
+        size = min(size, end - offset)
+        box = Mp4Box(boxType, offset, size, headerSize, depth)
+        boxes.append(box)
+        if boxType in CONTAINERTYPES:
+            boxes.extend(
+                _readBoxes(file, offset + headerSize, box.getEnd(), depth + 1)
+            )
+        offset += size
+    return boxes
+
+
+@lru_cache(maxsize=1024)
+def _getBoxesCached(path: str, fileSize: int, mtime: int) -> tuple[Mp4Box, ...]:
+    with open(path, mode="rb") as file:
+        return tuple(_readBoxes(file, 0, fileSize, 0))
+
+
+def getBoxes(path: Path) -> tuple[Mp4Box, ...]:
+    """
+    ファイル内の全ボックスを、入れ子も含めて出現順に取得する。
+    同じファイル(パス・サイズ・更新日時が同じ)に対する結果はキャッシュされる。
+    """
+    stat = path.stat()
+    return _getBoxesCached(str(path.absolute()), stat.st_size, stat.st_mtime_ns)
+
+
+def _searchBackward(file, start: int, end: int) -> Optional[int]:
+    """
+    [start, end) の範囲を末尾から TAILSEARCHCHUNKSIZE ずつ読み、最後に現れるCSMDATの位置を返す。
+    読む範囲は前の範囲と少し重ね、境目にかかるものも見つける
+    """
+    overlap = len(CSMDATMAGIC) - 1
+    chunkEnd = end
+    while chunkEnd > start:
+        chunkStart = max(start, chunkEnd - TAILSEARCHCHUNKSIZE)
+        file.seek(chunkStart, os.SEEK_SET)
+        chunk = file.read(chunkEnd - chunkStart + overlap)
+        position = chunk.rfind(CSMDATMAGIC)
+        if position >= 0:
+            return chunkStart + position
+        chunkEnd = chunkStart
+    return None
+
+
+@lru_cache(maxsize=1024)
+def _findCsmdatCached(path: str, fileSize: int, mtime: int) -> Optional[Mp4Payload]:
+    boxes = _getBoxesCached(path, fileSize, mtime)
+    with open(path, mode="rb") as file:
+        for box in boxes:
+            if box.boxType in CONTAINERTYPES:
+                continue
+            file.seek(box.offset, os.SEEK_SET)
+            head = file.read(min(MAGICSEARCHSIZE, box.size))
+            position = head.find(CSMDATMAGIC)
+            if position < 0:
+                continue
+            offset = box.offset + position
+            return Mp4Payload(offset, box.getEnd() - offset)
+        # ボックスの先頭に無ければ、動画本体(mdat / moov)より後ろの領域を探す。CSMDATはファイル末尾まで続く
+        tailStart = max(
+            (
+                box.getEnd()
+                for box in boxes
+                if box.depth == 0 and box.boxType in TAILSEARCHAFTERTYPES
+            ),
+            default=0,
+        )
+        offset = fileSize - CSMDATTAILOFFSET
+        if offset >= tailStart:
+            file.seek(offset, os.SEEK_SET)
+            if file.read(len(CSMDATMAGIC)) == CSMDATMAGIC:
+                return Mp4Payload(offset, fileSize - offset)
+        offset = _searchBackward(file, tailStart, fileSize)
+        if offset is None:
+            return None
+        logger.debug(f"found CSMDAT at {offset} by scanning from the end of {path}")
+        return Mp4Payload(offset, fileSize - offset)
+
+
+def findCsmdat(path: Path) -> Optional[Mp4Payload]:
+    """
+    CSMDATブロックの開始位置と、そこからボックス末尾(ファイル末尾)までの長さを求める。見つからなければNone
+    """
+    stat = path.stat()
+    return _findCsmdatCached(str(path.absolute()), stat.st_size, stat.st_mtime_ns)
@@ -2,19 +2,32 @@ from pathlib import Path
 from enum import IntEnum
 from re import findall as reFindall
 from datetime import datetime
-from typing import Optional, TypeVar, overload
-from shutil import rmtree
+from functools import lru_cache
+from itertools import count
+from typing import (
+    Generator,
+    Iterable,
+    Mapping,
+    Optional,
+    Sequence,
+    TypeVar,
+    overload,
+)
 import os
-from time import sleep
-import asyncio
+from time import perf_counter, sleep
 
 from logging import getLogger
 from logging.config import dictConfig
 
 from yaml import FullLoader, load as loadYaml
+import numpy as np
 import cv2
 from cv2.typing import MatLike
 
+from mp4box import CSMDATMAGIC, Mp4Payload, findCsmdat
+from frameWriter import FrameWriter, WrittenFrame
+from trackCache import TrackCache
+
 # hexdump -C PATH > tmp/test.txt
 
 # TODO getcoordinate with startOffset and interval
@@ -23,6 +36,10 @@ logger = getLogger("BicycleCheck.mp4file")
 
 T = TypeVar("T")
 CHUNKSIZE = 130
+HEADERSIZE = 40
+# レコードの終端(空白だけのレコード)を探す時に、一度に調べるレコード数
+RECORDSCANBLOCKSIZE = 64
+FRAMEINDEX_MAX_GAP_SECONDS = 5.0
 
 
 class FileSizes(IntEnum):
@@ -35,15 +52,15 @@ class SeekSizes(IntEnum):
     VID3M = 301391820
 
 
-class Mp4UnrecognizableException(BaseException):
+class Mp4UnrecognizableException(Exception):
     pass
 
 
-class Mp4FileException(BaseException):
+class Mp4FileException(Exception):
     pass
 
 
-class Mp4FileCoordinateDataInvalidException(BaseException):
+class Mp4FileCoordinateDataInvalidException(Exception):
     pass
 
 
@@ -53,18 +70,412 @@ coordinateType = tuple[
 ]
 
 
+def _parseDigits(columns: np.ndarray) -> np.ndarray:
+    """
+    (レコード数, 桁数) の ASCII 数字列を、列方向にまとめて整数配列にする
+    """
+    weights = 10 ** np.arange(columns.shape[1] - 1, -1, -1, dtype=np.int64)
+    return (columns.astype(np.int64) - ord("0")) @ weights
+
+
+def _isDigits(columns: np.ndarray) -> np.ndarray:
+    return np.all((columns >= ord("0")) & (columns <= ord("9")), axis=1)
+
+
+def _parseFloats(columns: np.ndarray) -> np.ndarray:
+    """
+    (レコード数, 桁数) の ASCII 小数列を float64 配列にする。数値以外はnanになる
+    """
+    width = columns.shape[1]
+    texts = np.ascontiguousarray(columns).view(f"S{width}").ravel()
+    result = np.full(len(texts), np.nan)
+    isDots = columns == ord(".")
+    isNumeric = np.all(
+        ((columns >= ord("0")) & (columns <= ord("9"))) | isDots, axis=1
+    ) & (np.count_nonzero(isDots, axis=1) <= 1)
+    result[isNumeric] = texts[isNumeric].astype(np.float64)
+    return result
+
+
+@lru_cache(maxsize=1024)
+def _countRecordsCached(
+    path: str, fileSize: int, mtime: int, offset: int, size: int
+) -> int:
+    """
+    CSMDATのレコード数。ヘッダにはレコード数が入っていないので、ブロックの長さから求めた件数を上限に、
+    先頭から RECORDSCANBLOCKSIZE 件ずつ読んで最初の空白だけのレコードを探し、その手前までとする。
+    ブロックの残りは空白で埋められているが、そこはレコードの後ろの1ブロック分しか読まない
+    """
+    capacity = max(size - HEADERSIZE, 0) // CHUNKSIZE
+    if capacity == 0:
+        return 0
+    records = np.memmap(
+        path,
+        dtype=np.uint8,
+        mode="r",
+        offset=offset + HEADERSIZE,
+        shape=(capacity, CHUNKSIZE),
+    )
+    for start in range(0, capacity, RECORDSCANBLOCKSIZE):
+        isBlanks = np.all(
+            records[start : start + RECORDSCANBLOCKSIZE] == ord(" "), axis=1
+        )
+        if isBlanks.any():
+            return start + int(isBlanks.argmax())
+    return capacity
+
+
+class Mp4Track(object):
+    """
+    CSMDATのGPSレコード列を列指向で保持するクラス。
+    1レコード1タプルの :data:`coordinateType` よりも省メモリで、numpyでまとめて扱える。
+    緯度経度は南緯・西経を負とした十進度。無効(V)レコードはnanになる。
+    """
+
+    indexes: np.ndarray
+    timestamps: np.ndarray
+    valids: np.ndarray
+    latitudes: np.ndarray
+    longitudes: np.ndarray
+    latitudeDegrees: np.ndarray
+    latitudeMinutes: np.ndarray
+    longitudeDegrees: np.ndarray
+    longitudeMinutes: np.ndarray
+    isNorths: np.ndarray
+    isEasts: np.ndarray
+
+    def __init__(
+        self,
+        indexes: np.ndarray,
+        timestamps: np.ndarray,
+        valids: np.ndarray,
+        latitudeDegrees: np.ndarray,
+        latitudeMinutes: np.ndarray,
+        isNorths: np.ndarray,
+        longitudeDegrees: np.ndarray,
+        longitudeMinutes: np.ndarray,
+        isEasts: np.ndarray,
+    ) -> None:
+        self.indexes = indexes
+        self.timestamps = timestamps
+        self.valids = valids
+        self.latitudeDegrees = latitudeDegrees
+        self.latitudeMinutes = latitudeMinutes
+        self.isNorths = isNorths
+        self.longitudeDegrees = longitudeDegrees
+        self.longitudeMinutes = longitudeMinutes
+        self.isEasts = isEasts
+        latitudes = latitudeDegrees + latitudeMinutes / 60
+        longitudes = longitudeDegrees + longitudeMinutes / 60
+        self.latitudes = np.where(
+            valids, np.where(isNorths, latitudes, -latitudes), np.nan
+        )
+        self.longitudes = np.where(
+            valids, np.where(isEasts, longitudes, -longitudes), np.nan
+        )
+
+    def __len__(self) -> int:
+        return len(self.indexes)
+
+    @classmethod
+    def fromRecords(cls, records: np.ndarray) -> "Mp4Track":
+        """
+        (レコード数, CHUNKSIZE) の uint8 配列を列ごとにまとめて解析する。
+        各列の配置は :meth:`Mp4File._parseCoordinate` の正規表現と同じ。
+        _parseCoordinate が例外になるレコード(日付が存在しないものなど)は、ログを出して飛ばす。
+        """
+        flags = records[:, 8]
+        valids = flags == ord("A")
+        timestampDigits = records[:, 34:46]
+        isParsable = (
+            _isDigits(records[:, 0:8])
+            & (valids | (flags == ord("V")))
+            & _isDigits(timestampDigits)
+        )
+        latitudeMinutes = _parseFloats(records[:, 11:18])
+        longitudeMinutes = _parseFloats(records[:, 22:29])
+        isParsable &= ~valids | (
+            _isDigits(records[:, 9:11])
+            & _isDigits(records[:, 19:22])
+            & np.isin(records[:, 18], (ord("N"), ord("S")))
+            & np.isin(records[:, 29], (ord("E"), ord("W")))
+            & ~np.isnan(latitudeMinutes)
+            & ~np.isnan(longitudeMinutes)
+        )
+        fractions = _parseFloats(records[:, 46:50])
+        isParsable &= (records[:, 46] == ord(".")) & ~np.isnan(fractions)
+
+        # strptime の %y と同じく、69以上は1900年代
+        years = _parseDigits(timestampDigits[:, 0:2])
+        years = np.where(years < 69, years + 2000, years + 1900)
+        months = _parseDigits(timestampDigits[:, 2:4])
+        days = _parseDigits(timestampDigits[:, 4:6])
+        hours = _parseDigits(timestampDigits[:, 6:8])
+        minutes = _parseDigits(timestampDigits[:, 8:10])
+        seconds = _parseDigits(timestampDigits[:, 10:12])
+        # strptime と同じく、存在しない日付・時刻(13月、2月30日、24時など)も解析できないレコードとする
+        isMonths = (months >= 1) & (months <= 12)
+        monthStarts = (years - 1970).astype("datetime64[Y]").astype("datetime64[M]") + (
+            np.where(isMonths, months, 1) - 1
+        ).astype("timedelta64[M]")
+        monthLengths = (
+            (monthStarts + 1).astype("datetime64[D]") - monthStarts.astype("datetime64[D]")
+        ).astype(np.int64)
+        isParsable &= (
+            isMonths
+            & (days >= 1)
+            & (days <= monthLengths)
+            & (hours < 24)
+            & (minutes < 60)
+            & (seconds < 60)
+        )
+
+        brokenCount = int(np.count_nonzero(~isParsable))
+        if brokenCount:
+            logger.error(f"skipped {brokenCount} unparsable coordinate records")
+            records = records[isParsable]
+            valids = valids[isParsable]
+            latitudeMinutes = latitudeMinutes[isParsable]
+            longitudeMinutes = longitudeMinutes[isParsable]
+            fractions = fractions[isParsable]
+            monthStarts = monthStarts[isParsable]
+            days = days[isParsable]
+            hours = hours[isParsable]
+            minutes = minutes[isParsable]
+            seconds = seconds[isParsable]
+
+        timestamps = monthStarts.astype("datetime64[D]") + (days - 1).astype(
+            "timedelta64[D]"
+        )
+        timestamps = (
+            timestamps.astype("datetime64[us]")
+            + ((hours * 3600 + minutes * 60 + seconds) * 1_000_000).astype(
+                "timedelta64[us]"
+            )
+            + np.rint(fractions * 1_000_000).astype("timedelta64[us]")
+        )
+
+        latitudeDegrees = np.where(valids, _parseDigits(records[:, 9:11]), 0)
+        longitudeDegrees = np.where(valids, _parseDigits(records[:, 19:22]), 0)
+        return cls(
+            indexes=_parseDigits(records[:, 0:8]),
+            timestamps=timestamps,
+            valids=valids,
+            latitudeDegrees=latitudeDegrees,
+            latitudeMinutes=np.where(valids, latitudeMinutes, 0.0),
+            isNorths=records[:, 18] == ord("N"),
+            longitudeDegrees=longitudeDegrees,
+            longitudeMinutes=np.where(valids, longitudeMinutes, 0.0),
+            isEasts=records[:, 29] == ord("E"),
+        )
+
+    def take(self, selector: np.ndarray | slice) -> "Mp4Track":
+        """
+        真偽値マスク・添字配列・スライスで一部のレコードだけを取り出す
+        """
+        return Mp4Track(
+            indexes=self.indexes[selector],
+            timestamps=self.timestamps[selector],
+            valids=self.valids[selector],
+            latitudeDegrees=self.latitudeDegrees[selector],
+            latitudeMinutes=self.latitudeMinutes[selector],
+            isNorths=self.isNorths[selector],
+            longitudeDegrees=self.longitudeDegrees[selector],
+            longitudeMinutes=self.longitudeMinutes[selector],
+            isEasts=self.isEasts[selector],
+        )
+
+    def getValid(self) -> "Mp4Track":
+        return self.take(self.valids)
+
+    def toArrays(self) -> dict[str, np.ndarray]:
+        """
+        np.savez などでそのまま保存できる、列名と配列の辞書にする
+        """
+        return {
+            "indexes": self.indexes,
+            "timestamps": self.timestamps,
+            "valids": self.valids,
+            "latitudeDegrees": self.latitudeDegrees,
+            "latitudeMinutes": self.latitudeMinutes,
+            "isNorths": self.isNorths,
+            "longitudeDegrees": self.longitudeDegrees,
+            "longitudeMinutes": self.longitudeMinutes,
+            "isEasts": self.isEasts,
+        }
+
+    @classmethod
+    def fromArrays(cls, arrays: Mapping[str, np.ndarray]) -> "Mp4Track":
+        """
+        :meth:`toArrays` の逆変換
+        """
+        return cls(
+            indexes=arrays["indexes"],
+            timestamps=arrays["timestamps"],
+            valids=arrays["valids"],
+            latitudeDegrees=arrays["latitudeDegrees"],
+            latitudeMinutes=arrays["latitudeMinutes"],
+            isNorths=arrays["isNorths"],
+            longitudeDegrees=arrays["longitudeDegrees"],
+            longitudeMinutes=arrays["longitudeMinutes"],
+            isEasts=arrays["isEasts"],
+        )
+
+    def toCoordinates(self) -> list[coordinateType]:
+        """
+        従来の :data:`coordinateType` のリストに変換する。
+        値は :meth:`Mp4File._parseCoordinate` と同じ計算で求める。
+        """
+        result: list[coordinateType] = []
+        columns = zip(
+            self.indexes.tolist(),
+            self.timestamps.astype(datetime).tolist(),
+            self.valids.tolist(),
+            self.latitudeDegrees.tolist(),
+            self.latitudeMinutes.tolist(),
+            self.isNorths.tolist(),
+            self.longitudeDegrees.tolist(),
+            self.longitudeMinutes.tolist(),
+            self.isEasts.tolist(),
+        )
+        for (
+            index,
+            datestamp,
+            valid,
+            lat_deg,
+            lat_minsec,
+            lat_isNorth,
+            lnt_deg,
+            lnt_minsec,
+            lnt_isEast,
+        ) in columns:
+            if not valid:
+                result.append((index, datestamp, None))
+                continue
+            coordinate = (
+                (
+                    lat_deg + (lat_minsec / 60),
+                    lat_deg,
+                    int(lat_minsec // 1),
+                    lat_minsec % 1 * 60,
+                    lat_isNorth,
+                ),
+                (
+                    lnt_deg + (lnt_minsec / 60),
+                    lnt_deg,
+                    int(lnt_minsec // 1),
+                    lnt_minsec % 1 * 60,
+                    lnt_isEast,
+                ),
+            )
+            result.append((index, datestamp, coordinate))
+        return result
+
+
+class Mp4FrameIndex(object):
+    """
+    動画の各フレームに対応する緯度経度と時刻の索引。
+    ファイルごとに一度 :class:`Mp4Track` と実際のフレーム数から作り、以降は配列の参照だけで引ける。
+    GPSレコードは動画全体に均等に並んでいるとみなし、前後の有効なレコードの間を線形補間する。
+    有効なレコード同士が maxGapSeconds 以上離れている区間と、最初と最後の有効なレコードの外側はnanになる。
+    """
+
+    frameCount: int
+    latitudes: np.ndarray
+    longitudes: np.ndarray
+    timestamps: np.ndarray
+
+    def __init__(
+        self,
+        latitudes: np.ndarray,
+        longitudes: np.ndarray,
+        timestamps: np.ndarray,
+    ) -> None:
+        self.frameCount = len(timestamps)
+        self.latitudes = latitudes
+        self.longitudes = longitudes
+        self.timestamps = timestamps
+
+    @classmethod
+    def fromTrack(
+        cls,
+        track: Mp4Track,
+        frameCount: int,
+        maxGapSeconds: float = FRAMEINDEX_MAX_GAP_SECONDS,
+    ) -> "Mp4FrameIndex":
+        recordCount = len(track)
+        latitudes = np.full(frameCount, np.nan)
+        longitudes = np.full(frameCount, np.nan)
+        if recordCount == 0:
+            timestamps = np.full(frameCount, np.datetime64("NaT", "us"))
+            return cls(latitudes, longitudes, timestamps)
+        # 各フレームが、何番目のレコードにあたるか(小数)
+        positions = np.arange(frameCount) * recordCount / frameCount
+        recordPositions = np.arange(recordCount, dtype=np.float64)
+
+        microseconds = track.timestamps.astype(np.int64)
+        timestamps = np.interp(positions, recordPositions, microseconds)
+        timestamps = np.rint(timestamps).astype(np.int64).astype("datetime64[us]")
+
+        validPositions = np.flatnonzero(track.valids).astype(np.float64)
+        if len(validPositions) > 0:
+            validLatitudes = track.latitudes[track.valids]
+            validLongitudes = track.longitudes[track.valids]
+            validMicroseconds = microseconds[track.valids]
+            latitudes = np.interp(positions, validPositions, validLatitudes)
+            longitudes = np.interp(positions, validPositions, validLongitudes)
+            rights = np.searchsorted(validPositions, positions, side="left")
+            lefts = np.searchsorted(validPositions, positions, side="right") - 1
+            isCovered = (lefts >= 0) & (rights < len(validPositions))
+            lefts = np.clip(lefts, 0, len(validPositions) - 1)
+            rights = np.clip(rights, 0, len(validPositions) - 1)
+            gaps = (validMicroseconds[rights] - validMicroseconds[lefts]) / 1_000_000
+            isCovered &= gaps <= maxGapSeconds
+            latitudes[~isCovered] = np.nan
+            longitudes[~isCovered] = np.nan
+        return cls(latitudes, longitudes, timestamps)
+
+    def getLocations(
+        self, frameIndexes: np.ndarray | Sequence[int]
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        フレーム番号の配列に対する (緯度, 経度, 時刻) の配列をまとめて返す。
+        範囲外のフレーム番号は最初・最後のフレームとして扱う。フレームが一つも無い索引ではnan(時刻はNaT)を返す。
+        """
+        indexes = np.asarray(frameIndexes, dtype=np.int64)
+        if self.frameCount == 0:
+            return (
+                np.full(indexes.shape, np.nan),
+                np.full(indexes.shape, np.nan),
+                np.full(indexes.shape, np.datetime64("NaT", "us")),
+            )
+        indexes = np.clip(indexes, 0, self.frameCount - 1)
+        return (
+            self.latitudes[indexes],
+            self.longitudes[indexes],
+            self.timestamps[indexes],
+        )
+
+
 class Mp4File(object):
     # ファイル名は一切固有のものではないので、送信された際にファイル名被りを起こす可能性がある。
     # 一意の名前をつけたフォルダに他の情報を含むjsonと一緒に入れるなどで対処すること → formの設計時に注意
     # というかそもそもファイル名に依存しているリスクについて
     path: Path
-    cached_Coordinates: Optional[list[coordinateType]] = None
+    trackCache: Optional[TrackCache]
+    _cachedTrack: Optional[Mp4Track]
+    _cachedFrameIndex: Optional[Mp4FrameIndex]
 
-    def __init__(self, path: str | os.PathLike) -> None:
+    def __init__(
+        self, path: str | os.PathLike, trackCache: Optional[TrackCache] = None
+    ) -> None:
         path = Path(path)
         if not path.exists():
             raise Mp4FileException("file don't exist")
         self.path = path
+        self.trackCache = trackCache
+        self._cachedTrack = None
+        self._cachedFrameIndex = None
         _file = open(self.path)
         _file.close()
 
@@ -92,6 +503,12 @@ class Mp4File(object):
     def isHead(self) -> bool:
         return self.getFilenameParsed()[3] == "S"
 
+    def getCamera(self) -> str:
+        """
+        F: 前方カメラ、R: 後方カメラ
+        """
+        return self.getFilenameParsed()[7]
+
     def getFilenameSerial(self) -> int:
         return int(self.getFilenameParsed()[6])
 
@@ -105,17 +522,28 @@ class Mp4File(object):
     def getVideoFile(self) -> cv2.VideoCapture:
         return cv2.VideoCapture(str(self.path.absolute()))
 
-    def getStartPoint(self) -> SeekSizes:
+    def getCsmdatPayload(self) -> Mp4Payload:
+        """
+        CSMDATブロックの位置と長さを、ボックスの索引から求める。
+        索引から見つからない場合は、既知のファイルサイズの固定位置にフォールバックする。
+        """
+        payload = findCsmdat(self.path)
+        if payload is not None:
+            return payload
         size = self.getFileSize()
         match size:
             case FileSizes.VID1:
-                return SeekSizes.VID1M
+                startPoint = SeekSizes.VID1M
             case FileSizes.VID3:
-                return SeekSizes.VID3M
+                startPoint = SeekSizes.VID3M
             case _:
                 raise Mp4UnrecognizableException(
                     f"unknown file size: {size}"
                 )  # ありえない
+        return Mp4Payload(int(startPoint), int(size) - startPoint)
+
+    def getStartPoint(self) -> int:
+        return self.getCsmdatPayload().offset
 
     @staticmethod
     def _parseCoordinate(chunk: bytes) -> coordinateType:
@@ -168,146 +596,224 @@ class Mp4File(object):
             coordinate,
         )
 
-    def getAllCoordinates(self, includeInvalid: bool = True) -> list[coordinateType]:
-        # FIXME 出力されるフレーム量が不一定。 602と1802が正常なはずだが、803と1803が出力される
-        CHUNKSIZE = 130
-        if self.cached_Coordinates is not None:
-            return self.cached_Coordinates
-        startPoint = self.getStartPoint()
-        result: list[coordinateType] = []
+    def _readRecords(self) -> np.ndarray:
+        """
+        CSMDATブロックをメモリマップし、(レコード数, CHUNKSIZE) の uint8 配列として返す。
+        ブロックはファイル末尾まで続き、後半は空白で埋められている。レコード数は :func:`_countRecordsCached` で
+        最初の空白だけのレコードまでとして求め(同じファイルに対してはキャッシュされる)、それより先は読まない。
+        """
+        payload = self.getCsmdatPayload()
         with open(self.path, mode="rb") as file:
-            file.seek(startPoint, os.SEEK_SET)
-            header = file.read(6)
-            if header != b"CSMDAT":
-                raise Mp4UnrecognizableException(
-                    f"couldn't recognize file. didn't read CSMDAT at {startPoint}"
-                )
-            file.read(34)
-            count = 0
-            invalid_count = 0
-            while True:
-                try:
-                    chunk = file.read(CHUNKSIZE)
-                    if chunk == (b" " * CHUNKSIZE):
-                        break
-                    count += 1
-                    parsedCoordinate = self._parseCoordinate(chunk)
-                    if parsedCoordinate[2] is None:
-                        invalid_count += 1
-                        if not includeInvalid:
-                            continue
-                    result.append(parsedCoordinate)
-                except UnicodeDecodeError:
-                    logger.error(f"UnicodeDecodeError at {self.path}:{count}")
-                    continue
+            file.seek(payload.offset, os.SEEK_SET)
+            magic = file.read(len(CSMDATMAGIC))
+        if magic != CSMDATMAGIC:
+            raise Mp4UnrecognizableException(
+                f"couldn't recognize file. didn't read CSMDAT at {payload.offset}"
+            )
+        stat = self.path.stat()
+        recordCount = _countRecordsCached(
+            str(self.path.absolute()),
+            stat.st_size,
+            stat.st_mtime_ns,
+            payload.offset,
+            payload.size,
+        )
+        if recordCount == 0:
+            return np.empty((0, CHUNKSIZE), dtype=np.uint8)
+        records = np.memmap(
+            self.path,
+            dtype=np.uint8,
+            mode="r",
+            offset=payload.offset + HEADERSIZE,
+            shape=(recordCount, CHUNKSIZE),
+        )
+        # メモリマップを閉じられるよう、コピーする
+        return np.array(records)
+
+    def _getCacheSerial(self) -> str:
+        try:
+            return self.getFilenameFormat()
+        except IndexError:
+            return ""
+
+    def _decodeTrack(self) -> Mp4Track:
+        track = Mp4Track.fromRecords(self._readRecords())
+        validCount = int(np.count_nonzero(track.valids))
         logger.info(
-            f"read coordinate of '{self.path.parent.name}/{self.path.name}'. valid rate: {count-invalid_count}/{count}"
+            f"read coordinate of '{self.path.parent.name}/{self.path.name}'. valid rate: {validCount}/{len(track)}"
         )
-        self.cached_Coordinates = result
-        return result
+        return track
+
+    def getTrack(self) -> Mp4Track:
+        """
+        無効(V)レコードも含めた全GPSレコードを :class:`Mp4Track` として取得する。
+        インスタンス内と、指定されていれば :class:`TrackCache` にキャッシュされる。
+        """
+        if self._cachedTrack is not None:
+            return self._cachedTrack
+        track: Optional[Mp4Track] = None
+        if self.trackCache is not None:
+            arrays = self.trackCache.get(self.path, self._getCacheSerial(), "full")
+            if arrays is not None:
+                track = Mp4Track.fromArrays(arrays)
+        if track is None:
+            track = self._decodeTrack()
+            if self.trackCache is not None:
+                self.trackCache.put(
+                    self.path, self._getCacheSerial(), "full", track.toArrays()
+                )
+        self._cachedTrack = track
+        return track
+
+    def getIntervalTrack(self, intervalCount: int, startingOffset: int = 0) -> Mp4Track:
+        """
+        startingOffset 番目から、intervalCount 個おきに間引いたGPSレコードを取得する。
+        全レコードとは別のエントリとして :class:`TrackCache` にキャッシュされる。
+        """
+        view = f"interval-{intervalCount}-{startingOffset}"
+        if self.trackCache is not None:
+            arrays = self.trackCache.get(self.path, self._getCacheSerial(), view)
+            if arrays is not None:
+                return Mp4Track.fromArrays(arrays)
+        track = self.getTrack().take(slice(startingOffset, None, intervalCount + 1))
+        if self.trackCache is not None:
+            self.trackCache.put(
+                self.path, self._getCacheSerial(), view, track.toArrays()
+            )
+        return track
+
+    def getFrameIndex(self) -> Mp4FrameIndex:
+        """
+        フレーム番号から緯度経度と時刻を引く索引を取得する。インスタンス内でキャッシュされる
+        """
+        if self._cachedFrameIndex is None:
+            self._cachedFrameIndex = Mp4FrameIndex.fromTrack(
+                self.getTrack(), self.getVideoFrameCount()
+            )
+        return self._cachedFrameIndex
+
+    def getAllCoordinates(self, includeInvalid: bool = True) -> list[coordinateType]:
+        # FIXME 出力されるフレーム量が不一定。 602と1802が正常なはずだが、803と1803が出力される
+        track = self.getTrack()
+        if not includeInvalid:
+            track = track.getValid()
+        return track.toCoordinates()
 
     def getIntervalCoordinates(
         self, intervalCount: int, startingOffset: int = 0, includeInvalid: bool = True
     ) -> list[coordinateType]:
         # FIXME 出力されるフレーム量が不一定。 602と1802が正常なはずだが、803と1803が出力される
-        startPoint = self.getStartPoint()
-        result: list[coordinateType] = []
-        with open(self.path, mode="rb") as file:
-            file.seek(startPoint, os.SEEK_SET)
-            header = file.read(6)
-            if header != b"CSMDAT":
-                raise Mp4UnrecognizableException(
-                    f"couldn't recognize file. didn't read CSMDAT at {startPoint}"
-                )
-            file.read(34)
-            count = 0
-            invalid_count = 0
-            file.read(CHUNKSIZE * startingOffset)
-            while True:
-                try:
-                    chunk = file.read(CHUNKSIZE)
-                    if chunk == (b" " * CHUNKSIZE):
-                        break
-                    count += 1
-                    parsedCoordinate = self._parseCoordinate(chunk)
-                    if parsedCoordinate[2] is None:
-                        invalid_count += 1
-                        if not includeInvalid:
-                            continue
-                    result.append(parsedCoordinate)
-                except UnicodeDecodeError:
-                    logger.error(f"UnicodeDecodeError at {self.path}:{count}")
-                    continue
-                file.read(CHUNKSIZE * intervalCount)
+        track = self.getIntervalTrack(intervalCount, startingOffset)
+        if not includeInvalid:
+            track = track.getValid()
         logger.info(
-            f"read coordinate of '{self.path.parent.name}/{self.path.name}', by intervalCount {intervalCount}, startingOffset {startingOffset}. valid rate: {count-invalid_count}/{count}"
+            f"sampled coordinate of '{self.path.parent.name}/{self.path.name}', by intervalCount {intervalCount}, startingOffset {startingOffset}. count: {len(track)}"
         )
-        self.cached_Coordinates = result
-        return result
+        return track.toCoordinates()
 
-    async def _extractFrame(self, frameIndex) -> Optional[MatLike]:
+    def iterateFrames(
+        self, step: int, startFrame: int = 0
+    ) -> Generator[tuple[int, MatLike], None, None]:
+        """
+        動画を先頭から一度だけ順に読み、step フレームごとに (フレーム番号, フレーム) を返す。
+        読み飛ばすフレームは grab() のみでデコード結果を取り出さないので、
+        フレーム毎にシークするより速く、全フレームをメモリに載せることもない。
+        """
+        yield from self.iterateFramesAt(count(startFrame, step))
+
+    def iterateFramesAt(
+        self, frameIndexes: Iterable[int]
+    ) -> Generator[tuple[int, MatLike], None, None]:
+        """
+        昇順に並んだフレーム番号のフレームだけを、動画を一度順に読みながら取り出す。
+        """
         videoFile = self.getVideoFile()
-        videoFile.set(cv2.CAP_PROP_POS_FRAMES, frameIndex)
-        ret, frame = videoFile.read()
-        if ret:
-            return frame
-        else:
-            logger.warning(
-                f"couldn't load frame {frameIndex} of '{self.path.parent.name}/{self.path.name}'"
-            )
-            return None
+        try:
+            frameIndex = -1
+            for targetIndex in frameIndexes:
+                while frameIndex < targetIndex:
+                    if not videoFile.grab():
+                        return
+                    frameIndex += 1
+                if frameIndex != targetIndex:
+                    continue
+                ret, frame = videoFile.retrieve()
+                if ret:
+                    yield frameIndex, frame
+                else:
+                    logger.warning(
+                        f"couldn't load frame {frameIndex} of '{self.path.parent.name}/{self.path.name}'"
+                    )
+        finally:
+            videoFile.release()
 
     def extractFrames(self, step: int) -> list[Optional[MatLike]]:
-        async def gather():
-            videoFrames = self.getVideoFrameCount()
-            tasks = []
-            for i in range(0, videoFrames, step):
-                tasks.append(asyncio.create_task(self._extractFrame(i)))
-            return await asyncio.gather(*tasks)
-
-        result = asyncio.run(gather())
+        videoFrames = self.getVideoFrameCount()
+        result: list[Optional[MatLike]] = [None] * len(range(0, videoFrames, step))
+        for frameIndex, frame in self.iterateFrames(step):
+            if frameIndex >= videoFrames:
+                break
+            result[frameIndex // step] = frame
         logger.info(
-            f"extracted {len(result)}/{self.getVideoFrameCount()} frames of {self.path.name}, every {step} frames"
+            f"extracted {len(result)}/{videoFrames} frames of {self.path.name}, every {step} frames"
         )
         return result
 
-    async def _writeFrame(self, frame: MatLike, filename: Path) -> Path:
-        await asyncio.sleep(0)
-        result = cv2.imwrite(str(filename), frame)
-        await asyncio.sleep(0)
-        if result:
-            return filename
-        else:
-            raise Exception()  # TODO couldn't write file
-
     def writeFrames(
         self,
         targetDir: Path,
-        frames: list[Optional[MatLike]],
+        frames: Iterable[Optional[MatLike]],
         step: Optional[int] = None,
+        writer: Optional[FrameWriter] = None,
     ) -> list[Path]:
-        FILESAFE = False
-        if not FILESAFE:
-            if targetDir.exists():
-                rmtree(targetDir)
-            os.mkdir(targetDir)
+        """
+        :meth:`extractFrames` の結果を書き出す。既存のファイルは消さずに上書きする
+        """
         if step is None:
             step = 1
+        indexedFrames = (
+            ((i + 1) * step, frame)
+            for i, frame in enumerate(frames)
+            if frame is not None
+        )
+        return [
+            written.path
+            for written in self.writeIndexedFrames(targetDir, indexedFrames, writer)
+        ]
 
-        async def gather() -> list[Path]:
-            tasks: list[asyncio.Task[Path]] = []
-            frameCount = 0
-            for frame in frames:
-                frameCount += step
-                if frame is None:
-                    continue
-                startDate = self.getStartDateFormat()
-                filename = targetDir.joinpath(f"{startDate}_{frameCount}.jpg")
-                tasks.append(asyncio.create_task(self._writeFrame(frame, filename)))
-            return await asyncio.gather(*tasks)
-
-        result = asyncio.run(gather())
-        logger.info(f"written {len(frames)} frames of {self.path} into {targetDir}/")
+    def writeIndexedFrames(
+        self,
+        targetDir: Path,
+        frames: Iterable[tuple[int, MatLike]],
+        writer: Optional[FrameWriter] = None,
+    ) -> list[WrittenFrame]:
+        """
+        (フレーム番号, フレーム) の列をスレッドプールでエンコードして書き出す。
+        :meth:`iterateFrames` をそのまま渡せば、デコードしながら書き出せる。
+        writer を省略した場合はJPEG形式で書き出す。
+        """
+        targetDir.mkdir(parents=True, exist_ok=True)
+        startDate = self.getStartDateFormat()
+        isOwnWriter = writer is None
+        if writer is None:
+            writer = FrameWriter()
+        try:
+            frameCount = writer.frameCount
+            byteCount = writer.byteCount
+            startTime = perf_counter()
+            result = list(
+                writer.writeFrames(
+                    (writer.getPath(targetDir, f"{startDate}_{frameIndex}"), frame)
+                    for frameIndex, frame in frames
+                )
+            )
+            elapsed = perf_counter() - startTime
+        finally:
+            if isOwnWriter:
+                writer.close()
+        logger.info(
+            f"written {writer.frameCount - frameCount} frames ({writer.byteCount - byteCount} bytes) of {self.path} into {targetDir}/ in {elapsed:.1f}s. {writer.getSummary()}"
+        )
         return result
 
     def getVideoFrameCount(self) -> int:
@@ -359,7 +865,7 @@ if __name__ == "__main__":
             continue
         if not file.suffix == ".MP4":
             continue
-        mp4File = Mp4File(file)
+        mp4File = Mp4File(file, TrackCache())
         allCoordinates = mp4File.getAllCoordinates()
         someCoordinates = mp4File.getIntervalCoordinates(9, 0)
         print(mp4File.getVideoLength())
@@ -0,0 +1,253 @@
+"""
+ドライブレコーダーのSDカードから吸い出したMP4ファイルを、ディレクトリ単位でまとめて取り込む。
+
+ファイル名から走行(連番が連続するファイルのまとまり)ごとにグループ化し、
+GPSの解析とフレームの抽出をプロセスプールで並列に行う。
+結果はファイルごとに出力ディレクトリへ書き出され、書き出し済みのファイルは再実行時に飛ばされる。
+
+リポジトリのルートで実行する: python src/mp4ingest.py tmp/ --workers 4
+"""
+
+from __future__ import annotations
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from json import dump as jsonDump, load as jsonLoad
+from pathlib import Path
+from time import perf_counter
+import os
+
+from logging import getLogger
+from logging.config import dictConfig
+
+from yaml import FullLoader, load as loadYaml
+import numpy as np
+
+from mp4extract import Mp4File, Mp4UnrecognizableException
+from frameWriter import FrameEncoding, FrameWriter, JPEGQUALITY, WEBPQUALITY
+from trackCache import TrackCache, CACHEDIR
+
+logger = getLogger("BicycleCheck.ingest")
+
+RESULTFILENAME = "result.json"
+TRACKFILENAME = "track.npz"
+FRAMEDIRNAME = "frames"
+# 各プロセス内でエンコードに使うスレッド数。ファイル単位でも並列なので少なめにする
+FRAMEWRITER_WORKERS = 2
+RUNSFILENAME = "runs.json"
+
+
+def getMp4Files(sourceDir: Path) -> list[Mp4File]:
+    """
+    ディレクトリ直下の、ドラレコの命名規則に沿ったMP4ファイルを全て取得する
+    """
+    mp4Files: list[Mp4File] = []
+    for path in sorted(sourceDir.glob("*.MP4")):
+        mp4File = Mp4File(path)
+        try:
+            mp4File.getFilenameParsed()
+        except IndexError:
+            logger.warning(f"skipping unrecognizable filename: {path.name}")
+            continue
+        mp4Files.append(mp4File)
+    return mp4Files
+
+
+def _getSortKey(mp4File: Mp4File) -> tuple[str, datetime, int]:
+    # 前方・後方カメラは別の走行として扱う
+    return (mp4File.getCamera(), mp4File.getStartDate(), mp4File.getFilenameSerial())
+
+
+def groupRuns(mp4Files: list[Mp4File]) -> list[list[Mp4File]]:
+    """
+    カメラが同じで、連番が連続するファイルを一つの走行にまとめる。日付をまたいだ走行もまとめる。
+    ファイルを開始日時の順に見て、同じカメラで最後の連番が一つ前の走行に繋げる。
+    別の日に同じ連番が使われていても、開始日時が後の走行に繋がるので交互にはならない。
+    先頭ファイル(S)が現れた場合は新しい走行を始める。
+    """
+    runs: list[list[Mp4File]] = []
+    # (カメラ, 最後のファイルの連番) から、続きを待っている走行
+    openRuns: dict[tuple[str, int], list[Mp4File]] = {}
+    for mp4File in sorted(mp4Files, key=_getSortKey):
+        camera = mp4File.getCamera()
+        serial = mp4File.getFilenameSerial()
+        run = openRuns.pop((camera, serial - 1), None)
+        if run is None or mp4File.isHead():
+            run = []
+            runs.append(run)
+        run.append(mp4File)
+        # 同じ連番の走行が既にあれば、開始日時が後のこちらで置き換える
+        openRuns[(camera, serial)] = run
+    return runs
+
+
+def formatRuns(runs: list[list[Mp4File]]) -> list[dict]:
+    return [
+        {
+            "start": run[0].getStartDate().isoformat(),
+            "files": [mp4File.path.name for mp4File in run],
+        }
+        for run in runs
+    ]
+
+
+def getTargetDir(outputDir: Path, mp4File: Mp4File) -> Path:
+    return outputDir.joinpath(mp4File.path.stem)
+
+
+def _getFileIdentity(path: Path) -> dict[str, int]:
+    stat = path.stat()
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+def isIngested(outputDir: Path, mp4File: Mp4File) -> bool:
+    """
+    結果ファイルが存在し、元ファイルのサイズと更新日時が変わっていなければ取り込み済み
+    """
+    resultPath = getTargetDir(outputDir, mp4File).joinpath(RESULTFILENAME)
+    if not resultPath.exists():
+        return False
+    with open(resultPath, "r", encoding="UTF-8") as file:
+        result = jsonLoad(file)
+    return result.get("identity") == _getFileIdentity(mp4File.path)
+
+
+def _writeJsonAtomic(path: Path, obj: dict | list) -> None:
+    temporaryPath = path.with_suffix(path.suffix + ".tmp")
+    with open(temporaryPath, "w", encoding="UTF-8") as file:
+        jsonDump(obj, file, indent=4, ensure_ascii=False)
+    os.replace(temporaryPath, path)
+
+
+def ingestFile(
+    path: Path,
+    outputDir: Path,
+    frameStep: int,
+    cacheDir: Path,
+    encoding: FrameEncoding = FrameEncoding.jpeg(),
+) -> dict:
+    """
+    一つのMP4ファイルを取り込む。プロセスプールの各ワーカーで実行される。
+    GPSトラックと抽出フレームを書き出し、最後に結果ファイルを書くことで完了とする。
+    フレームの書き出しに失敗した場合は例外がそのまま上がり、結果ファイルは書かれないので、再開時に取り込み直される。
+    """
+    startTime = perf_counter()
+    mp4File = Mp4File(path, TrackCache(cacheDir))
+    targetDir = getTargetDir(outputDir, mp4File)
+    frameDir = targetDir.joinpath(FRAMEDIRNAME)
+    frameDir.mkdir(parents=True, exist_ok=True)
+
+    trackCount = 0
+    validCount = 0
+    try:
+        track = mp4File.getTrack()
+        trackCount = len(track)
+        validCount = int(np.count_nonzero(track.valids))
+        np.savez(targetDir.joinpath(TRACKFILENAME), **track.toArrays())
+    except Mp4UnrecognizableException as e:
+        logger.warning(f"no coordinate for {path.name}: {e}")
+
+    with FrameWriter(encoding, FRAMEWRITER_WORKERS) as writer:
+        for _ in writer.writeFrames(
+            (writer.getPath(frameDir, str(frameIndex)), frame)
+            for frameIndex, frame in mp4File.iterateFrames(frameStep)
+        ):
+            pass
+
+    result = {
+        "file": path.name,
+        "identity": _getFileIdentity(path),
+        "coordinates": trackCount,
+        "validCoordinates": validCount,
+        "frames": writer.frameCount,
+        "frameStep": frameStep,
+        "frameBytes": writer.byteCount,
+        "encodeSeconds": writer.encodeSeconds,
+        "seconds": perf_counter() - startTime,
+    }
+    _writeJsonAtomic(targetDir.joinpath(RESULTFILENAME), result)
+    return result
+
+
+def ingestDirectory(
+    sourceDir: Path,
+    outputDir: Path,
+    workerCount: int,
+    frameStep: int,
+    cacheDir: Path = CACHEDIR,
+    encoding: FrameEncoding = FrameEncoding.jpeg(),
+) -> list[dict]:
+    """
+    ディレクトリ内のMP4ファイルを全てプロセスプールで取り込む。取り込み済みのファイルは飛ばす。
+    """
+    outputDir.mkdir(parents=True, exist_ok=True)
+    mp4Files = getMp4Files(sourceDir)
+    runs = groupRuns(mp4Files)
+    _writeJsonAtomic(outputDir.joinpath(RUNSFILENAME), formatRuns(runs))
+    logger.info(f"found {len(mp4Files)} files in {len(runs)} runs at {sourceDir}/")
+
+    pendingFiles = [
+        mp4File for mp4File in mp4Files if not isIngested(outputDir, mp4File)
+    ]
+    skippedCount = len(mp4Files) - len(pendingFiles)
+    if skippedCount:
+        logger.info(f"resuming. skipping {skippedCount} already ingested files")
+
+    totalBytes = sum(os.path.getsize(mp4File.path) for mp4File in pendingFiles)
+    doneBytes = 0
+    results: list[dict] = []
+    startTime = perf_counter()
+    with ProcessPoolExecutor(max_workers=workerCount) as executor:
+        futures = {
+            executor.submit(
+                ingestFile, mp4File.path, outputDir, frameStep, cacheDir, encoding
+            ): mp4File
+            for mp4File in pendingFiles
+        }
+        for future in as_completed(futures):
+            mp4File = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error(f"failed to ingest {mp4File.path.name}: {e}")
+                continue
+            results.append(result)
+            doneBytes += os.path.getsize(mp4File.path)
+            elapsed = perf_counter() - startTime
+            logger.info(
+                f"[{len(results)}/{len(pendingFiles)}] {mp4File.path.name} "
+                f"{len(results) / elapsed:.2f} files/s, "
+                f"{doneBytes / elapsed / 1_000_000:.1f} MB/s "
+                f"({doneBytes / max(totalBytes, 1):.0%} of {totalBytes / 1_000_000:.0f} MB)"
+            )
+    return results
+
+
+def main() -> None:
+    parser = ArgumentParser(description="ingest dashcam MP4 files in a directory")
+    parser.add_argument("sourceDir", type=Path)
+    parser.add_argument("--output", type=Path, default=Path("tmp/ingest"))
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--frame-step", type=int, default=28, dest="frameStep")
+    parser.add_argument("--track-cache", type=Path, default=CACHEDIR, dest="cacheDir")
+    parser.add_argument("--format", choices=("jpg", "webp"), default="jpg")
+    parser.add_argument("--quality", type=int, default=None)
+    args = parser.parse_args()
+    if args.format == "webp":
+        encoding = FrameEncoding.webp(args.quality or WEBPQUALITY)
+    else:
+        encoding = FrameEncoding.jpeg(args.quality or JPEGQUALITY)
+    ingestDirectory(
+        args.sourceDir,
+        args.output,
+        args.workers,
+        args.frameStep,
+        args.cacheDir,
+        encoding,
+    )
+
+
+if __name__ == "__main__":
+    with open(Path("configs/log_conf.yaml"), "r", encoding="UTF-8") as configFile:
+        dictConfig(loadYaml(configFile.read(), FullLoader))
+    main()
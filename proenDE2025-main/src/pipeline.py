@@ -0,0 +1,684 @@
+"""
+動画1本分の処理を、デコード → 検出 → 分類 → 保存 の各段階をつないだパイプラインで行う。
+
+段階どうしは上限つきのキューでつながっており、後ろの段階が詰まると前の段階は待たされる。
+そのため長い動画でも、メモリ上に載るフレームはキューの大きさ分だけで済む。
+各段階のワーカー数は個別に設定でき、I/Oの多い段階はスレッド、推論はプロセスで並列化できる。
+
+リポジトリのルートで実行する: python src/pipeline.py tmp/A___-250816-111814-000578F.MP4 --runtime-id 1
+"""
+
+from __future__ import annotations
+from argparse import ArgumentParser
+from concurrent.futures import Executor, ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from queue import Empty, Queue
+from threading import Lock, Thread
+from time import perf_counter
+from typing import Any, Callable, Iterable, NamedTuple, Optional
+
+from logging import getLogger
+from logging.config import dictConfig
+
+from yaml import FullLoader, load as loadYaml
+import numpy as np
+import cv2
+from cv2.typing import MatLike
+
+from mp4extract import Mp4File, Mp4FrameIndex
+from BicycleCheck.detector import (
+    Detection,
+    getDetector,
+    getThreadCount,
+    DETECTMODELPATH,
+    DETECTBATCHSIZE,
+)
+from BicycleCheck.attributes import (
+    AttributeDetector,
+    BicycleAttributes,
+    associateAttributes,
+    ATTRIBUTECLASSNAMES,
+    ATTRIBUTEMODELPATH,
+)
+from BicycleCheck.color import ColorClassifier
+from BicycleCheck.reid import AppearanceEncoder
+from BicycleCheck.sampler import FrameSampler
+from BicycleCheck.tiling import FrameTiler
+from geo import getDistanceMeters
+from schemas import Bicycle, BicycleDetect
+from reidIndex import EmbeddingStore, ReidIndex, REIDDIR
+from sightingIndex import SightingIndex
+
+logger = getLogger("BicycleCheck.pipeline")
+
+PIPELINE_QUEUE_SIZE = 16
+PIPELINE_FRAME_STEP = 14
+PIPELINE_PERSIST_BATCH_SIZE = 64
+# これ以内の距離で目撃済みの自転車は、同じ自転車とみなす
+SIGHTING_SAME_METERS = 5.0
+IMAGEDIR = Path("tmp/images/bicycle")
+
+# キューの終端を表す目印
+_STOP = object()
+
+
+class DetectedFrame(NamedTuple):
+    frameIndex: int
+    frame: MatLike
+    detections: list[Detection]
+
+
+class DetectionRecord(NamedTuple):
+    """
+    保存段階に渡す、1つの検出事例
+    """
+
+    frameIndex: int
+    detection: Detection
+    crop: MatLike
+    latitude: float
+    longitude: float
+    timestamp: datetime
+    color: str
+    hasBasket: bool
+    hasChildseat: bool
+    embedding: Optional[np.ndarray]
+
+
+class PipelineStage(object):
+    """
+    入力キューから1件ずつ取り出して function にかけ、結果を出力キューに入れるスレッド群。
+    function は0件以上の結果を返す。
+    処理時間(busy)と、出力キューが一杯で待たされた時間(wait)を記録する。
+    """
+
+    name: str
+    function: Callable[[Any], Iterable[Any]]
+    workerCount: int
+    inputQueue: Queue
+    outputQueue: Optional[Queue]
+    itemCount: int
+    busySeconds: float
+    waitSeconds: float
+    _threads: list[Thread]
+    _runningCount: int
+    _lock: Lock
+
+    def __init__(
+        self,
+        name: str,
+        function: Callable[[Any], Iterable[Any]],
+        workerCount: int,
+        inputQueue: Queue,
+        outputQueue: Optional[Queue],
+    ) -> None:
+        self.name = name
+        self.function = function
+        self.workerCount = workerCount
+        self.inputQueue = inputQueue
+        self.outputQueue = outputQueue
+        self.itemCount = 0
+        self.busySeconds = 0.0
+        self.waitSeconds = 0.0
+        self._threads = []
+        self._runningCount = workerCount
+        self._lock = Lock()
+
+    def start(self) -> None:
+        for i in range(self.workerCount):
+            thread = Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def join(self) -> None:
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self) -> None:
+        isStopped = False
+        try:
+            isStopped = self._work()
+        finally:
+            # ワーカーが例外で止まっても、件数を減らして後ろの段階に終端を伝える。
+            # 最後のワーカーが異常終了した場合は、前の段階が一杯のキューで待ち続けないよう、残りを読み捨てる
+            with self._lock:
+                self._runningCount -= 1
+                isLast = self._runningCount == 0
+            if isLast:
+                if not isStopped:
+                    logger.error(f"stage {self.name} stopped unexpectedly. discarding its input")
+                    while self.inputQueue.get() is not _STOP:
+                        pass
+                if self.outputQueue is not None:
+                    self.outputQueue.put(_STOP)
+
+    def _work(self) -> bool:
+        """
+        終端を受け取るまで処理する。終端を受け取って抜けた場合はTrue
+        """
+        while True:
+            item = self.inputQueue.get()
+            if item is _STOP:
+                # 同じ段階の他のワーカーにも終端を伝える
+                self.inputQueue.put(_STOP)
+                return True
+            startTime = perf_counter()
+            try:
+                results = list(self.function(item))
+            except Exception as e:
+                logger.error(f"stage {self.name} failed: {e}")
+                results = []
+            elapsed = perf_counter() - startTime
+            waitStartTime = perf_counter()
+            if self.outputQueue is not None:
+                for result in results:
+                    self.outputQueue.put(result)
+            waited = perf_counter() - waitStartTime
+            with self._lock:
+                self.itemCount += 1
+                self.busySeconds += elapsed
+                self.waitSeconds += waited
+
+    def getSummary(self) -> str:
+        return f"{self.name}: {self.itemCount} items, busy {self.busySeconds:.2f}s, blocked {self.waitSeconds:.2f}s, {self.workerCount} workers"
+
+
+def _loadDetector(modelPath: str, threadCount: int) -> None:
+    """
+    推論用プロセスの起動時に実行される。最初のバッチを待たせないよう、モデルの読み込みとウォームアップを先に済ませる
+    """
+    getDetector(modelPath, threadCount=threadCount)
+
+
+def _detectBatch(
+    modelPath: str, threadCount: int, frameIndexes: list[int], frames: list[MatLike]
+) -> list[Detection]:
+    """
+    推論用プロセスで実行される。モデルはプロセスごとに一度だけ読み込まれる
+    """
+    return getDetector(modelPath, threadCount=threadCount).detectBatch(
+        frameIndexes, frames
+    )
+
+
+class Pipeline(object):
+    """
+    動画1本を処理するパイプライン。
+    """
+
+    runtimeId: int
+    imageDir: Path
+    modelPath: str
+    batchSize: int
+    queueSize: int
+    frameStep: int
+    inferenceWorkerCount: int
+    isInferenceInProcess: bool
+    classifyWorkerCount: int
+    persistWorkerCount: int
+    persistBatchSize: int
+    sampler: Optional[FrameSampler]
+    tiler: Optional[FrameTiler]
+    colorClassifier: ColorClassifier
+    sightingIndex: Optional[SightingIndex]
+    reidIndex: Optional[ReidIndex]
+    appearanceEncoder: Optional[AppearanceEncoder]
+    attributeDetector: Optional[AttributeDetector]
+    _executor: Optional[Executor]
+    _matchLock: Lock
+
+    def __init__(
+        self,
+        runtimeId: int,
+        imageDir: Path = IMAGEDIR,
+        modelPath: str | Path = DETECTMODELPATH,
+        batchSize: int = DETECTBATCHSIZE,
+        queueSize: int = PIPELINE_QUEUE_SIZE,
+        frameStep: int = PIPELINE_FRAME_STEP,
+        inferenceWorkerCount: int = 1,
+        isInferenceInProcess: bool = True,
+        classifyWorkerCount: int = 2,
+        persistWorkerCount: int = 4,
+        persistBatchSize: int = PIPELINE_PERSIST_BATCH_SIZE,
+        sampler: Optional[FrameSampler] = None,
+        tiler: Optional[FrameTiler] = None,
+        sightingIndex: Optional[SightingIndex] = None,
+        reidIndex: Optional[ReidIndex] = None,
+        appearanceEncoder: Optional[AppearanceEncoder] = None,
+        attributeDetector: Optional[AttributeDetector] = None,
+    ) -> None:
+        self.runtimeId = runtimeId
+        self.imageDir = imageDir
+        self.modelPath = str(modelPath)
+        self.batchSize = batchSize
+        self.queueSize = queueSize
+        self.frameStep = frameStep
+        self.inferenceWorkerCount = inferenceWorkerCount
+        self.isInferenceInProcess = isInferenceInProcess
+        self.classifyWorkerCount = classifyWorkerCount
+        self.persistWorkerCount = persistWorkerCount
+        self.persistBatchSize = persistBatchSize
+        self.sampler = sampler
+        self.tiler = tiler
+        self.colorClassifier = ColorClassifier()
+        self.sightingIndex = sightingIndex
+        # 外観で照合する場合は、照合用の空間索引も reidIndex のものを使う
+        self.reidIndex = reidIndex
+        self.appearanceEncoder = appearanceEncoder
+        self.attributeDetector = attributeDetector
+        if reidIndex is not None:
+            self.sightingIndex = reidIndex.sightingIndex
+            if appearanceEncoder is None:
+                raise ValueError("appearanceEncoder is required with reidIndex")
+        self._executor = None
+        self._matchLock = Lock()
+
+    def _takeBatch(self, inputQueue: Queue, first: Any, batchSize: int) -> list:
+        """
+        キューに既に溜まっている要素を、batchSize まで待たずに取り出す
+        """
+        batch = [first]
+        while len(batch) < batchSize:
+            try:
+                item = inputQueue.get_nowait()
+            except Empty:
+                break
+            if item is _STOP:
+                inputQueue.put(_STOP)
+                break
+            batch.append(item)
+        return batch
+
+    def _getThreadCount(self) -> int:
+        """
+        推論ワーカー1つあたりのスレッド数。プロセスでもスレッドでも、CPUのコアを推論ワーカーで分け合う
+        """
+        return getThreadCount(self.inferenceWorkerCount)
+
+    def _inferBatch(
+        self, frameIndexes: list[int], frames: list[MatLike]
+    ) -> list[Detection]:
+        if self._executor is not None:
+            return self._executor.submit(
+                _detectBatch,
+                self.modelPath,
+                self._getThreadCount(),
+                frameIndexes,
+                frames,
+            ).result()
+        return getDetector(self.modelPath, threadCount=self._getThreadCount()).detectBatch(
+            frameIndexes, frames
+        )
+
+    def _detect(
+        self, frameQueue: Queue, camera: str
+    ) -> Callable[[Any], Iterable[DetectedFrame]]:
+        def detect(first: tuple[int, MatLike]) -> Iterable[DetectedFrame]:
+            batch = self._takeBatch(frameQueue, first, self.batchSize)
+            frameIndexes = [frameIndex for frameIndex, _ in batch]
+            frames = [frame for _, frame in batch]
+            if self.tiler is not None:
+                # 全フレームのタイルを一つのバッチで推論する
+                crops, tiles = self.tiler.split(frames, camera)
+                detections = self.tiler.merge(
+                    frameIndexes,
+                    frames,
+                    tiles,
+                    self._inferBatch(list(range(len(crops))), crops),
+                )
+            else:
+                detections = self._inferBatch(frameIndexes, frames)
+            results: list[DetectedFrame] = []
+            for frameIndex, frame in batch:
+                frameDetections = [
+                    detection
+                    for detection in detections
+                    if detection.frameIndex == frameIndex
+                ]
+                if frameDetections:
+                    results.append(DetectedFrame(frameIndex, frame, frameDetections))
+            return results
+
+        return detect
+
+    def _classify(
+        self, frameIndex: Mp4FrameIndex, detectedQueue: Queue
+    ) -> Callable[[DetectedFrame], Iterable[DetectionRecord]]:
+        def classify(first: DetectedFrame) -> Iterable[DetectionRecord]:
+            # 溜まっているフレームの切り抜きをまとめて色分類する
+            detectedFrames: list[DetectedFrame] = self._takeBatch(
+                detectedQueue, first, self.batchSize
+            )
+            latitudes, longitudes, timestamps = frameIndex.getLocations(
+                [detectedFrame.frameIndex for detectedFrame in detectedFrames]
+            )
+            located: list[tuple[int, DetectedFrame]] = []
+            for i, detectedFrame in enumerate(detectedFrames):
+                if np.isnan(latitudes[i]):
+                    logger.warning(
+                        f"no location for frame {detectedFrame.frameIndex}. skipping its detections"
+                    )
+                    continue
+                located.append((i, detectedFrame))
+            crops: list[tuple[int, DetectedFrame, Detection, MatLike]] = []
+            frameAttributes: list[BicycleAttributes] = []
+            for i, detectedFrame in located:
+                bicycles = [
+                    detection
+                    for detection in detectedFrame.detections
+                    if detection.className not in ATTRIBUTECLASSNAMES
+                ]
+                # 検出モデルが付属品も検出していれば、それを含む自転車に割り当てる
+                frameAttributes += associateAttributes(
+                    bicycles,
+                    [
+                        detection
+                        for detection in detectedFrame.detections
+                        if detection.className in ATTRIBUTECLASSNAMES
+                    ],
+                )
+                for detection in bicycles:
+                    x1, y1, x2, y2 = (int(value) for value in detection.box)
+                    crop = detectedFrame.frame[y1:y2, x1:x2].copy()
+                    crops.append((i, detectedFrame, detection, crop))
+            cropImages = [crop for *_, crop in crops]
+            colors = self.colorClassifier.classifyBatch(cropImages)
+            embeddings: list[Optional[np.ndarray]] = (
+                list(self.appearanceEncoder.encodeBatch(cropImages))
+                if self.appearanceEncoder is not None
+                else [None] * len(crops)
+            )
+            if self.attributeDetector is not None:
+                cropAttributes = self.attributeDetector.detectCrops(cropImages)
+                frameAttributes = [
+                    BicycleAttributes(
+                        fromFrame.hasBasket or fromCrop.hasBasket,
+                        fromFrame.hasChildseat or fromCrop.hasChildseat,
+                    )
+                    for fromFrame, fromCrop in zip(frameAttributes, cropAttributes)
+                ]
+            return [
+                DetectionRecord(
+                    frameIndex=detectedFrame.frameIndex,
+                    detection=detection,
+                    crop=crop,
+                    latitude=float(latitudes[i]),
+                    longitude=float(longitudes[i]),
+                    timestamp=timestamps[i].astype(datetime),
+                    color=color,
+                    hasBasket=attributes.hasBasket,
+                    hasChildseat=attributes.hasChildseat,
+                    embedding=embedding,
+                )
+                for (i, detectedFrame, detection, crop), color, embedding, attributes in zip(
+                    crops, colors, embeddings, frameAttributes
+                )
+            ]
+
+        return classify
+
+    def _matchBicycles(self, records: list[DetectionRecord]) -> list[Optional[int]]:
+        """
+        目撃済みの自転車と同じものがあればそのidを、無ければNoneを返す。
+        reidIndex があれば外観で照合し、無ければ最も近い目撃を使う
+        """
+        if self.reidIndex is not None:
+            matches = self.reidIndex.findBicycleIds(
+                [(record.longitude, record.latitude) for record in records],
+                np.array([record.embedding for record in records], dtype=np.float32),
+            )
+            return [match.bicycleId for match in matches]
+        if self.sightingIndex is None:
+            return [None] * len(records)
+        return [
+            self.sightingIndex.findBicycleId(
+                record.longitude, record.latitude, SIGHTING_SAME_METERS
+            )
+            for record in records
+        ]
+
+    def _isSameBicycle(self, record: DetectionRecord, other: DetectionRecord) -> bool:
+        meters = getDistanceMeters(
+            record.longitude, record.latitude, other.longitude, other.latitude
+        )
+        if self.reidIndex is None or record.embedding is None or other.embedding is None:
+            return meters <= SIGHTING_SAME_METERS
+        return (
+            meters <= self.reidIndex.radiusMeters
+            and float(record.embedding @ other.embedding) >= self.reidIndex.minSimilarity
+        )
+
+    def _storeRecords(
+        self, records: list[DetectionRecord], imagePaths: list[Path]
+    ) -> None:
+        """
+        検出事例を既知の自転車に照合し、自転車と検出事例をDBに登録して、目撃の索引に加える
+        """
+        bicycleIds = self._matchBicycles(records)
+        # 同じバッチ内で近く、外観も似ているものは、まとめて1台の自転車とする
+        newRecords: list[DetectionRecord] = []
+        newIndexes: list[Optional[int]] = []
+        for record, bicycleId in zip(records, bicycleIds):
+            if bicycleId is not None:
+                newIndexes.append(None)
+                continue
+            for i, newRecord in enumerate(newRecords):
+                if self._isSameBicycle(record, newRecord):
+                    newIndexes.append(i)
+                    break
+            else:
+                newIndexes.append(len(newRecords))
+                newRecords.append(record)
+        newBicycles = Bicycle.bulkCreate(
+            Bicycle(bicycle_id=0, handled_flg=False) for _ in newRecords
+        )
+        bicycleIds = [
+            bicycleId if newIndex is None else newBicycles[newIndex].bicycle_id
+            for bicycleId, newIndex in zip(bicycleIds, newIndexes)
+        ]
+        # 自転車の登録に失敗した検出は保存しない
+        stored = [
+            (record, imagePath, bicycleId)
+            for record, imagePath, bicycleId in zip(records, imagePaths, bicycleIds)
+            if bicycleId != 0
+        ]
+        detects = BicycleDetect.bulkCreate(
+            BicycleDetect(
+                instance_id=0,
+                bicycle_id=bicycleId,
+                runtime_id=self.runtimeId,
+                detection_time=record.timestamp,
+                coordinate_x=record.longitude,
+                coordinate_y=record.latitude,
+                image_path=str(imagePath),
+                color=record.color,
+                has_basket=record.hasBasket,
+                has_childseat=record.hasChildseat,
+            )
+            for record, imagePath, bicycleId in stored
+        )
+        savedIndexes = [
+            i for i, detect in enumerate(detects) if detect.instance_id != 0
+        ]
+        if self.reidIndex is not None:
+            self.reidIndex.addDetects(
+                [detects[i] for i in savedIndexes],
+                np.array(
+                    [stored[i][0].embedding for i in savedIndexes],
+                    dtype=np.float32,
+                ).reshape(len(savedIndexes), self.reidIndex.store.dimension),
+            )
+        elif self.sightingIndex is not None:
+            self.sightingIndex.addDetects(detects[i] for i in savedIndexes)
+
+    def _persist(
+        self, mp4File: Mp4File, recordQueue: Queue
+    ) -> Callable[[DetectionRecord], Iterable]:
+        def persist(first: DetectionRecord) -> Iterable:
+            records: list[DetectionRecord] = self._takeBatch(
+                recordQueue, first, self.persistBatchSize
+            )
+            imagePaths: list[Path] = []
+            for record in records:
+                imagePath = self.imageDir.joinpath(
+                    f"{mp4File.path.stem}_{record.frameIndex}_{int(record.detection.box[0])}.jpg"
+                )
+                cv2.imwrite(str(imagePath), record.crop)
+                imagePaths.append(imagePath)
+            if self.sightingIndex is None:
+                self._storeRecords(records, imagePaths)
+            else:
+                # 照合から索引への追加までの間に、別のワーカーが同じ自転車を照合すると、
+                # どちらも見つけられずに別々の自転車を登録してしまう。照合する場合はまとめて一つずつ行う
+                with self._matchLock:
+                    self._storeRecords(records, imagePaths)
+            return []
+
+        return persist
+
+    def run(self, mp4File: Mp4File) -> list[PipelineStage]:
+        """
+        動画1本を最後まで処理し、各段階の統計を返す
+        """
+        self.imageDir.mkdir(parents=True, exist_ok=True)
+        frameIndex = mp4File.getFrameIndex()
+        camera = mp4File.getCamera() if self.tiler is not None else ""
+        frameQueue: Queue = Queue(maxsize=self.queueSize)
+        detectedQueue: Queue = Queue(maxsize=self.queueSize)
+        recordQueue: Queue = Queue(maxsize=self.queueSize)
+        stages = [
+            PipelineStage(
+                "detect",
+                self._detect(frameQueue, camera),
+                self.inferenceWorkerCount,
+                frameQueue,
+                detectedQueue,
+            ),
+            PipelineStage(
+                "classify",
+                self._classify(frameIndex, detectedQueue),
+                self.classifyWorkerCount,
+                detectedQueue,
+                recordQueue,
+            ),
+            PipelineStage(
+                "persist",
+                self._persist(mp4File, recordQueue),
+                self.persistWorkerCount,
+                recordQueue,
+                None,
+            ),
+        ]
+        if self.isInferenceInProcess:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.inferenceWorkerCount,
+                initializer=_loadDetector,
+                initargs=(self.modelPath, self._getThreadCount()),
+            )
+        startTime = perf_counter()
+        try:
+            for stage in stages:
+                stage.start()
+            # デコードはこのスレッドで行う。キューが一杯の間は put で待たされる
+            decodeWaitSeconds = 0.0
+            decodeCount = 0
+            if self.sampler is not None:
+                frames = self.sampler.iterateFrames(mp4File)
+            else:
+                frames = mp4File.iterateFrames(self.frameStep)
+            for item in frames:
+                waitStartTime = perf_counter()
+                frameQueue.put(item)
+                decodeWaitSeconds += perf_counter() - waitStartTime
+                decodeCount += 1
+            frameQueue.put(_STOP)
+            for stage in stages:
+                stage.join()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+            if self.reidIndex is not None:
+                self.reidIndex.store.flush()
+        elapsed = perf_counter() - startTime
+        logger.info(
+            f"pipeline done for '{mp4File.path.name}' in {elapsed:.1f}s. decode: {decodeCount} frames, blocked {decodeWaitSeconds:.2f}s"
+        )
+        for stage in stages:
+            logger.info(stage.getSummary())
+        if decodeCount:
+            # 推論は並列に走るので、各段階の処理時間をフレーム数で割った目安
+            attributeSeconds = (
+                self.attributeDetector.inferenceSeconds
+                if self.attributeDetector is not None
+                else 0.0
+            )
+            logger.info(
+                f"inference per frame: detect {stages[0].busySeconds / decodeCount * 1000:.1f}ms, "
+                f"attributes {attributeSeconds / decodeCount * 1000:.1f}ms"
+            )
+        if self.attributeDetector is not None:
+            logger.info(f"attributes: {self.attributeDetector.getSummary()}")
+        logger.info(
+            f"color: {self.colorClassifier.cropCount} crops, {self.colorClassifier.getCropsPerSecond():.0f} crops/s"
+        )
+        return stages
+
+
+def main() -> None:
+    parser = ArgumentParser(description="detect bicycles in a dashcam MP4 file")
+    parser.add_argument("file", type=Path)
+    parser.add_argument("--runtime-id", type=int, required=True, dest="runtimeId")
+    parser.add_argument("--model", type=Path, default=DETECTMODELPATH)
+    parser.add_argument("--frame-step", type=int, default=PIPELINE_FRAME_STEP, dest="frameStep")
+    parser.add_argument("--queue-size", type=int, default=PIPELINE_QUEUE_SIZE, dest="queueSize")
+    parser.add_argument("--inference-workers", type=int, default=1, dest="inferenceWorkerCount")
+    parser.add_argument("--inference-threads", action="store_true", dest="isInferenceInThread")
+    parser.add_argument("--classify-workers", type=int, default=2, dest="classifyWorkerCount")
+    parser.add_argument("--persist-workers", type=int, default=4, dest="persistWorkerCount")
+    parser.add_argument("--no-sighting-index", action="store_false", dest="isSightingIndexed", help="register every detection as a new bicycle")
+    parser.add_argument("--reid", action="store_true", dest="isReidUsed", help="match bicycles by appearance as well as location")
+    parser.add_argument("--reid-backbone", action="store_true", dest="isReidBackboneUsed", help="add the YOLO backbone embedding to the appearance vector")
+    parser.add_argument("--attributes", action="store_true", dest="isAttributeDetected", help="run the basket/child seat model on bicycle crops")
+    parser.add_argument("--attribute-model", type=Path, default=ATTRIBUTEMODELPATH, dest="attributeModel")
+    parser.add_argument("--tiles", action="store_true", dest="isTiled", help="detect on overlapping tiles of the roadside region (configs/universal.json tiling)")
+    parser.add_argument("--sample", action="store_true", dest="isSampling", help="sample frames by GPS distance instead of --frame-step")
+    args = parser.parse_args()
+    sightingIndex = SightingIndex.loadFromDB() if args.isSightingIndexed else None
+    reidIndex: Optional[ReidIndex] = None
+    appearanceEncoder: Optional[AppearanceEncoder] = None
+    if args.isReidUsed:
+        if sightingIndex is None:
+            parser.error("--reid can't be used with --no-sighting-index")
+        appearanceEncoder = AppearanceEncoder(
+            backboneModelPath=args.model if args.isReidBackboneUsed else None
+        )
+        reidIndex = ReidIndex(
+            sightingIndex, EmbeddingStore(REIDDIR, appearanceEncoder.dimension)
+        )
+    pipeline = Pipeline(
+        args.runtimeId,
+        modelPath=args.model,
+        queueSize=args.queueSize,
+        frameStep=args.frameStep,
+        inferenceWorkerCount=args.inferenceWorkerCount,
+        isInferenceInProcess=not args.isInferenceInThread,
+        classifyWorkerCount=args.classifyWorkerCount,
+        persistWorkerCount=args.persistWorkerCount,
+        sampler=FrameSampler() if args.isSampling else None,
+        tiler=FrameTiler.fromConfig() if args.isTiled else None,
+        sightingIndex=sightingIndex,
+        reidIndex=reidIndex,
+        appearanceEncoder=appearanceEncoder,
+        attributeDetector=(
+            AttributeDetector(args.attributeModel) if args.isAttributeDetected else None
+        ),
+    )
+    pipeline.run(Mp4File(args.file))
+
+
+if __name__ == "__main__":
+    with open(Path("configs/log_conf.yaml"), "r", encoding="UTF-8") as configFile:
+        dictConfig(loadYaml(configFile.read(), FullLoader))
+    main()
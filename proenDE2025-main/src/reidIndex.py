@@ -0,0 +1,235 @@
+"""
+検出事例の外観の特徴ベクトルを保存し、新しい検出が既知のどの自転車かを判断する再識別の索引。
+
+ベクトルは :class:`BicycleCheck.reid.AppearanceEncoder` で計算したもので、検出事例のidとともに
+ディスク上の連続したfloat32の行列に追記し、メモリマップで読む。全件をメモリに載せる必要は無い。
+問い合わせ地点の周囲の目撃だけを :class:`sightingIndex.SightingIndex` で絞り込み、
+その行だけを読んでコサイン類似度をまとめて計算する。
+"""
+
+from __future__ import annotations
+from json import dump, load
+from pathlib import Path
+from threading import Lock
+from typing import NamedTuple, Optional, Sequence
+
+from logging import getLogger
+
+import numpy as np
+
+from BicycleCheck.reid import REID_MIN_SIMILARITY
+from schemas import BicycleDetect
+from sightingIndex import SightingIndex, Sighting
+
+logger = getLogger("BicycleCheck.reidindex")
+
+REIDDIR = Path("tmp/reid")
+REID_INITIAL_CAPACITY = 1024
+# 外観で照合する範囲(メートル)。GPSの誤差を見込んで、距離だけで判断する場合より広くとる。
+# 範囲内の自転車が多いほど取り違えやすいので、駐輪場をまとめて含むほどは広げない
+REID_RADIUS_METERS = 10.0
+# 周囲の目撃にベクトルが無い場合(照合を始める前の検出)は、この距離以内の最も近いものとみなす
+REID_FALLBACK_METERS = 5.0
+
+
+class EmbeddingStore(object):
+    """
+    検出事例ごとの特徴ベクトルを、ディスク上の行列に追記して保存するクラス。
+    vectors.f32 (容量, 次元数) と instances.i64 (容量,) をメモリマップし、
+    実際に使っている行数などは meta.json に書く。容量が足りなくなったら倍に広げる
+    """
+
+    directory: Path
+    dimension: int
+    count: int
+    _capacity: int
+    _vectors: np.memmap
+    _instanceIds: np.memmap
+    _rows: dict[int, int]
+    _lock: Lock
+
+    def __init__(self, directory: Path, dimension: int) -> None:
+        self.directory = directory
+        self.dimension = dimension
+        self.count = 0
+        self._capacity = 0
+        self._rows = {}
+        self._lock = Lock()
+        directory.mkdir(parents=True, exist_ok=True)
+        metaPath = self._getMetaPath()
+        if metaPath.exists():
+            with open(metaPath, "r") as file:
+                meta = load(file)
+            if meta["dimension"] != dimension:
+                raise ValueError(
+                    f"embeddings in {directory} have {meta['dimension']} dimensions, not {dimension}"
+                )
+            self.count = int(meta["count"])
+        self._open(max(self.count, REID_INITIAL_CAPACITY))
+        self._rows = {
+            instanceId: row
+            for row, instanceId in enumerate(self._instanceIds[: self.count].tolist())
+        }
+        logger.info(f"opened {self.count} embeddings of {dimension} dimensions in {directory}")
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _getMetaPath(self) -> Path:
+        return self.directory.joinpath("meta.json")
+
+    def _open(self, capacity: int) -> None:
+        """
+        ファイルを capacity 行分の大きさにしてメモリマップし直す
+        """
+        for name, rowBytes in (
+            ("vectors.f32", self.dimension * 4),
+            ("instances.i64", 8),
+        ):
+            path = self.directory.joinpath(name)
+            with open(path, "ab") as file:
+                if file.tell() < capacity * rowBytes:
+                    file.truncate(capacity * rowBytes)
+        self._vectors = np.memmap(
+            self.directory.joinpath("vectors.f32"),
+            dtype=np.float32,
+            mode="r+",
+            shape=(capacity, self.dimension),
+        )
+        self._instanceIds = np.memmap(
+            self.directory.joinpath("instances.i64"),
+            dtype=np.int64,
+            mode="r+",
+            shape=(capacity,),
+        )
+        self._capacity = capacity
+
+    def add(self, instanceIds: Sequence[int], vectors: np.ndarray) -> None:
+        with self._lock:
+            required = self.count + len(instanceIds)
+            if required > self._capacity:
+                self._vectors.flush()
+                self._instanceIds.flush()
+                capacity = self._capacity
+                while capacity < required:
+                    capacity *= 2
+                self._open(capacity)
+            rows = slice(self.count, required)
+            self._vectors[rows] = vectors
+            self._instanceIds[rows] = instanceIds
+            for row, instanceId in enumerate(instanceIds, self.count):
+                self._rows[instanceId] = row
+            self.count = required
+
+    def getRows(self, instanceIds: Sequence[int]) -> np.ndarray:
+        """
+        検出事例idに対応する行番号。ベクトルが無いものは-1
+        """
+        return np.array(
+            [self._rows.get(instanceId, -1) for instanceId in instanceIds],
+            dtype=np.int64,
+        )
+
+    def getVectors(self, rows: np.ndarray) -> np.ndarray:
+        return np.asarray(self._vectors[rows])
+
+    def flush(self) -> None:
+        """
+        ディスクに書き出し、行数を meta.json に記録する
+        """
+        with self._lock:
+            self._vectors.flush()
+            self._instanceIds.flush()
+            with open(self._getMetaPath(), "w") as file:
+                dump({"dimension": self.dimension, "count": self.count}, file)
+
+
+class ReidMatch(NamedTuple):
+    """
+    照合の結果。bicycleId がNoneなら、新しい自転車
+    """
+
+    bicycleId: Optional[int]
+    similarity: float
+    meters: float
+
+
+class ReidIndex(object):
+    """
+    目撃の空間索引と特徴ベクトルを組み合わせて、検出を既知の自転車に照合するクラス。
+    """
+
+    sightingIndex: SightingIndex
+    store: EmbeddingStore
+    radiusMeters: float
+    minSimilarity: float
+
+    def __init__(
+        self,
+        sightingIndex: SightingIndex,
+        store: EmbeddingStore,
+        radiusMeters: float = REID_RADIUS_METERS,
+        minSimilarity: float = REID_MIN_SIMILARITY,
+    ) -> None:
+        self.sightingIndex = sightingIndex
+        self.store = store
+        self.radiusMeters = radiusMeters
+        self.minSimilarity = minSimilarity
+
+    def findBicycleIds(
+        self, points: Sequence[tuple[float, float]], vectors: np.ndarray
+    ) -> list[ReidMatch]:
+        """
+        (経度, 緯度) と特徴ベクトルの組ごとに、radiusMeters 以内で最も似た目撃の自転車を探す。
+        全ての問い合わせの候補を一つの行列にまとめ、類似度を一度の行列積で求める
+        """
+        candidates = [
+            self.sightingIndex.getWithinRadius(x, y, self.radiusMeters)
+            for x, y in points
+        ]
+        instanceIds = sorted(
+            {near.sighting.instanceId for nears in candidates for near in nears}
+        )
+        rows = self.store.getRows(instanceIds)
+        columns = {
+            instanceId: column
+            for column, instanceId in enumerate(
+                instanceId for instanceId, row in zip(instanceIds, rows) if row >= 0
+            )
+        }
+        similarities = vectors @ self.store.getVectors(rows[rows >= 0]).T
+        matches: list[ReidMatch] = []
+        for i, nears in enumerate(candidates):
+            best = ReidMatch(None, 0.0, 0.0)
+            isCompared = False
+            for near in nears:
+                column = columns.get(near.sighting.instanceId)
+                if column is None:
+                    continue
+                isCompared = True
+                similarity = float(similarities[i, column])
+                if similarity >= self.minSimilarity and similarity > best.similarity:
+                    best = ReidMatch(near.sighting.bicycleId, similarity, near.meters)
+            # getWithinRadius は近い順なので、先頭が最も近い
+            if not isCompared and nears and nears[0].meters <= REID_FALLBACK_METERS:
+                best = ReidMatch(nears[0].sighting.bicycleId, 0.0, nears[0].meters)
+            matches.append(best)
+        return matches
+
+    def addDetects(
+        self, detects: Sequence[BicycleDetect], vectors: np.ndarray
+    ) -> None:
+        """
+        DBに保存済みの検出事例とその特徴ベクトルを追加する
+        """
+        for detect in detects:
+            self.sightingIndex.add(
+                Sighting(
+                    detect.instance_id,
+                    detect.bicycle_id,
+                    detect.coordinate_x,
+                    detect.coordinate_y,
+                    detect.detection_time.timestamp(),
+                )
+            )
+        self.store.add([detect.instance_id for detect in detects], vectors)
@@ -2,12 +2,27 @@ from typing import Optional
 
 from logging import getLogger
 
-from fastapi import APIRouter, Depends, status
+from fastapi import APIRouter, Depends, Query, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.exceptions import HTTPException
 
-from schemas import User, Bicycle, BicycleDetect, Area, Car, UserSql, AccessToken
+from auth import revocations
+from detectExport import getMediaType, iterateChunksAsync
+from schemas import (
+    User,
+    Bicycle,
+    BicycleDetect,
+    Area,
+    Car,
+    UserSql,
+    AccessToken,
+    DetectFilter,
+    Page,
+    PAGE_DEFAULT_LIMIT,
+    PAGE_MAX_LIMIT,
+)
 
 
 ROUTERBASE = "/api"
@@ -27,6 +42,17 @@ async def login(token: AccessToken = Depends(User.login)):
     return token
 
 
+@routerUser.post(
+    f"{ROUTERBASEUSER}/logout",
+    response_class=JSONResponse,
+    description="revoke every token issued to the user so far",
+)
+async def logout(user: User | None = Depends(User.requireVerified)):
+    assert user is not None
+    await run_in_threadpool(revocations.revoke, user.user_id)
+    return JSONResponse({"user_id": user.user_id}, status_code=status.HTTP_200_OK)
+
+
 @routerUser.get(f"{ROUTERBASEUSER}/me", response_class=JSONResponse)
 async def checkUser(user: User | None = Depends(User.require)):
     print(type(user))
@@ -37,7 +63,7 @@ async def checkUser(user: User | None = Depends(User.require)):
 
 
 @routerPublic.get(f"{ROUTERBASE}/bicycle", response_class=JSONResponse)
-async def getBicycle(bicycle: Bicycle | None = Depends(Bicycle.getOne)):
+async def getBicycle(bicycle: Bicycle | None = Depends(Bicycle.getOneAsync)):
     if bicycle is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Item not found"
@@ -47,16 +73,73 @@ async def getBicycle(bicycle: Bicycle | None = Depends(Bicycle.getOne)):
 
 @routerPublic.get(f"{ROUTERBASE}/bicycledetect", response_class=JSONResponse)
 async def getBicyclesdetect(
-    bicycledetect: BicycleDetect | None = Depends(BicycleDetect.getOne),
+    bicycledetect: BicycleDetect | None = Depends(BicycleDetect.getOneAsync),
 ):
     return JSONResponse(bicycledetect, status_code=status.HTTP_200_OK)
 
 
 @routerPublic.get(f"{ROUTERBASE}/area", response_class=JSONResponse)
-async def getArea(area: Area | None = Depends(Area.getOne)):
+async def getArea(area: Area | None = Depends(Area.getOneAsync)):
     return JSONResponse(area, status_code=status.HTTP_200_OK)
 
 
 @routerPublic.get(f"{ROUTERBASE}/car", response_class=JSONResponse)
-async def getCar(car: Car | None = Depends(Car.getOne)):
+async def getCar(car: Car | None = Depends(Car.getOneAsync)):
     return JSONResponse(car, status_code=status.HTTP_200_OK)
+
+
+@routerPublic.get(f"{ROUTERBASE}/bicycles", response_model=Page)
+async def getBicycles(
+    cursor: Optional[str] = None,
+    limit: int = Query(PAGE_DEFAULT_LIMIT, ge=1, le=PAGE_MAX_LIMIT),
+    handled_flg: Optional[bool] = None,
+    fields: Optional[str] = Query(None, description="comma separated field names"),
+):
+    return await Bicycle.getPageAsync(cursor, limit, handled_flg, fields)
+
+
+@routerPublic.get(f"{ROUTERBASE}/runs/{{runtime_id}}/detections", response_model=Page)
+async def getRunDetections(
+    runtime_id: int,
+    filter: DetectFilter = Depends(),
+    cursor: Optional[str] = None,
+    limit: int = Query(PAGE_DEFAULT_LIMIT, ge=1, le=PAGE_MAX_LIMIT),
+    fields: Optional[str] = Query(None, description="comma separated field names"),
+):
+    return await BicycleDetect.getPageByRuntimeIdAsync(
+        runtime_id, filter, cursor, limit, fields
+    )
+
+
+@routerPublic.get(
+    f"{ROUTERBASE}/areas/{{district_id}}/detections", response_model=Page
+)
+async def getAreaDetections(
+    district_id: int,
+    filter: DetectFilter = Depends(),
+    cursor: Optional[str] = None,
+    limit: int = Query(PAGE_DEFAULT_LIMIT, ge=1, le=PAGE_MAX_LIMIT),
+    fields: Optional[str] = Query(None, description="comma separated field names"),
+):
+    return await BicycleDetect.getPageByAreaIdAsync(
+        district_id, filter, cursor, limit, fields
+    )
+
+
+@routerPublic.get(f"{ROUTERBASE}/areas/{{district_id}}/detections/export")
+async def exportAreaDetections(
+    district_id: int,
+    filter: DetectFilter = Depends(),
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+):
+    # 結果は全件を読み込まず、DBから読んだ分ずつ送る
+    chunks = iterateChunksAsync(
+        BicycleDetect.iterateExportAsync(district_id, filter), format
+    )
+    return StreamingResponse(
+        chunks,
+        media_type=getMediaType(format),
+        headers={
+            "Content-Disposition": f'attachment; filename="detections_{district_id}.{format}"'
+        },
+    )
@@ -0,0 +1,291 @@
+"""
+スキーマの一件取得(getOne)の読み込みキャッシュ。
+
+DBから取得したインスタンスをJSONにしてキャッシュし、期限(ttl)内の同じ問い合わせにはDBを使わずに答える。
+キャッシュ先はプロセス内のLRU(memory)か、ローカルのRedis互換サーバー(redis)を選べる。
+設定は configs/universal.json の schemaCache にある。backend を none にすると無効になる。
+Redisを使う場合は redis パッケージが別途必要。getOneAsync からは redis.asyncio を使い、イベントループを止めない。
+
+結果がNoneの問い合わせはキャッシュしないので、新しい行の追加ではキャッシュを消す必要は無い。
+:func:`invalidate` は、既存の行を更新・削除する処理から呼ぶためのもの。
+パスワードのハッシュなどを持つスキーマは sharedCacheAllowed をFalseにし、
+複数のプロセスで共有するキャッシュ(redis)には置かない。
+"""
+
+from __future__ import annotations
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from functools import lru_cache, wraps
+from inspect import iscoroutinefunction
+from json import load
+from pathlib import Path
+from threading import Lock
+from time import monotonic
+from typing import Any, Callable, NamedTuple, Optional
+
+from logging import getLogger
+
+try:
+    import redis
+    import redis.asyncio
+except ImportError:
+    redis = None
+
+logger = getLogger("BicycleCheck.schemacache")
+
+SCHEMACACHE_MAX_SIZE = 10000
+SCHEMACACHE_TTL_SECONDS = 60.0
+SCHEMACACHE_REDIS_URL = "redis://localhost:6379/0"
+
+
+class CacheStats(NamedTuple):
+    hitCount: int
+    missCount: int
+    evictCount: int
+    invalidateCount: int
+
+    def getHitRatio(self) -> float:
+        total = self.hitCount + self.missCount
+        return self.hitCount / total if total else 0.0
+
+
+class CacheBackend(ABC):
+    """
+    キャッシュ先の抽象クラス。値は文字列で保存する。
+    非同期版の getAsync / setAsync は、既定では同期版をそのまま呼ぶ
+    """
+
+    # 複数のプロセスで共有されるキャッシュか
+    isShared: bool = False
+    ttlSeconds: float
+    hitCount: int
+    missCount: int
+    evictCount: int
+    invalidateCount: int
+
+    def __init__(self, ttlSeconds: float) -> None:
+        self.ttlSeconds = ttlSeconds
+        self.hitCount = 0
+        self.missCount = 0
+        self.evictCount = 0
+        self.invalidateCount = 0
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def set(self, key: str, value: str) -> None:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        raise NotImplementedError()
+
+    async def getAsync(self, key: str) -> Optional[str]:
+        return self.get(key)
+
+    async def setAsync(self, key: str, value: str) -> None:
+        self.set(key, value)
+
+    def getStats(self) -> CacheStats:
+        return CacheStats(
+            self.hitCount, self.missCount, self.evictCount, self.invalidateCount
+        )
+
+
+class MemoryCache(CacheBackend):
+    """
+    プロセス内の、件数上限と期限つきのLRUキャッシュ
+    """
+
+    maxSize: int
+    _entries: OrderedDict[str, tuple[float, str]]
+    _lock: Lock
+
+    def __init__(
+        self,
+        maxSize: int = SCHEMACACHE_MAX_SIZE,
+        ttlSeconds: float = SCHEMACACHE_TTL_SECONDS,
+    ) -> None:
+        super().__init__(ttlSeconds)
+        self.maxSize = maxSize
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.missCount += 1
+                return None
+            expireTime, value = entry
+            if expireTime < monotonic():
+                del self._entries[key]
+                self.evictCount += 1
+                self.missCount += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hitCount += 1
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        with self._lock:
+            self._entries[key] = (monotonic() + self.ttlSeconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxSize:
+                self._entries.popitem(last=False)
+                self.evictCount += 1
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.invalidateCount += 1
+
+
+class RedisCache(CacheBackend):
+    """
+    Redis互換サーバーを使うキャッシュ。期限切れと追い出しはサーバー側で行われる。
+    複数のプロセスで同じキャッシュを共有できる。
+    非同期版は redis.asyncio のクライアントを使う。クライアントは最初に使われたイベントループの中で作る
+    """
+
+    isShared = True
+    url: str
+    _client: Any
+    _asyncClient: Any
+
+    def __init__(
+        self, url: str = SCHEMACACHE_REDIS_URL, ttlSeconds: float = SCHEMACACHE_TTL_SECONDS
+    ) -> None:
+        if redis is None:
+            raise ImportError("redis package is required for the redis schema cache")
+        super().__init__(ttlSeconds)
+        self.url = url
+        self._client = redis.Redis.from_url(url, decode_responses=True)
+        self._asyncClient = None
+
+    def _count(self, value: Optional[str]) -> Optional[str]:
+        if value is None:
+            self.missCount += 1
+        else:
+            self.hitCount += 1
+        return value
+
+    def _getAsyncClient(self) -> Any:
+        if self._asyncClient is None:
+            self._asyncClient = redis.asyncio.Redis.from_url(
+                self.url, decode_responses=True
+            )
+        return self._asyncClient
+
+    def get(self, key: str) -> Optional[str]:
+        return self._count(self._client.get(key))
+
+    def set(self, key: str, value: str) -> None:
+        self._client.set(key, value, px=int(self.ttlSeconds * 1000))
+
+    async def getAsync(self, key: str) -> Optional[str]:
+        return self._count(await self._getAsyncClient().get(key))
+
+    async def setAsync(self, key: str, value: str) -> None:
+        await self._getAsyncClient().set(key, value, px=int(self.ttlSeconds * 1000))
+
+    def delete(self, key: str) -> None:
+        if self._client.delete(key):
+            self.invalidateCount += 1
+
+    def getStats(self) -> CacheStats:
+        # サーバー側で追い出された件数
+        evictCount = int(self._client.info("stats").get("evicted_keys", 0))
+        return CacheStats(
+            self.hitCount, self.missCount, evictCount, self.invalidateCount
+        )
+
+
+@lru_cache(maxsize=1)
+def getSchemaCache() -> Optional[CacheBackend]:
+    """
+    プロセス内で共有するキャッシュを取得する。無効な場合はNone
+    """
+    cacheConfig: dict[str, Any] = {
+        "backend": "memory",
+        "maxSize": SCHEMACACHE_MAX_SIZE,
+        "ttl": SCHEMACACHE_TTL_SECONDS,
+        "redisUrl": SCHEMACACHE_REDIS_URL,
+    }
+    filepath = Path("configs/universal.json")
+    if filepath.exists():
+        with open(filepath, "r") as file:
+            cacheConfig.update(load(file).get("schemaCache", {}))
+    match cacheConfig["backend"]:
+        case "memory":
+            return MemoryCache(int(cacheConfig["maxSize"]), float(cacheConfig["ttl"]))
+        case "redis":
+            return RedisCache(cacheConfig["redisUrl"], float(cacheConfig["ttl"]))
+        case "none":
+            return None
+        case backend:
+            logger.warning(f"unknown schema cache backend '{backend}'. cache disabled")
+            return None
+
+
+def getCacheKey(tableName: str, id: Any) -> str:
+    return f"schema:{tableName}:{id}"
+
+
+def invalidate(tableName: str, id: Any) -> None:
+    """
+    既存の行を更新・削除した時に呼ぶ。追加した行は、まだキャッシュに無いので呼ばなくてよい
+    """
+    cache = getSchemaCache()
+    if cache is not None:
+        cache.delete(getCacheKey(tableName, id))
+
+
+def readThrough(function: Callable) -> Callable:
+    """
+    getOne/getOneAsync に付けるデコレータ。@classmethod の内側に付ける。
+    結果がNoneの場合はキャッシュしない。
+    クラスの sharedCacheAllowed がFalseなら、共有のキャッシュ(redis)は使わずに毎回DBを読む
+    """
+
+    def getCache(cls, id: Any) -> tuple[Optional[CacheBackend], str]:
+        cache = getSchemaCache()
+        if cache is not None and cache.isShared and not getattr(
+            cls, "sharedCacheAllowed", True
+        ):
+            cache = None
+        return cache, getCacheKey(cls.getTableName(), id)
+
+    if iscoroutinefunction(function):
+
+        @wraps(function)
+        async def wrapperAsync(cls, id: Any) -> Any:
+            cache, key = getCache(cls, id)
+            if cache is None:
+                return await function(cls, id)
+            value = await cache.getAsync(key)
+            if value is not None:
+                return cls.model_validate_json(value)
+            result = await function(cls, id)
+            if result is not None:
+                await cache.setAsync(key, result.model_dump_json(by_alias=True))
+            return result
+
+        return wrapperAsync
+
+    @wraps(function)
+    def wrapper(cls, id: Any) -> Any:
+        cache, key = getCache(cls, id)
+        if cache is None:
+            return function(cls, id)
+        value = cache.get(key)
+        if value is not None:
+            return cls.model_validate_json(value)
+        result = function(cls, id)
+        if result is not None:
+            cache.set(key, result.model_dump_json(by_alias=True))
+        return result
+
+    return wrapper
@@ -8,9 +8,13 @@ https://zenn.dev/sh0nk/books/537bb028709ab9/viewer/2c02d7
 """
 
 from __future__ import annotations
-from typing import Any
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from contextlib import asynccontextmanager, contextmanager
+from json import dumps as jsonDumps, loads as jsonLoads
+from typing import Any, AsyncGenerator, ClassVar, Generator, Iterable, Optional
 from abc import ABC, abstractmethod
 from datetime import datetime
+from math import ceil, floor
 
 from logging import getLogger
 
@@ -20,24 +24,132 @@ from fastapi.exceptions import HTTPException
 from pydantic import ValidationError
 from pydantic import BaseModel, Field
 
-from crud import getConnectionToDB, DatabaseError, get_select, insert_query
+from mysql.connector.pooling import PooledMySQLConnection
+from mysql.connector.aio.abstracts import MySQLConnectionAbstract as AsyncConnection
+
+from crud import (
+    borrowConnection,
+    DatabaseError,
+    PoolError,
+    get_select,
+    insert_query,
+    iterate_select,
+    bulk_insert_query,
+    DBBULK_BATCH_SIZE,
+    DBSTREAM_BATCH_SIZE,
+)
+from crudAsync import borrowConnectionAsync, get_select_async, iterate_select_async
+from geo import getHaversineMeters, getMetersPerDegree
+from schemaCache import readThrough
 import auth
 
 
 logger = getLogger("bicyclecheck.schemas")
 
+# チャンク1つの大きさ(度)。緯度方向に約111m、北緯35度付近の経度方向に約91m
+CHUNKDEGREES = 0.001
+# 「近い」とみなす距離(メートル)。チャンクの大きさ以下なら、周囲3×3チャンクだけを読めば済む
+DETECT_NEAR_METERS = 50.0
+# 一覧APIで一度に返す件数
+PAGE_DEFAULT_LIMIT = 50
+PAGE_MAX_LIMIT = 500
+
 
 """
 sqlデータベースに接続
 """
 
 
-def connectToDB():
+@contextmanager
+def connectToDB() -> Generator[PooledMySQLConnection, None, None]:
+    """
+    接続プールから接続を借りる。with文を抜けると接続はプールに返される
+    """
+    try:
+        with borrowConnection() as conn:
+            yield conn
+    except (DatabaseError, PoolError) as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR) from e
+
+
+@asynccontextmanager
+async def connectToDBAsync() -> AsyncGenerator[AsyncConnection, None]:
+    """
+    :func:`connectToDB` の非同期版。async with文を抜けると接続はプールに返される
+    """
     try:
-        conn = getConnectionToDB()
-    except DatabaseError as e:
+        async with borrowConnectionAsync() as conn:
+            yield conn
+    except (DatabaseError, PoolError) as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR) from e
-    return conn
+
+
+def getInPlaceholders(count: int) -> str:
+    """
+    IN句に count 個の値を渡すためのプレースホルダ
+    """
+    return ",".join(["%s"] * count)
+
+
+class Page(BaseModel):
+    """
+    一覧APIの1ページ。次のページは nextCursor を cursor に渡して取得する。最後のページではNone
+    """
+
+    items: list[dict[str, Any]]
+    nextCursor: Optional[str] = None
+
+
+def encodeCursor(values: list[Any]) -> str:
+    """
+    ページの最後の行のキーを、URLに載せられる文字列にする
+    """
+    text = jsonDumps(
+        [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    )
+    return urlsafe_b64encode(text.encode()).decode()
+
+
+def decodeCursor(cursor: str, types: tuple[type, ...]) -> list[Any]:
+    """
+    :func:`encodeCursor` の逆。キーの数と型が types と合わない場合も、400を返す
+    """
+    try:
+        values = jsonLoads(urlsafe_b64decode(cursor.encode()))
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="invalid cursor"
+        ) from e
+    # boolはintの派生クラスなので、型は完全に一致するものだけを通す
+    if (
+        not isinstance(values, list)
+        or len(values) != len(types)
+        or any(type(value) is not valueType for value, valueType in zip(values, types))
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="invalid cursor"
+        )
+    return values
+
+
+def getProjection(
+    fields: Optional[str], columnsByField: dict[str, tuple[str, ...]]
+) -> tuple[list[str], list[str]]:
+    """
+    カンマ区切りのフィールド名から、返すフィールドとSELECTする列を求める。省略した場合は全て
+    """
+    if fields is None:
+        names = list(columnsByField)
+    else:
+        names = [name.strip() for name in fields.split(",") if name.strip()]
+        unknownNames = [name for name in names if name not in columnsByField]
+        if unknownNames:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"unknown fields: {','.join(unknownNames)}",
+            )
+    columns = list(dict.fromkeys(column for name in names for column in columnsByField[name]))
+    return names, columns
 
 
 """
@@ -64,6 +176,13 @@ class SqlObject(ABC):
         """
         f"SELECT * FROM {cls.getTableName()} where id={id} LIMIT 1"
 
+    @classmethod
+    @abstractmethod
+    async def getOneAsync(cls, id: int) -> Any | None:
+        """
+        :meth:`getOne` の非同期版。FastAPIのハンドラからはこちらを使う (cRud)
+        """
+
     # @classmethod
     # @abstractmethod
     # def getAll(cls) -> list:
@@ -76,16 +195,19 @@ class SqlObject(ABC):
     def create(self) -> None:
         """
         スキーマインスタンスを元に、DB上にレコードを追加する (Crud)
+        自動採番されたidは、インスタンスのidフィールドに反映する
         """
 
     # def update(self) -> None:
     #     """
     #     スキーマインスタンスを元に、DB上のレコードを更新する (crUd)
+    #     getOneの結果はキャッシュされているので、schemaCache.invalidate を呼ぶこと
     #     """
 
     # def delete(self) -> None:
     #     """
     #     スキーマインスタンスのidを元に、DB上のレコードを削除する (cruD)
+    #     getOneの結果はキャッシュされているので、schemaCache.invalidate を呼ぶこと
     #     """
 
 
@@ -109,13 +231,42 @@ class Bicycle(Schema):
     def getTableName(cls) -> str:
         return "bike_info"
 
+    @classmethod
+    def getInsertQuery(cls) -> str:
+        return f"INSERT INTO {cls.getTableName()} ( handled_flg ) VALUES (%s)"
+
+    def getInsertValue(self) -> tuple:
+        return (self.handled_flg,)
+
     def create(self) -> None:
-        query = f"INSERT INTO {self.getTableName()} ( handled_flg ) VALUES (%s)"
-        value = (self.handled_flg,)
-        conn = connectToDB()
-        insert_query(query, value, conn)
+        with connectToDB() as conn:
+            lastId = insert_query(self.getInsertQuery(), self.getInsertValue(), conn)
+        if lastId is not None:
+            self.bicycle_id = lastId
+
+    @classmethod
+    def bulkCreate(
+        cls, bicycles: Iterable[Bicycle], batchSize: int = DBBULK_BATCH_SIZE
+    ) -> list[Bicycle]:
+        """
+        複数の自転車を batchSize 件ずつまとめてDBに追加し、採番されたidを各インスタンスに反映する。
+        追加に失敗したバッチのインスタンスは、idが変わらないまま返される
+        """
+        bicycles = list(bicycles)
+        with connectToDB() as conn:
+            ids = bulk_insert_query(
+                cls.getInsertQuery(),
+                (bicycle.getInsertValue() for bicycle in bicycles),
+                batchSize,
+                conn,
+            )
+        for bicycle, lastId in zip(bicycles, ids):
+            if lastId is not None:
+                bicycle.bicycle_id = lastId
+        return bicycles
 
     @classmethod
+    @readThrough
     def getOne(
         cls,
         id: int,
@@ -123,9 +274,9 @@ class Bicycle(Schema):
         """
         指定されたidを元に、bike_infoテーブルからデータを一つ取得し、Bicycleスキーマのインスタンスにする。
         """
-        conn = connectToDB()
         query = f"SELECT * FROM {cls.getTableName()} WHERE bicycle_id={id}"
-        rows: list[dict] = get_select(query, conn)
+        with connectToDB() as conn:
+            rows: list[dict] = get_select(query, conn)
         if rows and isinstance(rows, list):
             try:
                 return Bicycle(**rows[0])
@@ -133,6 +284,72 @@ class Bicycle(Schema):
                 raise ValueError(f"failed to validate data: {e}") from e
         return None
 
+    @classmethod
+    @readThrough
+    async def getOneAsync(cls, id: int) -> Bicycle | None:
+        query = f"SELECT * FROM {cls.getTableName()} WHERE bicycle_id = %s LIMIT 1"
+        async with connectToDBAsync() as conn:
+            rows: list[dict] = await get_select_async(query, (id,), conn)
+        if rows:
+            try:
+                return Bicycle(**rows[0])
+            except ValidationError as e:
+                raise ValueError(f"failed to validate data: {e}") from e
+        return None
+
+    @classmethod
+    def getByIds(cls, ids: Iterable[int]) -> dict[int, Bicycle]:
+        """
+        複数のidの自転車を一度の問い合わせで取得する
+        """
+        ids = list(set(ids))
+        if not ids:
+            return {}
+        query = f"SELECT * FROM {cls.getTableName()} WHERE bicycle_id IN ({getInPlaceholders(len(ids))})"
+        with connectToDB() as conn:
+            rows: list[dict] = get_select(query, conn, tuple(ids))
+        return {row["bicycle_id"]: Bicycle(**row) for row in rows}
+
+    @classmethod
+    async def getPageAsync(
+        cls,
+        cursor: Optional[str] = None,
+        limit: int = PAGE_DEFAULT_LIMIT,
+        handled_flg: Optional[bool] = None,
+        fields: Optional[str] = None,
+    ) -> Page:
+        """
+        自転車の一覧を bicycle_id の順に1ページ分取得する。
+        前のページの最後のidより後ろを主キーで探すので、何ページ目でも同じ速さで返る
+        """
+        names, columns = getProjection(
+            fields, {"bicycle_id": ("bicycle_id",), "handled_flg": ("handled_flg",)}
+        )
+        if "bicycle_id" not in columns:
+            columns.append("bicycle_id")
+        conditions: list[str] = []
+        params: list[Any] = []
+        if cursor is not None:
+            conditions.append("bicycle_id > %s")
+            params.extend(decodeCursor(cursor, (int,)))
+        if handled_flg is not None:
+            conditions.append("handled_flg = %s")
+            params.append(handled_flg)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        # 次のページがあるかを知るため、1件多く取得する
+        query = f"SELECT {','.join(columns)} FROM {cls.getTableName()} {where} ORDER BY bicycle_id LIMIT %s"
+        params.append(limit + 1)
+        async with connectToDBAsync() as conn:
+            rows: list[dict] = await get_select_async(query, tuple(params), conn)
+        nextCursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            nextCursor = encodeCursor([rows[-1]["bicycle_id"]])
+        return Page(
+            items=[{name: row[name] for name in names} for row in rows],
+            nextCursor=nextCursor,
+        )
+
     def getDetects(self) -> list[BicycleDetect]:
         """
         この自転車idに紐づいている自転車発見事例を全て取得する
@@ -163,11 +380,14 @@ class BicycleDetect(Schema):
     has_basket: bool = Field(...)
     has_childseat: bool = Field(...)
 
-    def create(self) -> None:
+    @classmethod
+    def getInsertQuery(cls) -> str:
+        return f"INSERT INTO {cls.getTableName()}(bicycle_id,runtime_id,detection_time,x_chunk,y_chunk,x_fractional,y_fractional,image_path,color,has_basket,has_childseat) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)"
+
+    def getInsertValue(self) -> tuple:
         x_chunk, x_fractional = self.coordinateActualToChunked(self.coordinate_x)
         y_chunk, y_fractional = self.coordinateActualToChunked(self.coordinate_y)
-        query = f"INSERT INTO {self.getTableName()}(bicycle_id,runtime_id,detection_time,x_chunk,y_chunk,x_fractional,y_fractional,image_path,color,has_basket,has_childseat) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)"
-        value = (
+        return (
             self.bicycle_id,
             self.runtime_id,
             self.detection_time,
@@ -180,8 +400,33 @@ class BicycleDetect(Schema):
             self.has_basket,
             self.has_childseat,
         )
-        conn = connectToDB()
-        insert_query(query, value, conn)
+
+    def create(self) -> None:
+        with connectToDB() as conn:
+            lastId = insert_query(self.getInsertQuery(), self.getInsertValue(), conn)
+        if lastId is not None:
+            self.instance_id = lastId
+
+    @classmethod
+    def bulkCreate(
+        cls, detects: Iterable[BicycleDetect], batchSize: int = DBBULK_BATCH_SIZE
+    ) -> list[BicycleDetect]:
+        """
+        複数の検出事例を batchSize 件ずつまとめてDBに追加し、採番されたidを各インスタンスに反映する。
+        追加に失敗したバッチのインスタンスは、idが変わらないまま返される
+        """
+        detects = list(detects)
+        with connectToDB() as conn:
+            ids = bulk_insert_query(
+                cls.getInsertQuery(),
+                (detect.getInsertValue() for detect in detects),
+                batchSize,
+                conn,
+            )
+        for detect, lastId in zip(detects, ids):
+            if lastId is not None:
+                detect.instance_id = lastId
+        return detects
 
     @classmethod
     def getTableName(cls) -> str:
@@ -189,23 +434,98 @@ class BicycleDetect(Schema):
 
     @classmethod
     def coordinateActualToChunked(cls, coordinateActual: float) -> tuple[int, float]:
-        raise NotImplementedError()
+        """
+        実座標(度)を、チャンク番号とチャンク内の位置(0以上1未満)に分ける
+        """
+        position = coordinateActual / CHUNKDEGREES
+        chunk = floor(position)
+        return chunk, position - chunk
 
     @classmethod
     def coordinateChunkedToActual(cls, chunkedCoordinate: tuple[int, float]) -> float:
-        raise NotImplementedError()
+        chunk, fractional = chunkedCoordinate
+        return (chunk + fractional) * CHUNKDEGREES
+
+    @classmethod
+    def fromRow(cls, row: dict[str, Any]) -> BicycleDetect:
+        """
+        DBの行から、座標を実座標に戻してインスタンスを作る
+        """
+        row = dict(row)
+        row["coordinate_x"] = cls.coordinateChunkedToActual(
+            (row.pop("x_chunk"), row.pop("x_fractional"))
+        )
+        row["coordinate_y"] = cls.coordinateChunkedToActual(
+            (row.pop("y_chunk"), row.pop("y_fractional"))
+        )
+        return cls(**row)
 
     @classmethod
+    def getNearQuery(
+        cls, coordinate_x: float, coordinate_y: float, radiusMeters: float
+    ) -> tuple[str, tuple[int, ...]]:
+        """
+        指定された座標から radiusMeters 以内に入りうるチャンクの行を取得するクエリ。
+        (x_chunk, y_chunk) の組を列挙するので、複合インデックスの点検索になる
+        """
+        metersPerX, metersPerY = getMetersPerDegree(coordinate_y)
+        spanX = ceil(radiusMeters / (CHUNKDEGREES * metersPerX))
+        spanY = ceil(radiusMeters / (CHUNKDEGREES * metersPerY))
+        centerX = cls.coordinateActualToChunked(coordinate_x)[0]
+        centerY = cls.coordinateActualToChunked(coordinate_y)[0]
+        chunks = [
+            (x, y)
+            for x in range(centerX - spanX, centerX + spanX + 1)
+            for y in range(centerY - spanY, centerY + spanY + 1)
+        ]
+        placeholders = ",".join(["(%s,%s)"] * len(chunks))
+        query = f"SELECT * FROM {cls.getTableName()} WHERE (x_chunk,y_chunk) IN ({placeholders})"
+        return query, tuple(value for chunk in chunks for value in chunk)
+
+    @classmethod
+    def filterByDistance(
+        cls,
+        detects: list[BicycleDetect],
+        coordinate_x: float,
+        coordinate_y: float,
+        radiusMeters: float,
+    ) -> list[BicycleDetect]:
+        """
+        実際の距離が radiusMeters 以内のものだけを、近い順に並べて返す
+        """
+        if not detects:
+            return []
+        distances = getHaversineMeters(
+            coordinate_y,
+            coordinate_x,
+            [detect.coordinate_y for detect in detects],
+            [detect.coordinate_x for detect in detects],
+        )
+        order = distances.argsort()
+        return [detects[i] for i in order if distances[i] <= radiusMeters]
+
+    @classmethod
+    @readThrough
     def getOne(cls, id: int) -> BicycleDetect | None:
         """
         指定されたidを元に、bike_infoテーブルからデータを一つ取得し、Bicycleスキーマのインスタンスにする。
         DB上では座標はチャンク番号と端数番号に分解されているので、 coordinateChunkedToActualを利用して実座標に変換すること。
         """
-        conn = connectToDB()
         query = f"SELECT * FROM {cls.getTableName()} WHERE instance_id = {id} LIMIT 1"
-        rows: list[dict] = get_select(query, conn)
+        with connectToDB() as conn:
+            rows: list[dict] = get_select(query, conn)
         if rows and isinstance(rows, list):
-            return BicycleDetect(**rows[0])
+            return cls.fromRow(rows[0])
+        return None
+
+    @classmethod
+    @readThrough
+    async def getOneAsync(cls, id: int) -> BicycleDetect | None:
+        query = f"SELECT * FROM {cls.getTableName()} WHERE instance_id = %s LIMIT 1"
+        async with connectToDBAsync() as conn:
+            rows: list[dict] = await get_select_async(query, (id,), conn)
+        if rows:
+            return cls.fromRow(rows[0])
         return None
 
     @classmethod
@@ -213,35 +533,274 @@ class BicycleDetect(Schema):
         """
         DB上から、特定の自転車idに紐づいている発見事例レコードを全て取得する
         """
-        conn = connectToDB()
         query = f"SELECT * FROM {cls.getTableName()} where bicycle_id={bicycleId}"
         result: list[BicycleDetect] = []
-        rows: list[dict] = get_select(query, conn)
+        with connectToDB() as conn:
+            rows: list[dict] = get_select(query, conn)
         for row in rows:
-            result.append(BicycleDetect(**row))
+            result.append(cls.fromRow(row))
         return result
 
+    @classmethod
+    async def getByBicycleIdAsync(cls, bicycleId: int) -> list[BicycleDetect]:
+        query = f"SELECT * FROM {cls.getTableName()} WHERE bicycle_id = %s"
+        async with connectToDBAsync() as conn:
+            rows: list[dict] = await get_select_async(query, (bicycleId,), conn)
+        return [cls.fromRow(row) for row in rows]
+
     @classmethod
     def getByRuntimeId(cls, runtime_id: int) -> list[BicycleDetect]:
-        conn = connectToDB()
         query = f"SELECT * FROM {cls.getTableName()} WHERE runtime_id = {runtime_id}"
         result: list[BicycleDetect] = []
-        rows: list[dict] = get_select(query, conn)
+        with connectToDB() as conn:
+            rows: list[dict] = get_select(query, conn)
         for row in rows:
-            result.append(BicycleDetect(**row))
+            result.append(cls.fromRow(row))
         return result
 
+    @classmethod
+    async def getByRuntimeIdAsync(cls, runtime_id: int) -> list[BicycleDetect]:
+        query = f"SELECT * FROM {cls.getTableName()} WHERE runtime_id = %s"
+        async with connectToDBAsync() as conn:
+            rows: list[dict] = await get_select_async(query, (runtime_id,), conn)
+        return [cls.fromRow(row) for row in rows]
+
+    @classmethod
+    def getByBicycleIds(cls, bicycleIds: Iterable[int]) -> dict[int, list[BicycleDetect]]:
+        """
+        複数の自転車idに紐づく発見事例を一度の問い合わせで取得し、自転車idごとにまとめる
+        """
+        return cls._getGroupedBy("bicycle_id", bicycleIds)
+
+    @classmethod
+    def getByRuntimeIds(cls, runtimeIds: Iterable[int]) -> dict[int, list[BicycleDetect]]:
+        """
+        複数の走行idに紐づく発見事例を一度の問い合わせで取得し、走行idごとにまとめる
+        """
+        return cls._getGroupedBy("runtime_id", runtimeIds)
+
+    @classmethod
+    def _getGroupedBy(
+        cls, column: str, ids: Iterable[int]
+    ) -> dict[int, list[BicycleDetect]]:
+        ids = list(set(ids))
+        result: dict[int, list[BicycleDetect]] = {id: [] for id in ids}
+        if not ids:
+            return result
+        query = f"SELECT * FROM {cls.getTableName()} WHERE {column} IN ({getInPlaceholders(len(ids))}) ORDER BY detection_time"
+        with connectToDB() as conn:
+            rows: list[dict] = get_select(query, conn, tuple(ids))
+        for row in rows:
+            result[row[column]].append(cls.fromRow(row))
+        return result
+
+    @classmethod
+    async def getPageByRuntimeIdAsync(
+        cls,
+        runtime_id: int,
+        filter: DetectFilter,
+        cursor: Optional[str] = None,
+        limit: int = PAGE_DEFAULT_LIMIT,
+        fields: Optional[str] = None,
+    ) -> Page:
+        """
+        走行の発見事例を、検出日時の順に1ページ分取得する
+        """
+        return await cls._getPageAsync(
+            "", "k.runtime_id = %s", runtime_id, filter, cursor, limit, fields
+        )
+
+    @classmethod
+    async def getPageByAreaIdAsync(
+        cls,
+        district_id: int,
+        filter: DetectFilter,
+        cursor: Optional[str] = None,
+        limit: int = PAGE_DEFAULT_LIMIT,
+        fields: Optional[str] = None,
+    ) -> Page:
+        """
+        管区の車両による発見事例を、検出日時の順に1ページ分取得する
+        """
+        join = f"JOIN {Run.getTableName()} r ON k.runtime_id = r.runtime_id JOIN {Car.getTableName()} c ON r.vehicle_id = c.vehicle_id"
+        return await cls._getPageAsync(
+            join, "c.district_id = %s", district_id, filter, cursor, limit, fields
+        )
+
+    @classmethod
+    async def _getPageAsync(
+        cls,
+        join: str,
+        parentCondition: str,
+        parentId: int,
+        filter: DetectFilter,
+        cursor: Optional[str],
+        limit: int,
+        fields: Optional[str],
+    ) -> Page:
+        """
+        (detection_time, instance_id) をキーにしたページ分割。
+        前のページの最後の行より後ろをインデックスで探すので、何ページ目でも同じ速さで返る
+        """
+        names, columns = getProjection(fields, DETECT_COLUMNS_BY_FIELD)
+        for column in ("detection_time", "instance_id"):
+            if column not in columns:
+                columns.append(column)
+        conditions = [parentCondition]
+        params: list[Any] = [parentId]
+        if cursor is not None:
+            lastTime, lastId = decodeCursor(cursor, (str, int))
+            try:
+                lastTime = datetime.fromisoformat(lastTime)
+            except ValueError as e:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST, detail="invalid cursor"
+                ) from e
+            conditions.append(
+                "(k.detection_time > %s OR (k.detection_time = %s AND k.instance_id > %s))"
+            )
+            params.extend([lastTime, lastTime, lastId])
+        filterConditions, filterParams = filter.getConditions()
+        conditions.extend(filterConditions)
+        params.extend(filterParams)
+        query = f"SELECT {','.join(f'k.{column}' for column in columns)} FROM {cls.getTableName()} k {join} WHERE {' AND '.join(conditions)} ORDER BY k.detection_time, k.instance_id LIMIT %s"
+        params.append(limit + 1)
+        async with connectToDBAsync() as conn:
+            rows: list[dict] = await get_select_async(query, tuple(params), conn)
+        nextCursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            nextCursor = encodeCursor(
+                [rows[-1]["detection_time"], rows[-1]["instance_id"]]
+            )
+        items: list[dict[str, Any]] = []
+        for row in rows:
+            item: dict[str, Any] = {}
+            for name in names:
+                if name == "coordinate_x":
+                    item[name] = cls.coordinateChunkedToActual(
+                        (row["x_chunk"], row["x_fractional"])
+                    )
+                elif name == "coordinate_y":
+                    item[name] = cls.coordinateChunkedToActual(
+                        (row["y_chunk"], row["y_fractional"])
+                    )
+                else:
+                    item[name] = row[name]
+            items.append(item)
+        return Page(items=items, nextCursor=nextCursor)
+
+    @classmethod
+    def getExportQuery(
+        cls, district_id: Optional[int], filter: DetectFilter
+    ) -> tuple[str, tuple[Any, ...]]:
+        """
+        書き出し用のクエリ。district_id がNoneなら全管区
+        """
+        columns = [
+            f"k.{column}"
+            for columns in DETECT_COLUMNS_BY_FIELD.values()
+            for column in columns
+        ]
+        join = ""
+        conditions, params = filter.getConditions()
+        if district_id is not None:
+            join = f"JOIN {Run.getTableName()} r ON k.runtime_id = r.runtime_id JOIN {Car.getTableName()} c ON r.vehicle_id = c.vehicle_id"
+            conditions.insert(0, "c.district_id = %s")
+            params.insert(0, district_id)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        query = f"SELECT {','.join(columns)} FROM {cls.getTableName()} k {join} {where} ORDER BY k.detection_time, k.instance_id"
+        return query, tuple(params)
+
+    @classmethod
+    def toExportRow(cls, row: dict[str, Any]) -> dict[str, Any]:
+        """
+        DBの行を、座標を実座標に戻した書き出し用の辞書にする。
+        件数が多いので、インスタンスは作らない
+        """
+        return {
+            "instance_id": row["instance_id"],
+            "bicycle_id": row["bicycle_id"],
+            "runtime_id": row["runtime_id"],
+            "detection_time": row["detection_time"],
+            "coordinate_x": cls.coordinateChunkedToActual(
+                (row["x_chunk"], row["x_fractional"])
+            ),
+            "coordinate_y": cls.coordinateChunkedToActual(
+                (row["y_chunk"], row["y_fractional"])
+            ),
+            "image_path": row["image_path"],
+            "color": row["color"],
+            "has_basket": bool(row["has_basket"]),
+            "has_childseat": bool(row["has_childseat"]),
+        }
+
+    @classmethod
+    def iterateExport(
+        cls,
+        district_id: Optional[int],
+        filter: DetectFilter,
+        batchSize: int = DBSTREAM_BATCH_SIZE,
+    ) -> Generator[list[dict[str, Any]], None, None]:
+        """
+        条件に合う発見事例を、検出日時の順に batchSize 件ずつ返す。全件をメモリに載せることはない
+        """
+        query, params = cls.getExportQuery(district_id, filter)
+        with connectToDB() as conn:
+            for rows in iterate_select(query, params, batchSize, conn):
+                yield [cls.toExportRow(row) for row in rows]
+
+    @classmethod
+    async def iterateExportAsync(
+        cls,
+        district_id: Optional[int],
+        filter: DetectFilter,
+        batchSize: int = DBSTREAM_BATCH_SIZE,
+    ) -> AsyncGenerator[list[dict[str, Any]], None]:
+        query, params = cls.getExportQuery(district_id, filter)
+        async with connectToDBAsync() as conn:
+            async for rows in iterate_select_async(query, params, batchSize, conn):
+                yield [cls.toExportRow(row) for row in rows]
+
+    @classmethod
+    def getSince(cls, since: datetime) -> list[BicycleDetect]:
+        """
+        指定した日時以降の検出事例を、検出日時の順に全て取得する
+        """
+        query = f"SELECT * FROM {cls.getTableName()} WHERE detection_time >= %s ORDER BY detection_time"
+        with connectToDB() as conn:
+            rows: list[dict] = get_select(query, conn, (since,))
+        return [cls.fromRow(row) for row in rows]
+
     @classmethod
     def getByCoordinates(
-        cls, coordinate_x: float, coordinate_y: float
+        cls,
+        coordinate_x: float,
+        coordinate_y: float,
+        radiusMeters: float = DETECT_NEAR_METERS,
     ) -> list[BicycleDetect]:
         """
-        指定された座標に近い自転車検出事例を全て取得する。
-        「近い座標」の考慮にはチャンク座標を用いる。
+        指定された座標に近い自転車検出事例を全て、近い順に取得する。
+        周囲のチャンクだけをDBから読み、実際の距離で絞り込む。
         """
-        coordinate_chunk_x: int = cls.coordinateActualToChunked(coordinate_x)[0]
-        coordinate_chunk_y: int = cls.coordinateActualToChunked(coordinate_y)[0]
-        f"SELECT * FROM {cls.getTableName()} WHERE ..."  # TODO クエリを完成させる
+        query, params = cls.getNearQuery(coordinate_x, coordinate_y, radiusMeters)
+        with connectToDB() as conn:
+            rows: list[dict] = get_select(query, conn, params)
+        detects = [cls.fromRow(row) for row in rows]
+        return cls.filterByDistance(detects, coordinate_x, coordinate_y, radiusMeters)
+
+    @classmethod
+    async def getByCoordinatesAsync(
+        cls,
+        coordinate_x: float,
+        coordinate_y: float,
+        radiusMeters: float = DETECT_NEAR_METERS,
+    ) -> list[BicycleDetect]:
+        query, params = cls.getNearQuery(coordinate_x, coordinate_y, radiusMeters)
+        async with connectToDBAsync() as conn:
+            rows: list[dict] = await get_select_async(query, params, conn)
+        detects = [cls.fromRow(row) for row in rows]
+        return cls.filterByDistance(detects, coordinate_x, coordinate_y, radiusMeters)
 
     def getBicycle(self) -> Bicycle | None:
         """
@@ -261,7 +820,54 @@ class BicycleDetect(Schema):
         自身の座標に近い自転車検出事例を全て取得する。
         自身は除外。
         """
-        return self.getByCoordinates(self.coordinate_x, self.coordinate_y)
+        return [
+            detect
+            for detect in self.getByCoordinates(self.coordinate_x, self.coordinate_y)
+            if detect.instance_id != self.instance_id
+        ]
+
+
+# 発見事例の一覧で選べるフィールドと、そのために読む列
+DETECT_COLUMNS_BY_FIELD: dict[str, tuple[str, ...]] = {
+    "instance_id": ("instance_id",),
+    "bicycle_id": ("bicycle_id",),
+    "runtime_id": ("runtime_id",),
+    "detection_time": ("detection_time",),
+    "coordinate_x": ("x_chunk", "x_fractional"),
+    "coordinate_y": ("y_chunk", "y_fractional"),
+    "image_path": ("image_path",),
+    "color": ("color",),
+    "has_basket": ("has_basket",),
+    "has_childseat": ("has_childseat",),
+}
+
+
+class DetectFilter(BaseModel):
+    """
+    発見事例の一覧の絞り込み条件。FastAPIではクエリパラメータとして受け取る
+    """
+
+    color: Optional[str] = None
+    has_basket: Optional[bool] = None
+    has_childseat: Optional[bool] = None
+    since: Optional[datetime] = None
+    until: Optional[datetime] = None
+
+    def getConditions(self) -> tuple[list[str], list[Any]]:
+        conditions: list[str] = []
+        params: list[Any] = []
+        for column in ("color", "has_basket", "has_childseat"):
+            value = getattr(self, column)
+            if value is not None:
+                conditions.append(f"k.{column} = %s")
+                params.append(value)
+        if self.since is not None:
+            conditions.append("k.detection_time >= %s")
+            params.append(self.since)
+        if self.until is not None:
+            conditions.append("k.detection_time < %s")
+            params.append(self.until)
+        return conditions, params
 
 
 class Area(Schema):
@@ -279,18 +885,65 @@ class Area(Schema):
     def create(self):
         query = f"INSERT INTO {self.getTableName()}(name) VALUES (%s)"
         value = (self.name,)
-        conn = connectToDB()
-        insert_query(query, value, conn)
+        with connectToDB() as conn:
+            lastId = insert_query(query, value, conn)
+        if lastId is not None:
+            self.district_id = lastId
 
     @classmethod
+    @readThrough
     def getOne(cls, id: int) -> Area | None:
-        conn = connectToDB()
         query = f"SELECT * FROM {cls.getTableName()} WHERE district_id = {id} LIMIT 1"
-        rows: list[dict] = get_select(query, conn)
+        with connectToDB() as conn:
+            rows: list[dict] = get_select(query, conn)
         if rows and isinstance(rows, list):
             return Area(**rows[0])
         return None
 
+    @classmethod
+    @readThrough
+    async def getOneAsync(cls, id: int) -> Area | None:
+        query = f"SELECT * FROM {cls.getTableName()} WHERE district_id = %s LIMIT 1"
+        async with connectToDBAsync() as conn:
+            rows: list[dict] = await get_select_async(query, (id,), conn)
+        if rows:
+            return Area(**rows[0])
+        return None
+
+    @classmethod
+    def loadTree(cls, district_id: int) -> AreaTree | None:
+        """
+        管区 → 車両 → 走行 → 発見事例 と、発見事例の自転車をまとめて取得する。
+        階層の深さ分の決まった回数(5回)しか問い合わせない
+        """
+        area = cls.getOne(district_id)
+        if area is None:
+            return None
+        cars = Car.getByAreaIds([district_id])[district_id]
+        runsByCar = Run.getByCarIds(car.vehicle_id for car in cars)
+        detectsByRun = BicycleDetect.getByRuntimeIds(
+            run.runtime_id for runs in runsByCar.values() for run in runs
+        )
+        bicycles = Bicycle.getByIds(
+            detect.bicycle_id
+            for detects in detectsByRun.values()
+            for detect in detects
+        )
+        return AreaTree(
+            area=area,
+            cars=[
+                CarTree(
+                    car=car,
+                    runs=[
+                        RunTree(run=run, detects=detectsByRun[run.runtime_id])
+                        for run in runsByCar[car.vehicle_id]
+                    ],
+                )
+                for car in cars
+            ],
+            bicycles=bicycles,
+        )
+
     def getCars(self) -> list[Car]:
         """
         この管区に紐づく車両クラスを全て取得する
@@ -317,31 +970,67 @@ class Car(Schema):
             self.vehicle_name,
             self.district_id,
         )
-        conn = connectToDB()
-        insert_query(query, value, conn)
+        with connectToDB() as conn:
+            lastId = insert_query(query, value, conn)
+        if lastId is not None:
+            self.vehicle_id = lastId
 
     @classmethod
+    @readThrough
     def getOne(cls, id: int) -> Car | None:
-        conn = connectToDB()
         query = f"SELECT * FROM {cls.getTableName()} WHERE vehicle_id = {id} LIMIT 1"
-        rows: list[dict] = get_select(query, conn)
+        with connectToDB() as conn:
+            rows: list[dict] = get_select(query, conn)
         if rows and isinstance(rows, list):
             return Car(**rows[0])
         return None
 
+    @classmethod
+    @readThrough
+    async def getOneAsync(cls, id: int) -> Car | None:
+        query = f"SELECT * FROM {cls.getTableName()} WHERE vehicle_id = %s LIMIT 1"
+        async with connectToDBAsync() as conn:
+            rows: list[dict] = await get_select_async(query, (id,), conn)
+        if rows:
+            return Car(**rows[0])
+        return None
+
     @classmethod
     def getByAreaId(cls, areaId: int) -> list[Car]:
         """
         特定の管区に紐づく車両を全て取得する
         """
-        conn = connectToDB()
         query = f"SELECT * FROM {cls.getTableName()} WHERE district_id = {areaId}"
         result: list[Car] = []
-        rows: list[dict] = get_select(query, conn)
+        with connectToDB() as conn:
+            rows: list[dict] = get_select(query, conn)
         for row in rows:
             result.append(Car(**row))
         return result
 
+    @classmethod
+    async def getByAreaIdAsync(cls, areaId: int) -> list[Car]:
+        query = f"SELECT * FROM {cls.getTableName()} WHERE district_id = %s"
+        async with connectToDBAsync() as conn:
+            rows: list[dict] = await get_select_async(query, (areaId,), conn)
+        return [Car(**row) for row in rows]
+
+    @classmethod
+    def getByAreaIds(cls, areaIds: Iterable[int]) -> dict[int, list[Car]]:
+        """
+        複数の管区に紐づく車両を一度の問い合わせで取得し、管区idごとにまとめる
+        """
+        areaIds = list(set(areaIds))
+        result: dict[int, list[Car]] = {areaId: [] for areaId in areaIds}
+        if not areaIds:
+            return result
+        query = f"SELECT * FROM {cls.getTableName()} WHERE district_id IN ({getInPlaceholders(len(areaIds))})"
+        with connectToDB() as conn:
+            rows: list[dict] = get_select(query, conn, tuple(areaIds))
+        for row in rows:
+            result[row["district_id"]].append(Car(**row))
+        return result
+
     def getRuns(self) -> list[Run]:
         """
         この車両に紐づく走行を全て取得する
@@ -372,31 +1061,88 @@ class Run(Schema):
             self.Run_start,
             self.Run_fin,
         )
-        conn = connectToDB()
-        insert_query(query, value, conn)
+        with connectToDB() as conn:
+            lastId = insert_query(query, value, conn)
+        if lastId is not None:
+            self.runtime_id = lastId
 
     @classmethod
+    @readThrough
     def getOne(cls, id: int) -> Run | None:
-        conn = connectToDB()
         query = f"SELECT * FROM {cls.getTableName()} WHERE runtime_id = {id} LIMIT 1"
-        rows: list[dict] = get_select(query, conn)
+        with connectToDB() as conn:
+            rows: list[dict] = get_select(query, conn)
         if rows and isinstance(rows, list):
             return Run(**rows[0])
         return None
 
+    @classmethod
+    @readThrough
+    async def getOneAsync(cls, id: int) -> Run | None:
+        query = f"SELECT * FROM {cls.getTableName()} WHERE runtime_id = %s LIMIT 1"
+        async with connectToDBAsync() as conn:
+            rows: list[dict] = await get_select_async(query, (id,), conn)
+        if rows:
+            return Run(**rows[0])
+        return None
+
     @classmethod
     def getByCarId(cls, carId: int) -> list[Run]:
         """
         特定の車両に紐づく走行を全て取得する
         """
-        conn = connectToDB()
         query = f"SELECT * FROM {cls.getTableName()} WHERE vehicle_id = {carId}"
         result: list[Run] = []
-        rows: list[dict] = get_select(query, conn)
+        with connectToDB() as conn:
+            rows: list[dict] = get_select(query, conn)
         for row in rows:
             result.append(Run(**row))
         return result
 
+    @classmethod
+    async def getByCarIdAsync(cls, carId: int) -> list[Run]:
+        query = f"SELECT * FROM {cls.getTableName()} WHERE vehicle_id = %s"
+        async with connectToDBAsync() as conn:
+            rows: list[dict] = await get_select_async(query, (carId,), conn)
+        return [Run(**row) for row in rows]
+
+
+    @classmethod
+    def getByCarIds(cls, carIds: Iterable[int]) -> dict[int, list[Run]]:
+        """
+        複数の車両に紐づく走行を一度の問い合わせで取得し、車両idごとにまとめる
+        """
+        carIds = list(set(carIds))
+        result: dict[int, list[Run]] = {carId: [] for carId in carIds}
+        if not carIds:
+            return result
+        query = f"SELECT * FROM {cls.getTableName()} WHERE vehicle_id IN ({getInPlaceholders(len(carIds))}) ORDER BY Run_start"
+        with connectToDB() as conn:
+            rows: list[dict] = get_select(query, conn, tuple(carIds))
+        for row in rows:
+            result[row["vehicle_id"]].append(Run(**row))
+        return result
+
+
+class RunTree(BaseModel):
+    run: Run
+    detects: list[BicycleDetect]
+
+
+class CarTree(BaseModel):
+    car: Car
+    runs: list[RunTree]
+
+
+class AreaTree(BaseModel):
+    """
+    :meth:`Area.loadTree` の結果。自転車は、発見事例の bicycle_id から引く
+    """
+
+    area: Area
+    cars: list[CarTree]
+    bicycles: dict[int, Bicycle]
+
 
 class User(BaseModel):
     """
@@ -409,8 +1155,11 @@ class User(BaseModel):
     email: str = Field(...)
 
     @classmethod
-    def login(cls, form: OAuth2PasswordRequestForm = Depends()) -> "AccessToken":
-        if not auth.AuthUser(form.username, form.password):
+    async def login(
+        cls, form: OAuth2PasswordRequestForm = Depends()
+    ) -> "AccessToken":
+        user = await auth.getAuthenticatedUserAsync(form.username, form.password)
+        if user is None:
             logger.info("login attempt to '%s'. fail", form.username)
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
@@ -418,19 +1167,32 @@ class User(BaseModel):
                 headers={"WWW-Authenticate": "Bearer"},
             )
         logger.info("login attempt to %s", form.username)
-        tokenbody = auth.generateToken(form.username)
+        tokenbody = auth.generateToken(user)
         return AccessToken(access_token=tokenbody, token_type="bearer")
 
     @classmethod
-    def require(cls, user: User | None = Depends(auth.getCurrentUser)) -> User | None:
+    def require(
+        cls, user: User | None = Depends(auth.getCurrentUserAsync)
+    ) -> User | None:
+        return user
+
+    @classmethod
+    def requireVerified(
+        cls, user: User | None = Depends(auth.getVerifiedUserAsync)
+    ) -> User | None:
+        """
+        :meth:`require` に加えて、DB上の利用者を確かめる。重要な操作のハンドラで使う
+        """
         return user
 
 
 class UserSql(User, Schema):
     """
     ユーザーのDB寄りクラス。
+    パスワードのハッシュを持つので、共有のキャッシュ(redis)には置かない
     """
 
+    sharedCacheAllowed: ClassVar[bool] = False
     hashedPassword: str = Field(..., alias="password")
 
     @classmethod
@@ -444,17 +1206,97 @@ class UserSql(User, Schema):
         value = (self.name, self.email, self.hashedPassword)
 
     @classmethod
+    @readThrough
     def getOne(cls, email: str) -> UserSql | None:
-        conn = connectToDB()
-        query = f"SELECT * FROM {cls.getTableName()} WHERE email = '{email}' LIMIT 1"
-        rows: list[dict] = get_select(query, conn)
+        return cls.getOneUncached(email)
+
+    @classmethod
+    def getOneUncached(cls, email: str) -> UserSql | None:
+        """
+        キャッシュを通さずに、DBから直接読む。パスワードの照合にはこちらを使う
+        """
+        query = f"SELECT * FROM {cls.getTableName()} WHERE email = %s LIMIT 1"
+        with connectToDB() as conn:
+            rows: list[dict] = get_select(query, conn, (email,))
         if rows and isinstance(rows, list):
             user = UserSql(**rows[0])
             return user
         return None
+
+    @classmethod
+    @readThrough
+    async def getOneAsync(cls, email: str) -> UserSql | None:
+        return await cls.getOneUncachedAsync(email)
+
+    @classmethod
+    async def getOneUncachedAsync(cls, email: str) -> UserSql | None:
+        """
+        キャッシュを通さずに、DBから直接読む。パスワードの照合にはこちらを使う
+        """
+        query = f"SELECT * FROM {cls.getTableName()} WHERE email = %s LIMIT 1"
+        async with connectToDBAsync() as conn:
+            rows: list[dict] = await get_select_async(query, (email,), conn)
+        if rows:
+            return UserSql(**rows[0])
+        return None
+
     def asUser(self) -> User:
         return User(**self.model_dump())
 
+
+class TokenRevoke(Schema):
+    """
+    トークンの失効クラス。DB上のtoken_revokeテーブルと対応。
+    revoked_time 以前に発行された、その利用者のトークンは無効になる
+    """
+
+    user_id: int
+    revoked_time: datetime
+
+    @classmethod
+    def getTableName(cls) -> str:
+        return "token_revoke"
+
+    def create(self) -> None:
+        query = f"INSERT INTO {self.getTableName()}(user_id,revoked_time) VALUES (%s,%s) ON DUPLICATE KEY UPDATE revoked_time = VALUES(revoked_time)"
+        with connectToDB() as conn:
+            insert_query(query, (self.user_id, self.revoked_time), conn)
+
+    # 失効はすぐに反映したいので、getOne はキャッシュしない
+    @classmethod
+    def getOne(cls, id: int) -> TokenRevoke | None:
+        query = f"SELECT * FROM {cls.getTableName()} WHERE user_id = %s LIMIT 1"
+        with connectToDB() as conn:
+            rows = get_select(query, conn, (id,))
+        if rows:
+            return TokenRevoke(**rows[0])
+        return None
+
+    @classmethod
+    async def getOneAsync(cls, id: int) -> TokenRevoke | None:
+        query = f"SELECT * FROM {cls.getTableName()} WHERE user_id = %s LIMIT 1"
+        async with connectToDBAsync() as conn:
+            rows = await get_select_async(query, (id,), conn)
+        if rows:
+            return TokenRevoke(**rows[0])
+        return None
+
+    @classmethod
+    def getAll(cls) -> list[TokenRevoke]:
+        """
+        全ての失効を取得する。利用者ごとに一行なので、件数は利用者数を超えない
+        """
+        with connectToDB() as conn:
+            rows = get_select(f"SELECT * FROM {cls.getTableName()}", conn)
+        return [TokenRevoke(**row) for row in rows]
+
+    @classmethod
+    async def getAllAsync(cls) -> list[TokenRevoke]:
+        async with connectToDBAsync() as conn:
+            rows = await get_select_async(f"SELECT * FROM {cls.getTableName()}", None, conn)
+        return [TokenRevoke(**row) for row in rows]
+
+
 class AccessToken(BaseModel):
     access_token: str
     token_type: str
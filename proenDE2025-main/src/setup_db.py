@@ -36,6 +36,10 @@ def setUpDB():
         cursor.execute(
             "CREATE TABLE IF NOT EXISTS user_info(user_id INT PRIMARY KEY AUTO_INCREMENT,name VARCHAR(10) NOT NULL,email VARCHAR(50)  NOT NULL,password VARCHAR(100) NOT NULL)"
         )
+        # トークン失効テーブル
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS token_revoke(user_id INT PRIMARY KEY,revoked_time DATETIME NOT NULL,FOREIGN KEY(user_id) REFERENCES user_info(user_id))"
+        )
         # 車両テーブル
         cursor.execute(
             "CREATE TABLE IF NOT EXISTS car_info(vehicle_id INT PRIMARY KEY AUTO_INCREMENT,vehicle_name VARCHAR(20),district_id INT NOT NULL,FOREIGN KEY(district_id) REFERENCES district_info(district_id))"
@@ -46,8 +50,20 @@ def setUpDB():
         )
         # 検出テーブル
         cursor.execute(
-            "CREATE TABLE IF NOT EXISTS kensys_info(instance_id INT PRIMARY KEY AUTO_INCREMENT,bicycle_id INT NOT NULL,runtime_id INT NOT NULL,detection_time DATETIME NOT NULL,x_chunk INT NOT NULL,y_chunk INT NOT NULL,x_fractional FLOAT NOT NULL,y_fractional FLOAT NOT NULL,image_path VARCHAR(255) NOT NULL,color VARCHAR(10) NOT NULL,has_basket BOOLEAN NOT NULL,has_childseat BOOLEAN NOT NULL,FOREIGN KEY(bicycle_id) REFERENCES bike_info(bicycle_id),FOREIGN KEY(runtime_id) REFERENCES run_info(runtime_id))"
+            "CREATE TABLE IF NOT EXISTS kensys_info(instance_id INT PRIMARY KEY AUTO_INCREMENT,bicycle_id INT NOT NULL,runtime_id INT NOT NULL,detection_time DATETIME NOT NULL,x_chunk INT NOT NULL,y_chunk INT NOT NULL,x_fractional FLOAT NOT NULL,y_fractional FLOAT NOT NULL,image_path VARCHAR(255) NOT NULL,color VARCHAR(10) NOT NULL,has_basket BOOLEAN NOT NULL,has_childseat BOOLEAN NOT NULL,INDEX kensys_chunk(x_chunk,y_chunk),INDEX kensys_run_time(runtime_id,detection_time),INDEX kensys_time(detection_time),FOREIGN KEY(bicycle_id) REFERENCES bike_info(bicycle_id),FOREIGN KEY(runtime_id) REFERENCES run_info(runtime_id))"
         )
+        # インデックスが無い既存の検出テーブルには、後から追加する
+        for indexName, columns in (
+            ("kensys_chunk", "x_chunk,y_chunk"),
+            ("kensys_run_time", "runtime_id,detection_time"),
+            ("kensys_time", "detection_time"),
+        ):
+            cursor.execute(
+                "SELECT COUNT(*) FROM information_schema.statistics WHERE table_schema = DATABASE() AND table_name = 'kensys_info' AND index_name = %s",
+                (indexName,),
+            )
+            if cursor.fetchone()[0] == 0:
+                cursor.execute(f"CREATE INDEX {indexName} ON kensys_info({columns})")
         conn.commit()
         print("✅ All tables created and test data inserted successfully.")
     except MysqlProgrammingError as e:
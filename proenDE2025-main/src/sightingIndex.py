@@ -0,0 +1,211 @@
+"""
+最近の自転車の目撃(検出事例)をメモリ上に保持する空間索引。
+
+取り込み中に、新しい検出が既知の自転車と同じものかどうかを、DBに問い合わせずに判断するのに使う。
+:class:`schemas.BicycleDetect` と同じチャンクで区切った格子に目撃を入れておき、
+問い合わせ地点の周囲のマスだけを調べる。
+保持するのは、最新の目撃から windowSeconds 秒以内のものだけで、それより古いものは捨てる。
+"""
+
+from __future__ import annotations
+from collections import deque
+from datetime import datetime, timedelta
+from threading import Lock
+from typing import Iterable, NamedTuple, Optional
+import sys
+
+from logging import getLogger
+
+from geo import getDistanceMeters, getMetersPerDegree
+from schemas import BicycleDetect, CHUNKDEGREES
+
+logger = getLogger("BicycleCheck.sightingindex")
+
+# 既定では、30日以内に目撃されたものを保持する
+SIGHTING_WINDOW_SECONDS = 30 * 24 * 60 * 60
+
+
+class Sighting(NamedTuple):
+    instanceId: int
+    bicycleId: int
+    x: float
+    y: float
+    detectionTime: float
+
+
+class NearSighting(NamedTuple):
+    meters: float
+    sighting: Sighting
+
+
+class SightingIndex(object):
+    """
+    チャンクごとのマスに目撃を入れた格子状の空間索引。複数のスレッドから使える。
+    """
+
+    windowSeconds: float
+    evictCount: int
+    _cells: dict[tuple[int, int], dict[int, Sighting]]
+    _order: deque[tuple[float, int, tuple[int, int]]]
+    _latestTime: float
+    _lock: Lock
+
+    def __init__(self, windowSeconds: float = SIGHTING_WINDOW_SECONDS) -> None:
+        self.windowSeconds = windowSeconds
+        self.evictCount = 0
+        self._cells = {}
+        # (検出日時, 事例id, マス) を追加順に並べたもの。古いものから捨てるのに使う
+        self._order = deque()
+        self._latestTime = float("-inf")
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    @classmethod
+    def loadFromDB(
+        cls, windowSeconds: float = SIGHTING_WINDOW_SECONDS
+    ) -> SightingIndex:
+        """
+        現在から windowSeconds 秒以内の検出事例をDBから読み込んで索引を作る
+        """
+        index = cls(windowSeconds)
+        since = datetime.now() - timedelta(seconds=windowSeconds)
+        index.addDetects(BicycleDetect.getSince(since))
+        logger.info(
+            f"loaded {len(index)} sightings since {since}. {index.getMemoryBytes() / 1_000_000:.1f} MB"
+        )
+        return index
+
+    @staticmethod
+    def _getCell(x: float, y: float) -> tuple[int, int]:
+        return (
+            BicycleDetect.coordinateActualToChunked(x)[0],
+            BicycleDetect.coordinateActualToChunked(y)[0],
+        )
+
+    def add(self, sighting: Sighting) -> None:
+        cell = self._getCell(sighting.x, sighting.y)
+        with self._lock:
+            self._cells.setdefault(cell, {})[sighting.instanceId] = sighting
+            self._order.append((sighting.detectionTime, sighting.instanceId, cell))
+            if sighting.detectionTime > self._latestTime:
+                self._latestTime = sighting.detectionTime
+                self._evict(self._latestTime - self.windowSeconds)
+
+    def addDetects(self, detects: Iterable[BicycleDetect]) -> None:
+        """
+        DBに保存済みの検出事例を追加する。検出日時の古い順に渡すこと
+        """
+        for detect in detects:
+            self.add(
+                Sighting(
+                    detect.instance_id,
+                    detect.bicycle_id,
+                    detect.coordinate_x,
+                    detect.coordinate_y,
+                    detect.detection_time.timestamp(),
+                )
+            )
+
+    def _evict(self, cutoffTime: float) -> None:
+        """
+        cutoffTime より前の目撃を捨てる。ロックを取った状態で呼ぶこと。
+        ほぼ検出日時の順に追加される前提で、先頭から古いものだけを見る
+        """
+        while self._order and self._order[0][0] < cutoffTime:
+            _, instanceId, cell = self._order.popleft()
+            sightings = self._cells.get(cell)
+            if sightings is None:
+                continue
+            sightings.pop(instanceId, None)
+            if not sightings:
+                del self._cells[cell]
+            self.evictCount += 1
+
+    def getWithinRadius(
+        self, x: float, y: float, radiusMeters: float
+    ) -> list[NearSighting]:
+        """
+        指定した地点から radiusMeters 以内の目撃を、近い順に取得する
+        """
+        metersPerX, metersPerY = getMetersPerDegree(y)
+        spanX = int(radiusMeters / (CHUNKDEGREES * metersPerX)) + 1
+        spanY = int(radiusMeters / (CHUNKDEGREES * metersPerY)) + 1
+        centerX, centerY = self._getCell(x, y)
+        result: list[NearSighting] = []
+        with self._lock:
+            for cellX in range(centerX - spanX, centerX + spanX + 1):
+                for cellY in range(centerY - spanY, centerY + spanY + 1):
+                    sightings = self._cells.get((cellX, cellY))
+                    if sightings is None:
+                        continue
+                    for sighting in sightings.values():
+                        meters = getDistanceMeters(x, y, sighting.x, sighting.y)
+                        if meters <= radiusMeters:
+                            result.append(NearSighting(meters, sighting))
+        result.sort()
+        return result
+
+    def getNearest(
+        self, x: float, y: float, count: int = 1, maxMeters: float = 1000.0
+    ) -> list[NearSighting]:
+        """
+        指定した地点に近い順に、maxMeters 以内の目撃を最大 count 件取得する。
+        近くのマスから順に広げて探し、それより外に近いものが無いと分かった時点で止める
+        """
+        metersPerX, metersPerY = getMetersPerDegree(y)
+        cellMeters = CHUNKDEGREES * min(metersPerX, metersPerY)
+        maxRing = int(maxMeters / cellMeters) + 1
+        centerX, centerY = self._getCell(x, y)
+        found: list[NearSighting] = []
+        with self._lock:
+            for ring in range(maxRing + 1):
+                for cellX in range(centerX - ring, centerX + ring + 1):
+                    isEdgeColumn = abs(cellX - centerX) == ring
+                    for cellY in range(centerY - ring, centerY + ring + 1):
+                        # 前の周で調べたマスは飛ばす
+                        if not isEdgeColumn and abs(cellY - centerY) != ring:
+                            continue
+                        sightings = self._cells.get((cellX, cellY))
+                        if sightings is None:
+                            continue
+                        for sighting in sightings.values():
+                            meters = getDistanceMeters(x, y, sighting.x, sighting.y)
+                            if meters <= maxMeters:
+                                found.append(NearSighting(meters, sighting))
+                # この周の外側のマスは、どれも ring * cellMeters より遠い
+                if len(found) >= count:
+                    found.sort()
+                    if found[count - 1].meters <= ring * cellMeters:
+                        break
+        found.sort()
+        return found[:count]
+
+    def findBicycleId(
+        self, x: float, y: float, radiusMeters: float
+    ) -> Optional[int]:
+        """
+        radiusMeters 以内で最も近い目撃の自転車idを返す。無ければNone
+        """
+        nearest = self.getNearest(x, y, 1, radiusMeters)
+        if not nearest:
+            return None
+        return nearest[0].sighting.bicycleId
+
+    def getMemoryBytes(self) -> int:
+        """
+        索引が使っているメモリのおおよその量(バイト)。目撃の数に比例する時間がかかる
+        """
+        with self._lock:
+            total = sys.getsizeof(self._cells) + sys.getsizeof(self._order)
+            for cell, sightings in self._cells.items():
+                total += sys.getsizeof(cell) + sys.getsizeof(sightings)
+                for sighting in sightings.values():
+                    # タプル本体と、中の数値オブジェクト
+                    total += sys.getsizeof(sighting) + sum(
+                        sys.getsizeof(value) for value in sighting
+                    )
+            # 順序用のタプル。中の値は目撃と共有している
+            total += len(self._order) * sys.getsizeof((0.0, 0, (0, 0)))
+        return total
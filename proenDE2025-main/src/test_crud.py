@@ -0,0 +1,58 @@
+import pytest
+
+pytest.importorskip("mysql.connector")
+
+from mysql.connector import connect  # noqa: E402
+from mysql.connector.errors import Error as MysqlError  # noqa: E402
+
+import crud  # noqa: E402
+from crud import bulk_insert_query, getDBConfig  # noqa: E402
+
+TABLE = "bulk_insert_test"
+
+
+@pytest.fixture
+def conn():
+    """
+    テスト用の表を作り、終わったら消す
+    """
+    try:
+        dbconfig = getDBConfig()
+        conn = connect(
+            host=dbconfig["host"],
+            user=dbconfig["user"],
+            password=dbconfig["password"],
+            database=dbconfig["database"],
+        )
+    except (FileNotFoundError, KeyError, MysqlError) as e:
+        pytest.skip(f"DB is not available: {e}")
+    cursor = conn.cursor()
+    cursor.execute(
+        f"CREATE TABLE IF NOT EXISTS {TABLE} (id INT AUTO_INCREMENT PRIMARY KEY, value INT NOT NULL)"
+    )
+    cursor.execute(f"DELETE FROM {TABLE}")
+    conn.commit()
+    cursor.close()
+    yield conn
+    cursor = conn.cursor()
+    cursor.execute(f"DROP TABLE {TABLE}")
+    conn.commit()
+    conn.close()
+
+
+@pytest.mark.parametrize("step", [1, None])
+def test_bulkInsertReturnsIdsOfEachRow(conn, monkeypatch, step) -> None:
+    # None は innodb_autoinc_lock_mode=2 の場合で、idを読み直す
+    monkeypatch.setattr(crud, "getAutoIncrementStep", lambda conn: step)
+    values = list(range(100, 125))
+
+    ids = bulk_insert_query(
+        f"INSERT INTO {TABLE}(value) VALUES (%s)", [(value,) for value in values], 10, conn
+    )
+
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT id, value FROM {TABLE}")
+    rows = dict(cursor.fetchall())
+    cursor.close()
+    assert None not in ids
+    assert [rows[id] for id in ids] == values
@@ -0,0 +1,58 @@
+from asyncio import run
+
+import pytest
+
+pytest.importorskip("mysql.connector.aio")
+
+from mysql.connector import connect  # noqa: E402
+from mysql.connector.errors import Error as MysqlError  # noqa: E402
+
+from crud import getDBConfig  # noqa: E402
+from crudAsync import AsyncConnectionPool, get_select_async  # noqa: E402
+
+TABLE = "pool_snapshot_test"
+
+
+@pytest.fixture
+def writer():
+    """
+    プールとは別の接続。テスト用の表を作り、終わったら消す
+    """
+    try:
+        dbconfig = getDBConfig()
+        conn = connect(
+            host=dbconfig["host"],
+            user=dbconfig["user"],
+            password=dbconfig["password"],
+            database=dbconfig["database"],
+        )
+    except (FileNotFoundError, KeyError, MysqlError) as e:
+        pytest.skip(f"DB is not available: {e}")
+    cursor = conn.cursor()
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS {TABLE} (id INT PRIMARY KEY)")
+    cursor.execute(f"DELETE FROM {TABLE}")
+    conn.commit()
+    yield conn
+    cursor.execute(f"DROP TABLE {TABLE}")
+    conn.commit()
+    conn.close()
+
+
+def test_pooledConnectionSeesLaterCommits(writer) -> None:
+    async def readTwice() -> tuple[list, list]:
+        # 接続が1つだけなので、2回とも同じ接続で読む
+        pool = AsyncConnectionPool(1, 5.0)
+        async with pool.borrow() as conn:
+            before = await get_select_async(f"SELECT id FROM {TABLE}", conn=conn)
+        cursor = writer.cursor()
+        cursor.execute(f"INSERT INTO {TABLE} (id) VALUES (1)")
+        writer.commit()
+        async with pool.borrow() as conn:
+            after = await get_select_async(f"SELECT id FROM {TABLE}", conn=conn)
+            await conn.close()
+        return before, after
+
+    before, after = run(readTwice())
+
+    assert before == []
+    assert after == [{"id": 1}]
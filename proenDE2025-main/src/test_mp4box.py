@@ -0,0 +1,67 @@
+from pathlib import Path
+from struct import pack
+
+import pytest
+
+from mp4box import CSMDATMAGIC, TAILSEARCHCHUNKSIZE, findCsmdat
+
+# ドラレコのファイルで、CSMDATがファイル末尾から何バイト手前にあるか
+CSMDAT_FROM_END = 598068
+
+
+def _box(boxType: bytes, body: bytes) -> bytes:
+    return pack(">I4s", 8 + len(body), boxType) + body
+
+
+def _writeRecorderLayout(path: Path, paddingSize: int, csmdatFromEnd: int) -> int:
+    """
+    ftyp / skip / mdat / moov の後ろに 'A' で埋めた領域が続き、その途中にCSMDATがあるファイルを書く。
+    'A' の領域は、サイズ 0x41414141 の "AAAA" ボックスとして読める。CSMDATの位置を返す
+    """
+    head = (
+        _box(b"ftyp", b"isom\x00\x00\x02\x00isomiso2mp41")
+        + _box(b"skip", b"\x00" * 32)
+        + _box(b"mdat", b"\x01\x02\x03\x04" * 4096)
+        + _box(b"moov", _box(b"mvhd", b"\x00" * 100))
+    )
+    payload = CSMDATMAGIC + b"20250816A" + b"0" * (csmdatFromEnd - len(CSMDATMAGIC) - 9)
+    with open(path, "wb") as file:
+        file.write(head)
+        file.write(b"A" * paddingSize)
+        file.write(payload)
+    return len(head) + paddingSize
+
+
+def test_findCsmdatInsidePaddingBox(tmp_path: Path) -> None:
+    path = tmp_path.joinpath("A___-250816-111814-000578F.MP4")
+    offset = _writeRecorderLayout(path, 24 * 1024 * 1024, CSMDAT_FROM_END)
+    fileSize = path.stat().st_size
+    assert offset == fileSize - CSMDAT_FROM_END
+
+    payload = findCsmdat(path)
+
+    assert payload is not None
+    assert payload.offset == offset
+    assert payload.size == CSMDAT_FROM_END
+
+
+@pytest.mark.parametrize("shift", [-3, -1, 0, 2])
+def test_findCsmdatAcrossChunkBoundary(tmp_path: Path, shift: int) -> None:
+    # CSMDATが読み込みの区切りをまたぐ位置にあっても見つける
+    path = tmp_path.joinpath("boundary.MP4")
+    offset = _writeRecorderLayout(path, 2 * TAILSEARCHCHUNKSIZE, TAILSEARCHCHUNKSIZE + shift)
+
+    payload = findCsmdat(path)
+
+    assert payload is not None
+    assert payload.offset == offset
+
+
+def test_findCsmdatMissing(tmp_path: Path) -> None:
+    # 途中で切れてCSMDATまで届いていないファイル
+    path = tmp_path.joinpath("truncated.MP4")
+    _writeRecorderLayout(path, 1024 * 1024, CSMDAT_FROM_END)
+    with open(path, "r+b") as file:
+        file.truncate(path.stat().st_size - CSMDAT_FROM_END)
+
+    assert findCsmdat(path) is None
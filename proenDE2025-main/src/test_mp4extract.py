@@ -0,0 +1,118 @@
+from pathlib import Path
+from struct import pack
+
+import numpy as np
+import pytest
+
+from mp4box import CSMDATMAGIC, CSMDATTAILOFFSET
+from mp4extract import CHUNKSIZE, HEADERSIZE, Mp4File, Mp4FrameIndex, Mp4Track
+
+
+def _record(
+    index: int,
+    flag: bytes = b"A",
+    latitude: bytes = b"3541.2345N",
+    longitude: bytes = b"13945.6789E",
+    timestamp: bytes = b"250816111814.500",
+) -> bytes:
+    """
+    CSMDATの130バイトのレコード。緯度は度2桁・分7桁・N/S、経度は度3桁・分7桁・E/W
+    """
+    head = b"%08d" % index + flag + latitude + longitude + b"0000" + timestamp
+    return head + b"0" * (CHUNKSIZE - len(head))
+
+
+def _writeCsmdat(path: Path, records: list[bytes]) -> None:
+    """
+    動画本体の後ろ、ファイル末尾から CSMDATTAILOFFSET の位置にCSMDATを置き、残りを空白で埋める
+    """
+    head = pack(">I4s", 16, b"mdat") + b"\x00" * 8 + pack(">I4s", 8, b"moov")
+    block = CSMDATMAGIC + b"0" * (HEADERSIZE - len(CSMDATMAGIC)) + b"".join(records)
+    with open(path, "wb") as file:
+        file.write(head)
+        file.write(block)
+        file.write(b" " * (CSMDATTAILOFFSET - len(block)))
+
+
+def _index(latitudes: list[float]) -> Mp4FrameIndex:
+    count = len(latitudes)
+    return Mp4FrameIndex(
+        np.array(latitudes, dtype=np.float64),
+        np.array(latitudes, dtype=np.float64) + 100,
+        np.arange(count).astype("datetime64[s]").astype("datetime64[us]"),
+    )
+
+
+def test_getLocationsClipsOutOfRange() -> None:
+    latitudes, longitudes, timestamps = _index([35.0, 35.1, 35.2]).getLocations(
+        [-1, 1, 5]
+    )
+    assert latitudes.tolist() == [35.0, 35.1, 35.2]
+    assert longitudes.tolist() == [135.0, 135.1, 135.2]
+    assert timestamps[0] == np.datetime64(0, "s")
+
+
+def test_getLocationsOfEmptyIndex() -> None:
+    # フレーム数が取れなかった動画の索引
+    latitudes, longitudes, timestamps = _index([]).getLocations([0, 3])
+    assert np.isnan(latitudes).all() and latitudes.shape == (2,)
+    assert np.isnan(longitudes).all() and longitudes.shape == (2,)
+    assert np.isnat(timestamps).all() and timestamps.shape == (2,)
+
+
+def test_readRecordsStopsAtFirstBlankRecord(tmp_path: Path) -> None:
+    # ブロックの後半は空白で埋められている。レコードの数はその手前まで
+    path = tmp_path.joinpath("A___-250816-111814-000578F.MP4")
+    _writeCsmdat(path, [_record(index) for index in range(1, 131)])
+
+    records = Mp4File(path)._readRecords()
+
+    assert records.shape == (130, CHUNKSIZE)
+    assert bytes(records[-1, :8]) == b"00000130"
+
+
+def _toArray(records: list[bytes]) -> np.ndarray:
+    return np.frombuffer(b"".join(records), dtype=np.uint8).reshape(-1, CHUNKSIZE)
+
+
+def test_fromRecordsMatchesParseCoordinate() -> None:
+    records = [
+        _record(1),
+        _record(2, b"V", b"0000.0000N", b"00000.0000E"),
+        _record(3, latitude=b"3300.0001S", longitude=b"07030.5000W"),
+        _record(4, latitude=b"0959.9999N", longitude=b"00001.2500W"),
+        _record(5, b"V", timestamp=b"991231235959.999"),
+        _record(6, timestamp=b"240229000000.001"),
+        _record(7, b"V", b"          ", b"           ", b"250101000000.000"),
+    ]
+
+    coordinates = Mp4Track.fromRecords(_toArray(records)).toCoordinates()
+
+    assert coordinates == [Mp4File._parseCoordinate(record) for record in records]
+
+
+@pytest.mark.parametrize(
+    "timestamp",
+    [
+        b"251316111814.500",
+        b"250230111814.500",
+        b"250100111814.500",
+        b"250816241814.500",
+        b"250816116014.500",
+        b"250816111860.500",
+        b"250816111814x500",
+    ],
+)
+def test_fromRecordsSkipsInvalidDate(timestamp: bytes) -> None:
+    # strptime が受け付けない日付のレコードは、他のレコードを残して飛ばす
+    badRecord = _record(2, timestamp=timestamp)
+    with pytest.raises(ValueError):
+        Mp4File._parseCoordinate(badRecord)
+
+    track = Mp4Track.fromRecords(_toArray([_record(1), badRecord, _record(3)]))
+
+    assert track.indexes.tolist() == [1, 3]
+    assert track.toCoordinates() == [
+        Mp4File._parseCoordinate(_record(1)),
+        Mp4File._parseCoordinate(_record(3)),
+    ]
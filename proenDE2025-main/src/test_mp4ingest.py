@@ -0,0 +1,100 @@
+from pathlib import Path
+
+import numpy as np
+import cv2
+import pytest
+
+from frameWriter import FrameWriteException
+from mp4extract import Mp4File, Mp4UnrecognizableException
+from mp4ingest import RESULTFILENAME, groupRuns, ingestFile
+
+
+def _files(directory: Path, names: list[str]) -> list[Mp4File]:
+    mp4Files: list[Mp4File] = []
+    for name in names:
+        path = directory.joinpath(name)
+        path.touch()
+        mp4Files.append(Mp4File(path))
+    return mp4Files
+
+
+def _names(runs: list[list[Mp4File]]) -> list[list[str]]:
+    return [[mp4File.path.name for mp4File in run] for run in runs]
+
+
+def test_groupRunsAcrossMidnight(tmp_path: Path) -> None:
+    # 23:58から走り出し、日付をまたいで続いた走行
+    names = [
+        "A___-250816-235800-000100F.MP4",
+        "A___-250816-235900-000101F.MP4",
+        "A___-250817-000000-000102F.MP4",
+        "A___-250817-000100-000103F.MP4",
+    ]
+    runs = groupRuns(_files(tmp_path, list(reversed(names))))
+    assert _names(runs) == [names]
+
+
+def test_groupRunsSplitsByCameraHeadAndSerial(tmp_path: Path) -> None:
+    runs = groupRuns(
+        _files(
+            tmp_path,
+            [
+                "A___-250816-101000-000005R.MP4",
+                "A___-250816-100000-000001F.MP4",
+                "A___-250816-100100-000002F.MP4",
+                "A__S-250816-110000-000003F.MP4",
+                "A___-250816-120000-000005F.MP4",
+                "A___-250816-100000-000004R.MP4",
+            ],
+        )
+    )
+    assert _names(runs) == [
+        ["A___-250816-100000-000001F.MP4", "A___-250816-100100-000002F.MP4"],
+        ["A__S-250816-110000-000003F.MP4"],
+        ["A___-250816-120000-000005F.MP4"],
+        ["A___-250816-100000-000004R.MP4", "A___-250816-101000-000005R.MP4"],
+    ]
+
+
+def test_groupRunsSameSerialOnOtherDays(tmp_path: Path) -> None:
+    # 別の日に同じ連番が使われても、日付の順に分けて交互に繋がない
+    names = [
+        "A___-250816-100000-000010F.MP4",
+        "A___-250816-100100-000011F.MP4",
+        "A___-250820-090000-000011F.MP4",
+        "A___-250820-090100-000012F.MP4",
+    ]
+    runs = groupRuns(_files(tmp_path, names))
+    assert _names(runs) == [names[:2], names[2:]]
+
+
+def test_groupRunsInterleavedSerialsOnOtherDays(tmp_path: Path) -> None:
+    # 別の日の走行が、前の日の走行と同じ連番を使い、連番の範囲が重なる
+    names = [
+        "A___-250816-100000-000010F.MP4",
+        "A___-250816-100100-000011F.MP4",
+        "A___-250816-100200-000012F.MP4",
+        "A___-250820-090000-000011F.MP4",
+        "A___-250820-090100-000012F.MP4",
+    ]
+    runs = groupRuns(_files(tmp_path, list(reversed(names))))
+    assert _names(runs) == [names[:3], names[3:]]
+
+
+def test_ingestFileFailedWriteIsNotFinished(tmp_path: Path, monkeypatch) -> None:
+    # フレームを書き出せなかったファイルは、結果ファイルを書かずに失敗とする
+    path = _files(tmp_path, ["A___-250816-100000-000001F.MP4"])[0].path
+    frame = np.zeros((8, 8, 3), dtype=np.uint8)
+
+    def getTrack(self):
+        raise Mp4UnrecognizableException("no CSMDAT")
+
+    monkeypatch.setattr(Mp4File, "getTrack", getTrack)
+    monkeypatch.setattr(Mp4File, "iterateFrames", lambda self, step: iter([(0, frame)]))
+    monkeypatch.setattr(cv2, "imencode", lambda *args: (False, None))
+    outputDir = tmp_path.joinpath("ingest")
+
+    with pytest.raises(FrameWriteException):
+        ingestFile(path, outputDir, 1, tmp_path.joinpath("cache"))
+
+    assert not outputDir.joinpath(path.stem, RESULTFILENAME).exists()
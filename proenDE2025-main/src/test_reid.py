@@ -0,0 +1,64 @@
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pytest
+
+from BicycleCheck.reid import AppearanceEncoder, REID_MIN_SIMILARITY, REIDWHITENINGPATH
+
+ROOTDIR = Path(__file__).parent.parent
+DATASETDIR = ROOTDIR.joinpath("yolo/datasets/yolo11/ver2")
+
+
+@pytest.fixture(scope="module")
+def encoder() -> AppearanceEncoder:
+    return AppearanceEncoder(whiteningPath=ROOTDIR.joinpath(REIDWHITENINGPATH))
+
+
+@pytest.fixture(scope="module")
+def heldOutImages() -> list[np.ndarray]:
+    # 白色化は train で求めているので、それ以外の写真で確かめる
+    paths = sorted(DATASETDIR.glob("valid/images/*.jpg")) + sorted(
+        DATASETDIR.glob("test/images/*.jpg")
+    )
+    return [cv2.imread(str(path)) for path in paths]
+
+
+def test_differentBicyclesBelowThreshold(
+    encoder: AppearanceEncoder, heldOutImages: list[np.ndarray]
+) -> None:
+    vectors = encoder.encodeBatch(heldOutImages[:2])
+
+    assert float(vectors[0] @ vectors[1]) < REID_MIN_SIMILARITY
+
+
+def test_differentBicyclesRarelyMatch(
+    encoder: AppearanceEncoder, heldOutImages: list[np.ndarray]
+) -> None:
+    vectors = encoder.encodeBatch(heldOutImages)
+    similarities = (vectors @ vectors.T)[~np.eye(len(vectors), dtype=bool)]
+
+    assert (similarities >= REID_MIN_SIMILARITY).mean() < 0.01
+
+
+def test_sameBicycleMatches(
+    encoder: AppearanceEncoder, heldOutImages: list[np.ndarray]
+) -> None:
+    # 少し明るく、小さく写った同じ自転車
+    image = heldOutImages[0]
+    other = cv2.resize(
+        cv2.convertScaleAbs(image, alpha=1.1, beta=10),
+        None,
+        fx=0.6,
+        fy=0.6,
+        interpolation=cv2.INTER_AREA,
+    )
+    vectors = encoder.encodeBatch([image, other])
+
+    assert float(vectors[0] @ vectors[1]) >= REID_MIN_SIMILARITY
+
+
+def test_emptyCropIsZero(encoder: AppearanceEncoder) -> None:
+    vectors = encoder.encodeBatch([np.zeros((0, 0, 3), dtype=np.uint8)])
+
+    assert not vectors.any()
@@ -0,0 +1,45 @@
+from base64 import urlsafe_b64encode
+from datetime import datetime
+from json import dumps as jsonDumps
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("mysql.connector.aio")
+
+from fastapi.exceptions import HTTPException  # noqa: E402
+
+from schemas import decodeCursor, encodeCursor  # noqa: E402
+
+
+def _cursor(value) -> str:
+    return urlsafe_b64encode(jsonDumps(value).encode()).decode()
+
+
+def test_decodeCursorRoundTrip() -> None:
+    time = datetime(2025, 8, 16, 11, 18, 14)
+    assert decodeCursor(encodeCursor([12]), (int,)) == [12]
+    assert decodeCursor(encodeCursor([time, 3]), (str, int)) == [time.isoformat(), 3]
+
+
+@pytest.mark.parametrize(
+    "cursor, types",
+    [
+        ("not base64!", (int,)),
+        (urlsafe_b64encode(b"{").decode(), (int,)),
+        # 形は正しいJSONでも、キーの数や型が違うもの
+        (_cursor(12), (int,)),
+        (_cursor({"id": 12}), (int,)),
+        (_cursor([]), (int,)),
+        (_cursor([1, 2]), (int,)),
+        (_cursor(["12"]), (int,)),
+        (_cursor([True]), (int,)),
+        (_cursor(["2025-08-16T11:18:14"]), (str, int)),
+        (_cursor([1, 2, 3]), (str, int)),
+        (_cursor([None, 3]), (str, int)),
+    ],
+)
+def test_decodeCursorRejectsMalformed(cursor: str, types: tuple[type, ...]) -> None:
+    with pytest.raises(HTTPException) as info:
+        decodeCursor(cursor, types)
+    assert info.value.status_code == 400
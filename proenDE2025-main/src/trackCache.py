@@ -0,0 +1,139 @@
+"""
+GPSトラックのディスクキャッシュ。
+
+解析済みの :class:`mp4extract.Mp4Track` を列ごとの配列として .npz に保存し、
+SQLiteの索引でファイルの同一性(パス・サイズ・更新日時・開始日時と連番)と対応づける。
+プロセスを再起動しても、同じファイルを再度取り込む場合も解析をやり直さずに済む。
+"""
+
+from __future__ import annotations
+from contextlib import closing
+from hashlib import sha1
+from pathlib import Path
+from time import time
+from typing import Optional
+import os
+import sqlite3
+
+from logging import getLogger
+
+import numpy as np
+
+logger = getLogger("BicycleCheck.trackcache")
+
+CACHEDIR = Path("tmp/trackcache")
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+INDEXFILENAME = "index.sqlite"
+
+
+class TrackCache(object):
+    """
+    .npz ファイルとSQLiteの索引からなる、容量上限つきのLRUキャッシュ。
+    ファイルの全レコード(full)と間引いたレコード(interval)は別のエントリとして保存する。
+    """
+
+    cacheDir: Path
+    maxBytes: int
+    hitCount: int
+    missCount: int
+    evictCount: int
+
+    def __init__(
+        self, cacheDir: Path = CACHEDIR, maxBytes: int = CACHE_MAX_BYTES
+    ) -> None:
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.hitCount = 0
+        self.missCount = 0
+        self.evictCount = 0
+        self.cacheDir.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries(key TEXT PRIMARY KEY,path TEXT NOT NULL,view TEXT NOT NULL,bytes INTEGER NOT NULL,last_access REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS entries_last_access ON entries(last_access)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        # プロセスプールの各ワーカーから同時に触られるので、ロック待ちを長めにとる
+        return sqlite3.connect(self.cacheDir.joinpath(INDEXFILENAME), timeout=30)
+
+    @staticmethod
+    def getKey(path: Path, serial: str, view: str) -> str:
+        """
+        パス・サイズ・更新日時・開始日時と連番・ビュー名からキャッシュキーを作る
+        """
+        stat = path.stat()
+        identity = (
+            f"{path.absolute()}|{stat.st_size}|{stat.st_mtime_ns}|{serial}|{view}"
+        )
+        return sha1(identity.encode()).hexdigest()
+
+    def _getEntryPath(self, key: str) -> Path:
+        return self.cacheDir.joinpath(f"{key}.npz")
+
+    def get(
+        self, path: Path, serial: str, view: str
+    ) -> Optional[dict[str, np.ndarray]]:
+        key = self.getKey(path, serial, view)
+        entryPath = self._getEntryPath(key)
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute(
+                "SELECT key FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and entryPath.exists():
+                conn.execute(
+                    "UPDATE entries SET last_access = ? WHERE key = ?", (time(), key)
+                )
+                with np.load(entryPath) as arrays:
+                    result = {name: arrays[name] for name in arrays.files}
+                self.hitCount += 1
+                logger.info(
+                    f"track cache hit: '{path.name}' {view} (hit {self.hitCount}, miss {self.missCount})"
+                )
+                return result
+        self.missCount += 1
+        logger.info(
+            f"track cache miss: '{path.name}' {view} (hit {self.hitCount}, miss {self.missCount})"
+        )
+        return None
+
+    def put(
+        self, path: Path, serial: str, view: str, arrays: dict[str, np.ndarray]
+    ) -> None:
+        key = self.getKey(path, serial, view)
+        entryPath = self._getEntryPath(key)
+        temporaryPath = entryPath.with_suffix(f".{os.getpid()}.tmp")
+        with open(temporaryPath, "wb") as file:
+            np.savez(file, **arrays)
+        os.replace(temporaryPath, entryPath)
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries(key,path,view,bytes,last_access) VALUES (?,?,?,?,?)",
+                (key, str(path.absolute()), view, entryPath.stat().st_size, time()),
+            )
+            self._evict(conn)
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        """
+        合計サイズが上限を超えている間、最も古く使われたエントリから削除する
+        """
+        totalBytes: int = conn.execute(
+            "SELECT COALESCE(SUM(bytes), 0) FROM entries"
+        ).fetchone()[0]
+        if totalBytes <= self.maxBytes:
+            return
+        rows = conn.execute(
+            "SELECT key, bytes FROM entries ORDER BY last_access ASC"
+        ).fetchall()
+        for key, entryBytes in rows:
+            if totalBytes <= self.maxBytes:
+                break
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self._getEntryPath(key).unlink(missing_ok=True)
+            totalBytes -= entryBytes
+            self.evictCount += 1
+        logger.info(
+            f"track cache evicted down to {totalBytes} bytes (evicted {self.evictCount})"
+        )